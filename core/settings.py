@@ -62,7 +62,7 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
     "django.middleware.security.SecurityMiddleware",
-    "whitenoise.middleware.WhiteNoiseMiddleware",
+    "home.middleware.static_files.AsyncWhiteNoiseMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -70,6 +70,7 @@ MIDDLEWARE = [
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
     "home.middleware.kiosk_auth.KioskAuthMiddleware",
+    "home.middleware.media_cache.ImmutableMediaMiddleware",
 ]
 
 if DEBUG:
@@ -102,6 +103,10 @@ WSGI_APPLICATION = "core.wsgi.application"
 # Stripe
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
+# True when a `process_stripe_events --loop` worker applies queued webhook events; otherwise the webhook view does
+STRIPE_WEBHOOK_WORKER = str2bool(os.environ.get('STRIPE_WEBHOOK_WORKER', 'False'))
+# Alternative API base, e.g. the local stand-in started by run_payment_fakes; unset uses api.stripe.com
+STRIPE_API_BASE = os.getenv("STRIPE_API_BASE")
 
 # Database
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
@@ -260,10 +265,12 @@ SWAGGER_SETTINGS = {
 # CORS settings
 CORS_ALLOW_ALL_ORIGINS = True
 
+# Point CACHE_BACKEND at a shared backend (Redis, Memcached, DatabaseCache) in
+# production so cache-held state is shared by every gunicorn worker.
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-        'LOCATION': 'unique-snowflake',
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', 'unique-snowflake'),
     }
 }
 
@@ -309,3 +316,55 @@ LOGGING = {
 PAYPAL_CLIENT_ID = os.environ.get('PAYPAL_CLIENT_ID')
 PAYPAL_CLIENT_SECRET = os.environ.get('PAYPAL_CLIENT_SECRET')
 PAYPAL_MODE = os.environ.get('PAYPAL_MODE')
+# Alternative API base, e.g. the local stand-in started by run_payment_fakes; unset uses PAYPAL_MODE's endpoint
+PAYPAL_API_BASE = os.environ.get('PAYPAL_API_BASE')
+# The shared PayPal access token is replaced this long before it expires
+PAYPAL_TOKEN_REFRESH_MARGIN_SECONDS = int(os.environ.get('PAYPAL_TOKEN_REFRESH_MARGIN_SECONDS', 300))
+
+# Instagram outbound budget (shared through the cache by all workers)
+INSTAGRAM_REQUESTS_PER_MINUTE = int(os.environ.get('INSTAGRAM_REQUESTS_PER_MINUTE', 20))
+INSTAGRAM_BURST = int(os.environ.get('INSTAGRAM_BURST', 10))
+INSTAGRAM_BACKGROUND_RESERVE = int(os.environ.get('INSTAGRAM_BACKGROUND_RESERVE', 3))
+INSTAGRAM_BACKOFF_BASE_SECONDS = int(os.environ.get('INSTAGRAM_BACKOFF_BASE_SECONDS', 60))
+INSTAGRAM_BACKOFF_MAX_SECONDS = int(os.environ.get('INSTAGRAM_BACKOFF_MAX_SECONDS', 3600))
+
+# Card image renditions generated on save (widths in pixels)
+CARD_RENDITION_WIDTHS = [int(width) for width in os.environ.get('CARD_RENDITION_WIDTHS', '320,640,1280').split(',')]
+CARD_RENDITIONS_ASYNC = str2bool(os.environ.get('CARD_RENDITIONS_ASYNC', 'True'))
+CARD_SPRITE_TILE_SIZE = (160, 240)
+
+# Card change feed entries are served once they are this old, so a slower transaction's earlier seq is never skipped
+CARD_CHANGES_SETTLE_SECONDS = int(os.environ.get('CARD_CHANGES_SETTLE_SECONDS', 5))
+
+# Replaced content-addressed card media is kept this long before garbage collection
+CARD_MEDIA_GC_GRACE_HOURS = int(os.environ.get('CARD_MEDIA_GC_GRACE_HOURS', 72))
+
+# Shared outbound HTTP client for Stripe and PayPal (timeouts in seconds)
+OUTBOUND_HTTP_CONNECT_TIMEOUT = float(os.environ.get('OUTBOUND_HTTP_CONNECT_TIMEOUT', 3.05))
+OUTBOUND_HTTP_READ_TIMEOUT = float(os.environ.get('OUTBOUND_HTTP_READ_TIMEOUT', 30))
+OUTBOUND_HTTP_RETRIES = int(os.environ.get('OUTBOUND_HTTP_RETRIES', 2))
+OUTBOUND_HTTP_POOL_HOSTS = int(os.environ.get('OUTBOUND_HTTP_POOL_HOSTS', 10))
+OUTBOUND_HTTP_POOL_SIZE = int(os.environ.get('OUTBOUND_HTTP_POOL_SIZE', 10))
+# Concurrent connections per event loop for async views (Stripe *_async calls)
+OUTBOUND_HTTP_ASYNC_MAX_CONNECTIONS = int(os.environ.get('OUTBOUND_HTTP_ASYNC_MAX_CONNECTIONS', 200))
+
+# Kiosk payment status polls are answered from webhook-maintained order state while it is this fresh
+PAYMENT_STATUS_FRESHNESS_SECONDS = int(os.environ.get('PAYMENT_STATUS_FRESHNESS_SECONDS', 30))
+
+# Long-polled order status requests are held at most this long, watching the cache at this interval
+PAYMENT_STATUS_WAIT_TIMEOUT = int(os.environ.get('PAYMENT_STATUS_WAIT_TIMEOUT', 25))
+PAYMENT_STATUS_WAIT_INTERVAL = float(os.environ.get('PAYMENT_STATUS_WAIT_INTERVAL', 0.5))
+
+# Most order ids a kiosk may look up in one batch status request, unless its configuration sets its own
+PAYMENT_STATUS_BATCH_LIMIT = int(os.environ.get('PAYMENT_STATUS_BATCH_LIMIT', 50))
+
+# reconcile_stripe_orders: first run looks back this far; later runs re-check this much before the last run
+STRIPE_RECONCILE_LOOKBACK_HOURS = int(os.environ.get('STRIPE_RECONCILE_LOOKBACK_HOURS', 72))
+STRIPE_RECONCILE_OVERLAP_SECONDS = int(os.environ.get('STRIPE_RECONCILE_OVERLAP_SECONDS', 3600))
+
+# Responses to requests sent with an Idempotency-Key are replayed to retries for this long (Stripe keeps keys 24h)
+IDEMPOTENCY_KEY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_KEY_TTL_SECONDS', 86400))
+
+# Internal nginx location media downloads are handed to via X-Accel-Redirect (e.g. /protected-media/).
+# Unset, Django streams media itself.
+MEDIA_ACCEL_REDIRECT = os.environ.get('MEDIA_ACCEL_REDIRECT', '')
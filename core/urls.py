@@ -82,9 +82,9 @@ urlpatterns = [
     path("api/login", MyLoginView.as_view()),
 ]
 
-# Serving static files in development
+# Serving static files in development (media is served by home.views.serve_media)
 if settings.DEBUG:
-    urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT) + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
 
 if settings.DEBUG:
     urlpatterns += [path("__reload__/", include("django_browser_reload.urls"))]
\ No newline at end of file
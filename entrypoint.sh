@@ -6,6 +6,9 @@ set -e
 # Run migrations
 python manage.py migrate --noinput
 
+# Create the cache table when CACHE_BACKEND is DatabaseCache (no-op otherwise)
+python manage.py createcachetable
+
 # Collect static files
 python manage.py collectstatic --noinput
 
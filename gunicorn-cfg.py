@@ -5,6 +5,8 @@ Copyright (c) 2019 - present AppSeed.us
 
 bind = '0.0.0.0:5005'
 workers = 1
+# Served through core.asgi so long-polling and other async views do not hold a worker while they wait
+worker_class = 'uvicorn.workers.UvicornWorker'
 accesslog = '-'
 loglevel = 'debug'
 capture_output = True
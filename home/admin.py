@@ -1,9 +1,13 @@
 from django.contrib import admin
 from django import forms
-from .models import KioskClient, KioskConfiguration, KioskHealthCheck, Order, CardImage, KioskDevice, ReaderDevice
-from django.core.files.base import ContentFile
-import csv
-import io
+from .models import KioskClient, KioskConfiguration, KioskHealthCheck, Order, StripePayload, StripeWebhookEvent, CardImage, CardChange, CardImageRendition, KioskDevice, ReaderDevice
+from django.contrib import messages
+from django.http import JsonResponse
+from django.utils.html import format_html_join
+from django.shortcuts import redirect, render
+from django.urls import path, reverse
+from .services import CardImportService, StripeWebhookService
+import json
 
 class KioskConfigurationInline(admin.StackedInline):
     model = KioskConfiguration
@@ -16,11 +20,11 @@ class KioskConfigurationInline(admin.StackedInline):
             'classes': ['collapsee show']  # Black theme styling
         }),
         ('Display Settings', {
-            'fields': ('theme', 'custom_header'),
+            'fields': ('theme', 'custom_header', 'instagram_image_width'),
             'classes': ['collapsee show']
         }),
         ('Functionality', {
-            'fields': ('idle_timeout_seconds', 'allow_printer', 'maintenance_mode'),
+            'fields': ('idle_timeout_seconds', 'allow_printer', 'maintenance_mode', 'payment_status_batch_limit'),
             'classes': ['collapsee show']
         })
     )
@@ -101,11 +105,11 @@ class KioskConfigurationAdmin(admin.ModelAdmin):
             'classes': ['collapsee show']
         }),
         ('Display Settings', {
-            'fields': ('theme', 'custom_header'),
+            'fields': ('theme', 'custom_header', 'instagram_image_width'),
             'classes': ['collapsee show']
         }),
         ('Functionality', {
-            'fields': ('idle_timeout_seconds', 'allow_printer', 'maintenance_mode'),
+            'fields': ('idle_timeout_seconds', 'allow_printer', 'maintenance_mode', 'payment_status_batch_limit'),
             'classes': ['collapsee show']
         }),
         ('Timestamps', {
@@ -120,38 +124,120 @@ class OrderAdmin(admin.ModelAdmin):
     search_fields = ('transaction_id', 'kiosk_id')
     list_filter = ('status', 'created_at')
     ordering = ('-created_at', 'status')
+    readonly_fields = ('stripe_payloads',)
+
+    def stripe_payloads(self, obj):
+        """Archived Stripe objects, only loaded on the order's detail page"""
+        payment_intent_id = obj.stripe_payment_intent_id
+        if not payment_intent_id:
+            return '-'
+        payloads = StripePayload.objects.filter(payment_intent_id=payment_intent_id).order_by('id')
+        return format_html_join(
+            '', '<p><strong>{}</strong> ({})</p><pre>{}</pre>',
+            (
+                (payload.event_type, payload.created_at, json.dumps(payload.payload, indent=2))
+                for payload in payloads
+            ),
+        ) or '-'
+    stripe_payloads.short_description = 'Stripe payloads'
+
+class StripeWebhookEventStateFilter(admin.SimpleListFilter):
+    title = 'state'
+    parameter_name = 'state'
+
+    def lookups(self, request, model_admin):
+        return (('pending', 'Pending'), ('failed', 'Failed'), ('processed', 'Processed'))
+
+    def queryset(self, request, queryset):
+        if self.value() == 'failed':
+            return queryset & StripeWebhookService.failed()
+        if self.value() == 'pending':
+            return queryset.filter(processed_at__isnull=True, attempts__lt=StripeWebhookService.MAX_ATTEMPTS)
+        if self.value() == 'processed':
+            return queryset.filter(processed_at__isnull=False)
+        return queryset
+
+@admin.register(StripeWebhookEvent)
+class StripeWebhookEventAdmin(admin.ModelAdmin):
+    list_display = ('event_id', 'event_type', 'received_at', 'processed_at', 'attempts', 'last_error')
+    list_filter = (StripeWebhookEventStateFilter, 'event_type')
+    search_fields = ('event_id',)
+    readonly_fields = ('event_id', 'event_type', 'payload', 'received_at', 'processed_at', 'attempts', 'last_error')
+    actions = ['retry_events']
+
+    def has_add_permission(self, request):
+        return False
+
+    def retry_events(self, request, queryset):
+        count = StripeWebhookService.retry(queryset)
+        self.message_user(request, f"{count} events queued to be applied again", messages.SUCCESS)
+    retry_events.short_description = "Retry selected events"
+
+class CardImageRenditionInline(admin.TabularInline):
+    model = CardImageRendition
+    can_delete = False
+    extra = 0
+    fields = ('format', 'width', 'height', 'bytes', 'content_hash', 'file')
+    readonly_fields = fields
+
+    def has_add_permission(self, request, obj=None):
+        return False
 
 @admin.register(CardImage)
 class CardImageAdmin(admin.ModelAdmin):
     list_display = ('id', 'version', 'is_enabled', 'created_at', 'updated_at')
     list_filter = ('is_enabled',)
     readonly_fields = ('id', 'version', 'created_at', 'updated_at')
+    inlines = [CardImageRenditionInline]
     
     actions = ['bulk_upload_images']
 
+    def get_urls(self):
+        urls = [
+            path('bulk-upload/', self.admin_site.admin_view(self.bulk_upload_view), name='home_cardimage_bulk_upload'),
+            path('bulk-upload/<str:import_id>/', self.admin_site.admin_view(self.bulk_upload_progress), name='home_cardimage_bulk_upload_progress'),
+        ]
+        return urls + super().get_urls()
+
     def bulk_upload_images(self, request, queryset):
-        if 'apply' in request.POST:
-            csv_file = request.FILES.get('csv_file')
-            if csv_file:
-                decoded_file = csv_file.read().decode('utf-8')
-                csv_data = csv.DictReader(io.StringIO(decoded_file))
-                for row in csv_data:
-                    if 'image_path' in row:
-                        CardImage.objects.create(
-                            image=row['image_path'],
-                            is_enabled=row.get('is_enabled', 'True').lower() == 'true'
-                        )
-                self.message_user(request, "Successfully imported card images")
-                return
-            
-        return render(
-            request,
-            'admin/bulk_upload_form.html',
-            context={'cards': queryset}
-        )
-    
+        return redirect('admin:home_cardimage_bulk_upload')
     bulk_upload_images.short_description = "Bulk upload images"
 
+    def bulk_upload_view(self, request):
+        """Upload a CSV of media paths or a zip of images and follow the import's progress"""
+        if not self.has_add_permission(request):
+            return redirect('admin:home_cardimage_changelist')
+
+        import_id = request.GET.get('import_id')
+        if request.method == 'POST':
+            import_file = request.FILES.get('import_file')
+            if import_file and import_file.name.lower().endswith(('.csv', '.zip')):
+                import_id = CardImportService.start(import_file)
+                return redirect(f"{reverse('admin:home_cardimage_bulk_upload')}?import_id={import_id}")
+            messages.error(request, "Choose a .csv or .zip file to import")
+
+        return render(request, 'admin/bulk_upload_form.html', {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'import_id': import_id,
+        })
+
+    def bulk_upload_progress(self, request, import_id):
+        progress = CardImportService.get_progress(import_id)
+        if progress is None:
+            return JsonResponse({'error': 'Import not found'}, status=404)
+        return JsonResponse(progress)
+
+@admin.register(CardChange)
+class CardChangeAdmin(admin.ModelAdmin):
+    list_display = ('seq', 'card_id', 'action', 'version', 'created_at')
+    list_filter = ('action',)
+    search_fields = ('card_id',)
+    readonly_fields = ('seq', 'card_id', 'action', 'version', 'created_at')
+
+    def has_add_permission(self, request):
+        return False
+
 # Customize the admin site header and title
 admin.site.site_header = 'Kiosk Management System'
 admin.site.site_title = 'Kiosk Management'
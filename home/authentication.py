@@ -19,7 +19,8 @@ class KioskAuthentication(authentication.BaseAuthentication):
             username, password = decoded.split(':', 1)
             
             try:
-                kiosk = KioskClient.objects.get(login_name=username)
+                # The configuration comes along so views can read per-kiosk settings without another query
+                kiosk = KioskClient.objects.select_related('configuration').get(login_name=username)
             except KioskClient.DoesNotExist:
                 raise exceptions.AuthenticationFailed('Invalid kiosk credentials')
 
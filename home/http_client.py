@@ -0,0 +1,250 @@
+"""
+Shared outbound HTTP layer for Stripe, PayPal and other third-party calls.
+
+One requests.Session per process keeps a pool of keep-alive connections per
+host, so repeated calls skip the TCP and TLS handshakes. Every call gets
+explicit connect/read timeouts, idempotent requests are retried with
+jittered backoff, and each call's duration is logged and aggregated per host.
+
+Async views get the same from async_client(): a pooled httpx.AsyncClient per
+event loop, which Stripe's *_async methods also use, so a single process can
+keep many calls in flight without a thread each.
+"""
+import asyncio
+import logging
+import threading
+import time
+import weakref
+from typing import Dict
+from urllib.parse import urlsplit
+
+import httpx
+import paypalrestsdk
+import requests
+import stripe
+from django.conf import settings
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+
+class OutboundSession(requests.Session):
+    """
+    requests.Session with default timeouts and per-call timing.
+
+    :param connect_retries_only: Retry only connections that could not be
+        opened, for clients that retry failed responses themselves
+    """
+
+    def __init__(self, connect_retries_only: bool = False):
+        super().__init__()
+        if connect_retries_only:
+            retry = Retry(
+                total=settings.OUTBOUND_HTTP_RETRIES,
+                read=0,
+                status=0,
+                other=0,
+                backoff_factor=0.25,
+                backoff_jitter=0.25,
+                raise_on_status=False,
+            )
+        else:
+            retry = Retry(
+                total=settings.OUTBOUND_HTTP_RETRIES,
+                backoff_factor=0.25,
+                backoff_jitter=0.25,
+                status_forcelist=(429, 502, 503, 504),
+                # Connection failures are retried for every method, read failures only for idempotent ones
+                allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            )
+        adapter = HTTPAdapter(
+            pool_connections=settings.OUTBOUND_HTTP_POOL_HOSTS,
+            pool_maxsize=settings.OUTBOUND_HTTP_POOL_SIZE,
+            max_retries=retry,
+        )
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = (settings.OUTBOUND_HTTP_CONNECT_TIMEOUT, settings.OUTBOUND_HTTP_READ_TIMEOUT)
+
+        host = urlsplit(url).netloc
+        started = time.perf_counter()
+        status_code = None
+        try:
+            response = super().request(method, url, **kwargs)
+            status_code = response.status_code
+            return response
+        finally:
+            duration_ms = (time.perf_counter() - started) * 1000
+            outbound_stats.record(host, duration_ms, status_code)
+            logger.info(f"Outbound {method} {host}{urlsplit(url).path} {status_code or 'failed'} {duration_ms:.1f}ms")
+
+
+class TimedAsyncTransport(httpx.AsyncHTTPTransport):
+    """httpx transport that records each call like OutboundSession does"""
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        started = time.perf_counter()
+        status_code = None
+        try:
+            response = await super().handle_async_request(request)
+            status_code = response.status_code
+            return response
+        finally:
+            duration_ms = (time.perf_counter() - started) * 1000
+            outbound_stats.record(request.url.netloc.decode(), duration_ms, status_code)
+            logger.info(f"Outbound {request.method} {request.url.host}{request.url.path} {status_code or 'failed'} {duration_ms:.1f}ms")
+
+
+class AsyncStripeHttpClient(stripe.HTTPXClient):
+    """Stripe's httpx client, sending the *_async calls through async_client()"""
+
+    async def request_async(self, method, url, headers, post_data=None):
+        args, kwargs = self._get_request_args_kwargs(method, url, headers, post_data)
+        try:
+            response = await async_client().request(*args, **kwargs)
+        except Exception as e:
+            self._handle_request_error(e)
+        return response.content, response.status_code, response.headers
+
+
+class OutboundStats:
+    """Per-host call counts and timings of this process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def record(self, host: str, duration_ms: float, status_code):
+        with self._lock:
+            stats = self._hosts.setdefault(host, {
+                "calls": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0, "last_ms": 0.0,
+            })
+            stats["calls"] += 1
+            stats["errors"] += status_code is None or status_code >= 500
+            stats["total_ms"] += duration_ms
+            stats["max_ms"] = max(stats["max_ms"], duration_ms)
+            stats["last_ms"] = duration_ms
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                host: dict(stats, avg_ms=round(stats["total_ms"] / stats["calls"], 1))
+                for host, stats in self._hosts.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._hosts.clear()
+
+
+class PooledPayPalApi(paypalrestsdk.Api):
+    """
+    PayPal SDK client that sends its calls through the shared session.
+
+    The OAuth access token is shared by all workers through the cache and
+    replaced PAYPAL_TOKEN_REFRESH_MARGIN_SECONDS before it expires, so a
+    payment call normally costs one round trip rather than two.
+    """
+    TOKEN_CACHE_KEY = "paypal_access_token_{mode}_{client_id}"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._token_lock = threading.Lock()
+        self._token_served = None
+
+    def http_call(self, url, method, **kwargs):
+        response = session.request(method, url, proxies=self.proxies, **kwargs)
+        return self.handle_response(response, response.content.decode("utf-8"))
+
+    def get_token_hash(self, authorization_code=None, refresh_token=None, headers=None):
+        if authorization_code is not None or refresh_token is not None:
+            return super().get_token_hash(authorization_code, refresh_token, headers)
+
+        key = self.TOKEN_CACHE_KEY.format(mode=self.mode, client_id=self.client_id)
+        with self._token_lock:
+            if self.token_hash is None and self._token_served is not None:
+                # The SDK drops its token when PayPal rejects it; keep other workers from reusing it
+                if cache.get(key) == self._token_served:
+                    cache.delete(key)
+            token = self.token_hash if self._is_fresh(self.token_hash) else cache.get(key)
+
+            if not self._is_fresh(token):
+                self.token_hash = None
+                token = super().get_token_hash(headers=headers)
+                token = dict(token, expires_at=time.time() + int(token.get("expires_in", 0)))
+                cache.set(key, token, max(int(token.get("expires_in", 0)) - settings.PAYPAL_TOKEN_REFRESH_MARGIN_SECONDS, 1))
+
+            self.token_hash = self._token_served = token
+            return token
+
+    @staticmethod
+    def _is_fresh(token) -> bool:
+        return bool(token) and token.get("expires_at", 0) - settings.PAYPAL_TOKEN_REFRESH_MARGIN_SECONDS > time.time()
+
+
+outbound_stats = OutboundStats()
+session = OutboundSession()
+# Stripe retries failed responses itself (stripe.max_network_retries); retrying them here too would multiply attempts
+stripe_session = OutboundSession(connect_retries_only=True)
+_paypal_lock = threading.Lock()
+# httpx connections belong to the event loop that opened them, so each loop gets its own pool
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def async_client() -> httpx.AsyncClient:
+    """The pooled async client of the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            transport=TimedAsyncTransport(
+                limits=httpx.Limits(
+                    max_connections=settings.OUTBOUND_HTTP_ASYNC_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.OUTBOUND_HTTP_POOL_SIZE,
+                ),
+                # Connection failures only; Stripe retries failed requests itself
+                retries=settings.OUTBOUND_HTTP_RETRIES,
+            ),
+            timeout=httpx.Timeout(settings.OUTBOUND_HTTP_READ_TIMEOUT, connect=settings.OUTBOUND_HTTP_CONNECT_TIMEOUT),
+        )
+        _async_clients[loop] = client
+    return client
+
+
+def install():
+    """Route the Stripe library through its pooled session and the async pool and set up PayPal; called once at startup"""
+    stripe.default_http_client = stripe.http_client.RequestsClient(
+        session=stripe_session,
+        timeout=(settings.OUTBOUND_HTTP_CONNECT_TIMEOUT, settings.OUTBOUND_HTTP_READ_TIMEOUT),
+        async_fallback_client=AsyncStripeHttpClient(
+            timeout=httpx.Timeout(settings.OUTBOUND_HTTP_READ_TIMEOUT, connect=settings.OUTBOUND_HTTP_CONNECT_TIMEOUT),
+        ),
+    )
+    # Stripe retries failed POSTs itself, with idempotency keys and jittered backoff
+    stripe.max_network_retries = settings.OUTBOUND_HTTP_RETRIES
+    if settings.STRIPE_API_BASE:
+        stripe.api_base = settings.STRIPE_API_BASE
+    paypal_api()
+
+
+def paypal_api() -> PooledPayPalApi:
+    """The process-wide PayPal client, also installed as the SDK default for Payment and friends"""
+    with _paypal_lock:
+        api = paypalrestsdk.api.__api__
+        if not isinstance(api, PooledPayPalApi):
+            options = {"endpoint": settings.PAYPAL_API_BASE} if settings.PAYPAL_API_BASE else {}
+            api = PooledPayPalApi(
+                mode=settings.PAYPAL_MODE or "sandbox",
+                client_id=settings.PAYPAL_CLIENT_ID,
+                client_secret=settings.PAYPAL_CLIENT_SECRET,
+                **options,
+            )
+            paypalrestsdk.api.__api__ = api
+        return api
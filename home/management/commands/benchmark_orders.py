@@ -0,0 +1,134 @@
+import random
+import statistics
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from home.models import Order
+from home.services import StripeWebhookService
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark order lookups and webhook upserts on a large synthetic order table. "
+        "Runs against a throwaway test database, never the configured one, on the configured engine; "
+        "timings only speak for production when that engine is MySQL."
+    )
+
+    STATUSES = ["created", "processing", "paid", "paid", "paid", "failed"]
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=2_000_000, help="Orders to generate")
+        parser.add_argument('--kiosks', type=int, default=200, help="Distinct kiosk ids")
+        parser.add_argument('--samples', type=int, default=2000, help="Timed operations per measurement")
+        parser.add_argument('--batch-size', type=int, default=5000, help="Orders inserted per statement")
+        parser.add_argument('--keepdb', action='store_true', help="Reuse the benchmark database and its rows")
+        parser.add_argument('--compare', action='store_true',
+                            help="Also time the lookups after dropping the order indexes")
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        try:
+            self.populate(options)
+            self.stdout.write(f"{Order.objects.count()} orders ({connection.vendor})")
+            if connection.vendor != 'mysql':
+                self.stderr.write(
+                    f"Benchmarking on {connection.vendor}, not MySQL: index and upsert costs differ from production"
+                )
+            self.report(self.measure_lookups(options))
+            self.report(self.measure_upserts(options))
+            if options['compare']:
+                self.drop_indexes()
+                self.stdout.write("Without indexes:")
+                self.report(self.measure_lookups(options))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+
+    def populate(self, options):
+        existing = Order.objects.count()
+        random.seed(existing)
+        for start in range(existing, options['rows'], options['batch_size']):
+            end = min(start + options['batch_size'], options['rows'])
+            Order.objects.bulk_create([
+                Order(
+                    transaction_id=f"pi_bench_{index}",
+                    stripe_payment_intent_id=f"pi_bench_{index}",
+                    kiosk_id=f"kiosk-{random.randrange(options['kiosks'])}",
+                    price=random.choice([5, 10, 15, 20]),
+                    num_pictures=random.randint(1, 6),
+                    status=random.choice(self.STATUSES),
+                    stripe_event_created=1_700_000_000 + index,
+                )
+                for index in range(start, end)
+            ])
+            self.stdout.write(f"Inserted {end}/{options['rows']} orders", ending="\r")
+        self.stdout.write("")
+
+    def measure_lookups(self, options):
+        rows, kiosks = options['rows'], options['kiosks']
+        return {
+            "payment intent lookup": self.time(options['samples'], lambda: list(
+                Order.objects.filter(stripe_payment_intent_id=f"pi_bench_{random.randrange(rows)}").values("id", "status")
+            )),
+            "kiosk latest 20": self.time(options['samples'], lambda: list(
+                Order.objects.filter(kiosk_id=f"kiosk-{random.randrange(kiosks)}").order_by("-created_at").values("id")[:20]
+            )),
+            "status page of 100": self.time(options['samples'], lambda: list(
+                Order.objects.filter(status=random.choice(self.STATUSES)).order_by("-created_at").values("id")[:100]
+            )),
+        }
+
+    def measure_upserts(self, options):
+        rows = options['rows']
+
+        def event(event_type, status, payment_intent_id):
+            return {
+                "id": f"evt_{uuid.uuid4().hex}",
+                "type": event_type,
+                "created": 1_800_000_000,
+                "data": {"object": {
+                    "id": payment_intent_id,
+                    "amount": 1500,
+                    "status": status,
+                    "metadata": {"kiosk_id": "kiosk-bench", "num_pictures": "3"},
+                }},
+            }
+
+        return {
+            "upsert new order": self.time(options['samples'], lambda: StripeWebhookService.apply(
+                event("payment_intent.created", "requires_payment_method", f"pi_new_{uuid.uuid4().hex}")
+            )),
+            "upsert existing order": self.time(options['samples'], lambda: StripeWebhookService.apply(
+                event("payment_intent.processing", "processing", f"pi_bench_{random.randrange(rows)}")
+            )),
+        }
+
+    def drop_indexes(self):
+        with connection.schema_editor() as editor:
+            for index in Order._meta.indexes:
+                editor.remove_index(Order, index)
+            old_field = Order._meta.get_field("stripe_payment_intent_id")
+            new_field = old_field.clone()
+            new_field.set_attributes_from_name(old_field.name)
+            new_field.model = Order
+            new_field._unique = False
+            editor.alter_field(Order, old_field, new_field)
+
+    @staticmethod
+    def time(samples, operation):
+        durations = []
+        for _ in range(samples):
+            started = time.perf_counter()
+            operation()
+            durations.append((time.perf_counter() - started) * 1000)
+        return durations
+
+    def report(self, results):
+        for name, durations in results.items():
+            quantiles = statistics.quantiles(durations, n=100)
+            self.stdout.write(
+                f"{name:<24} p50 {quantiles[49]:7.3f} ms  p95 {quantiles[94]:7.3f} ms  p99 {quantiles[98]:7.3f} ms"
+            )
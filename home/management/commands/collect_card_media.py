@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from home.services import CardMediaService
+
+
+class Command(BaseCommand):
+    help = "Delete card images and renditions no longer referenced once their grace period has passed"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace-hours', type=int, default=settings.CARD_MEDIA_GC_GRACE_HOURS,
+                            help="Keep unreferenced files at least this long")
+        parser.add_argument('--dry-run', action='store_true', help="Only list the files that would be deleted")
+
+    def handle(self, *args, **options):
+        collected = CardMediaService.collect_garbage(options['grace_hours'] * 3600, options['dry_run'])
+        for path in collected:
+            self.stdout.write(path)
+        verb = "Would delete" if options['dry_run'] else "Deleted"
+        self.stdout.write(f"{verb} {len(collected)} unreferenced files")
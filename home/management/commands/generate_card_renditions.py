@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from home.models import CardImage
+from home.services import CardRenditionService
+
+
+class Command(BaseCommand):
+    help = "Generate missing or outdated renditions for card images"
+
+    def handle(self, *args, **options):
+        for card_id in CardImage.objects.exclude(image='').values_list('id', flat=True):
+            try:
+                renditions = CardRenditionService.generate(card_id)
+                self.stdout.write(f"{card_id}: {len(renditions)} renditions")
+            except Exception as e:
+                self.stderr.write(f"{card_id}: {str(e)}")
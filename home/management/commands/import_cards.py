@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from home.services import CardImportService
+
+
+class Command(BaseCommand):
+    help = "Import card images from a zip of images or a CSV with image_path and is_enabled columns"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Local path of the .zip or .csv file")
+
+    def handle(self, *args, **options):
+        def report(progress):
+            self.stdout.write(
+                f"{progress['status']}: {progress['processed']} processed, {progress['created']} created, "
+                f"{progress['skipped']} skipped, {progress['failed']} failed"
+            )
+
+        progress = CardImportService.run(options['path'], on_progress=report)
+        for error in progress['errors']:
+            self.stderr.write(error)
@@ -0,0 +1,137 @@
+import base64
+import math
+import os
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive a simulated kiosk fleet through complete Stripe Terminal purchases against a running app: "
+        "create PaymentIntent, process it on a reader, present a card, then poll the order status until the "
+        "webhook has marked it paid. Meant for an app pointed at run_payment_fakes, with the "
+        "process_stripe_events worker running."
+    )
+
+    STEPS = ("create_intent", "process", "present", "confirmed", "purchase")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', default='http://127.0.0.1:8000', help="App under test")
+        parser.add_argument('--kiosks', type=int, default=20, help="Concurrent simulated kiosks")
+        parser.add_argument('--purchases', type=int, default=10, help="Purchases per kiosk")
+        parser.add_argument('--client-secret', default=os.environ.get('CLIENT_SECRET_KEY'),
+                            help="CLIENT_SECRET_KEY header value, defaults to the environment's")
+        parser.add_argument('--kiosk-login', required=True, help="Kiosk login for the order status endpoint")
+        parser.add_argument('--kiosk-password', required=True)
+        parser.add_argument('--amount', type=int, default=1500, help="Purchase amount in cents")
+        parser.add_argument('--poll-interval', type=float, default=0.2, help="Seconds between status polls")
+        parser.add_argument('--timeout', type=float, default=30, help="Seconds to wait for a purchase to settle")
+
+    def handle(self, *args, **options):
+        if not options['client_secret']:
+            raise CommandError("--client-secret or CLIENT_SECRET_KEY is required")
+
+        self.options = options
+        self.durations = defaultdict(list)
+        self.outcomes = Counter()
+        self.lock = threading.Lock()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['kiosks']) as executor:
+            for kiosk in range(options['kiosks']):
+                executor.submit(self.run_kiosk, kiosk)
+        elapsed = time.perf_counter() - started
+
+        self.report(elapsed)
+
+    def run_kiosk(self, kiosk: int):
+        options = self.options
+        credentials = base64.b64encode(f"{options['kiosk_login']}:{options['kiosk_password']}".encode()).decode()
+        with requests.Session() as session:
+            session.headers["Client-Secret-Key"] = options['client_secret']
+            session.headers["Authorization"] = f"Basic {credentials}"
+            reader_id = f"tmr_load_{kiosk}"
+            for _ in range(options['purchases']):
+                try:
+                    outcome = self.purchase(session, f"load-kiosk-{kiosk}", reader_id)
+                except (requests.RequestException, KeyError, ValueError) as e:
+                    outcome = f"error: {type(e).__name__}"
+                with self.lock:
+                    self.outcomes[outcome] += 1
+
+    def purchase(self, session: requests.Session, kiosk_id: str, reader_id: str) -> str:
+        base_url = self.options['base_url'].rstrip('/')
+        purchase_started = time.perf_counter()
+
+        response = self.timed("create_intent", session.post, f"{base_url}/api/payment-intents/", json={
+            "amount": self.options['amount'], "currency": "chf",
+            "kiosk_id": kiosk_id, "num_pictures": 3,
+        }, headers={"Idempotency-Key": str(uuid.uuid4())})
+        if response.status_code != 201:
+            return f"create_intent {response.status_code}"
+        payment_intent_id = response.json()["id"]
+
+        response = self.timed("process", session.post, f"{base_url}/api/process-payment-intent/", json={
+            "reader_id": reader_id, "payment_intent": payment_intent_id,
+        })
+        if response.status_code != 200:
+            return f"process {response.status_code}"
+
+        present_started = time.perf_counter()
+        response = self.timed("present", session.post, f"{base_url}/api/present-payment-method/", json={
+            "reader_id": reader_id,
+        })
+        if response.status_code != 200:
+            return f"present {response.status_code}"
+
+        # Webhook-created orders use the PaymentIntent id as their transaction id
+        deadline = present_started + self.options['timeout']
+        while time.perf_counter() < deadline:
+            response = session.get(f"{base_url}/api/payment/status/{payment_intent_id}/")
+            if response.status_code == 200 and response.json()["status"] in ("paid", "failed"):
+                now = time.perf_counter()
+                self.record("confirmed", (now - present_started) * 1000)
+                self.record("purchase", (now - purchase_started) * 1000)
+                return response.json()["status"]
+            if response.status_code not in (200, 404):
+                return f"status {response.status_code}"
+            time.sleep(self.options['poll_interval'])
+        return "timeout"
+
+    def timed(self, step: str, call, *args, **kwargs):
+        started = time.perf_counter()
+        response = call(*args, timeout=self.options['timeout'], **kwargs)
+        self.record(step, (time.perf_counter() - started) * 1000)
+        return response
+
+    def record(self, step: str, duration_ms: float):
+        with self.lock:
+            self.durations[step].append(duration_ms)
+
+    def report(self, elapsed: float):
+        total = sum(self.outcomes.values())
+        self.stdout.write(
+            f"{total} purchases by {self.options['kiosks']} kiosks in {elapsed:.1f}s, "
+            f"{self.outcomes['paid'] / elapsed:.2f} paid purchases/s"
+        )
+        for outcome, count in self.outcomes.most_common():
+            self.stdout.write(f"  {outcome:<24} {count}")
+        for step in self.STEPS:
+            durations = sorted(self.durations[step])
+            if not durations:
+                continue
+            self.stdout.write(
+                f"{step:<14} n {len(durations):5d}  p50 {self.percentile(durations, 50):8.1f} ms  "
+                f"p99 {self.percentile(durations, 99):8.1f} ms  max {durations[-1]:8.1f} ms"
+            )
+
+    @staticmethod
+    def percentile(durations, percent: float) -> float:
+        """Nearest-rank percentile of sorted durations"""
+        return durations[max(0, math.ceil(percent / 100 * len(durations)) - 1)]
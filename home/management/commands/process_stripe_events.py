@@ -0,0 +1,44 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from home.services import StripeWebhookService
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Apply pending Stripe webhook events from the inbox to orders"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help="Events applied per transaction")
+        parser.add_argument('--loop', action='store_true', help="Keep polling the inbox instead of exiting once it is empty")
+        parser.add_argument('--interval', type=float, default=1.0, help="Seconds to wait between polls of an empty inbox")
+        parser.add_argument('--max-backoff', type=float, default=60.0, help="Longest wait after repeated database errors, in seconds")
+
+    def handle(self, *args, **options):
+        total = 0
+        backoff = 1.0
+        while True:
+            try:
+                applied = StripeWebhookService.drain(options['batch_size'])
+            except Exception as e:
+                if not options['loop']:
+                    raise
+                # A lost connection or deadlock must not stop the worker: drop the connection and try again later
+                logger.error(f"Draining Stripe events failed, retrying in {backoff:.0f}s: {str(e)}")
+                close_old_connections()
+                time.sleep(backoff)
+                backoff = min(backoff * 2, options['max_backoff'])
+                continue
+            backoff = 1.0
+            total += applied
+            if applied:
+                self.stdout.write(f"Applied {applied} events")
+            if applied < options['batch_size']:
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+        self.stdout.write(f"Inbox drained, {total} events applied")
@@ -0,0 +1,40 @@
+import time
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from home.services import StripeReconciliationService
+
+
+class Command(BaseCommand):
+    help = (
+        "Repair orders whose Stripe webhooks were missed, from the PaymentIntents created since the "
+        "last run. Meant to run periodically, e.g. hourly from cron or with --loop."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help="Start from this ISO date or Unix timestamp instead of the stored watermark")
+        parser.add_argument('--chunk-size', type=int, default=500, help="PaymentIntents diffed and written per batch")
+        parser.add_argument('--dry-run', action='store_true', help="Report corrections without writing them")
+        parser.add_argument('--loop', action='store_true', help="Keep reconciling instead of exiting after one pass")
+        parser.add_argument('--interval', type=float, default=3600.0, help="Seconds to wait between passes")
+
+    def handle(self, *args, **options):
+        since = options['since']
+        if since is not None:
+            try:
+                since = int(since) if since.isdigit() else int(datetime.fromisoformat(since).timestamp())
+            except ValueError:
+                raise CommandError("--since must be an ISO date or a Unix timestamp")
+
+        while True:
+            result = StripeReconciliationService.run(since, options['chunk_size'], options['dry_run'])
+            self.stdout.write(
+                f"{'Would repair' if options['dry_run'] else 'Repaired'} PaymentIntents since {result['since']}: "
+                f"{result['seen']} seen, {result['created']} orders created, {result['corrected']} corrected"
+            )
+            if not options['loop']:
+                break
+            # Later passes continue from the stored watermark
+            since = None
+            time.sleep(options['interval'])
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from home.services import InstagramService, InstagramRateLimiter
+
+
+class Command(BaseCommand):
+    help = "Refresh cached Instagram posts in the background without starving live kiosk requests"
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='+', help="Instagram usernames to refresh")
+        parser.add_argument('--limit', type=int, default=9, help="Number of posts per profile")
+        parser.add_argument('--width', type=int, default=None,
+                            help="Target image width in pixels (default: full resolution)")
+        parser.add_argument('--budget-timeout', type=float, default=60,
+                            help="Seconds to wait for the outbound budget per request")
+
+    def handle(self, *args, **options):
+        for username in options['usernames']:
+            service = InstagramService(
+                priority=InstagramRateLimiter.PRIORITY_BACKGROUND,
+                budget_timeout=options['budget_timeout'],
+            )
+            try:
+                posts = service.get_profile_posts(
+                    username, options['limit'], refresh=True, target_width=options['width'],
+                )
+                self.stdout.write(f"{username}: {len(posts)} posts cached")
+            finally:
+                service.cleanup()
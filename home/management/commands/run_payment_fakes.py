@@ -0,0 +1,49 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from home.payment_fakes import FakePaymentProviders
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a local stand-in for the Stripe and PayPal APIs. Start the app with "
+        "STRIPE_API_BASE and PAYPAL_API_BASE set to the printed URL."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=12111)
+        parser.add_argument('--latency-ms', type=float, default=0, help="Delay added to every API call")
+        parser.add_argument('--jitter-ms', type=float, default=0, help="Random extra delay of up to this much")
+        parser.add_argument('--failure-rate', type=float, default=0.0, help="Share of API calls answered with a 500")
+        parser.add_argument('--decline-rate', type=float, default=0.0, help="Share of card presentations declined")
+        parser.add_argument('--webhook-url', default='http://127.0.0.1:8000/api/webhook/stripe',
+                            help="Where signed Stripe events are delivered; empty disables webhooks")
+        parser.add_argument('--webhook-secret', default=settings.STRIPE_WEBHOOK_SECRET,
+                            help="Signing secret, defaults to STRIPE_WEBHOOK_SECRET")
+        parser.add_argument('--webhook-delay-ms', type=float, default=0, help="Delay before each webhook delivery")
+
+    def handle(self, *args, **options):
+        fakes = FakePaymentProviders(
+            host=options['host'],
+            port=options['port'],
+            latency_ms=options['latency_ms'],
+            jitter_ms=options['jitter_ms'],
+            failure_rate=options['failure_rate'],
+            decline_rate=options['decline_rate'],
+            webhook_url=options['webhook_url'] or None,
+            webhook_secret=options['webhook_secret'],
+            webhook_delay_ms=options['webhook_delay_ms'],
+        )
+        fakes.start()
+        self.stdout.write(f"Fake Stripe/PayPal API on {fakes.url}, webhooks to {options['webhook_url'] or 'nowhere'}")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            fakes.stop()
+            self.stdout.write(f"Stopped; {fakes.webhooks_sent} webhooks sent, {fakes.webhooks_failed} failed")
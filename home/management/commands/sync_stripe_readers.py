@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from home.services import StripeReaderService
+
+
+class Command(BaseCommand):
+    help = "Mirror the account's Stripe Terminal readers and locations into ReaderDevice"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help="Keep syncing instead of exiting after one pass")
+        parser.add_argument('--interval', type=float, default=300.0, help="Seconds to wait between syncs")
+
+    def handle(self, *args, **options):
+        while True:
+            result = StripeReaderService.sync()
+            self.stdout.write(f"Synced {result['readers']} readers, removed {result['removed']}")
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
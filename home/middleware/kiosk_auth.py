@@ -1,13 +1,12 @@
 import hmac, hashlib
 from django.http import JsonResponse
+from django.utils import timezone
+from django.utils.deprecation import MiddlewareMixin
 from home.models import KioskDevice
 
 
-class KioskAuthMiddleware:
-    def __init__(self, get_response):
-        self.get_response = get_response
-
-    def __call__(self, request):
+class KioskAuthMiddleware(MiddlewareMixin):
+    def process_request(self, request):
         kiosk_id = request.headers.get("X-Kiosk-ID")
         signature = request.headers.get("X-Kiosk-Signature")
 
@@ -30,5 +29,3 @@ class KioskAuthMiddleware:
             # Update heartbeat
             kiosk.last_seen_at = timezone.now()
             kiosk.save(update_fields=["last_seen_at"])
-
-        return self.get_response(request)
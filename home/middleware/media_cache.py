@@ -0,0 +1,20 @@
+import re
+from django.conf import settings
+from django.utils.deprecation import MiddlewareMixin
+
+# cards/<sha256>.<ext>, cards/renditions/<sha256>.<ext> and cards/sprites/<sha256>.<ext>
+CONTENT_ADDRESSED_MEDIA = re.compile(r'cards/(renditions/|sprites/)?[0-9a-f]{64}\.[a-z0-9]+$')
+
+
+class ImmutableMediaMiddleware(MiddlewareMixin):
+    """Far-future caching for content-addressed card media, whose URLs never change content"""
+
+    def process_response(self, request, response):
+        if (
+            response.status_code in (200, 206, 304)
+            and request.path.startswith(settings.MEDIA_URL)
+            and CONTENT_ADDRESSED_MEDIA.match(request.path[len(settings.MEDIA_URL):])
+        ):
+            response["Cache-Control"] = "public, max-age=31536000, immutable"
+
+        return response
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.9 on 2026-10-18 23:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0011_rename_paypal_payer_id_order_stripe_charge_id_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='kioskconfiguration',
+            name='instagram_image_width',
+            field=models.PositiveIntegerField(blank=True, help_text='Target width in pixels for Instagram post images (empty for full resolution)', null=True),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.9 on 2026-10-18 23:18
+
+from django.db import migrations, models
+
+
+def seed_card_changes(apps, schema_editor):
+    # Existing enabled cards start the feed, so a kiosk can bootstrap from cursor 0
+    CardImage = apps.get_model('home', 'CardImage')
+    CardChange = apps.get_model('home', 'CardChange')
+    CardChange.objects.bulk_create([
+        CardChange(card_id=card.id, action='upsert', version=card.version)
+        for card in CardImage.objects.filter(is_enabled=True).order_by('created_at')
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0012_kioskconfiguration_instagram_image_width'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CardChange',
+            fields=[
+                ('seq', models.BigAutoField(primary_key=True, serialize=False)),
+                ('card_id', models.UUIDField(db_index=True)),
+                ('action', models.CharField(choices=[('upsert', 'Created or updated'), ('disable', 'Disabled'), ('delete', 'Deleted')], max_length=10)),
+                ('version', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Card Change',
+                'verbose_name_plural': 'Card Changes',
+                'ordering': ['seq'],
+            },
+        ),
+        migrations.RunPython(seed_card_changes, migrations.RunPython.noop),
+    ]
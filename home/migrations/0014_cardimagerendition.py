@@ -0,0 +1,36 @@
+# Generated by Django 4.2.9 on 2026-10-18 23:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+import home.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0013_cardchange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CardImageRendition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.FileField(max_length=255, upload_to=home.models.card_rendition_upload_path)),
+                ('format', models.CharField(choices=[('webp', 'WebP'), ('jpeg', 'JPEG')], max_length=10)),
+                ('width', models.PositiveIntegerField()),
+                ('height', models.PositiveIntegerField()),
+                ('bytes', models.PositiveIntegerField()),
+                ('content_hash', models.CharField(help_text='SHA-256 of the rendition file', max_length=64)),
+                ('source_hash', models.CharField(help_text='SHA-256 of the original it was generated from', max_length=64)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('card', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='renditions', to='home.cardimage')),
+            ],
+            options={
+                'verbose_name': 'Card Image Rendition',
+                'verbose_name_plural': 'Card Image Renditions',
+                'ordering': ['width', 'format'],
+                'unique_together': {('card', 'width', 'format')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.9 on 2026-10-18 23:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0014_cardimagerendition'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cardimage',
+            name='image_hash',
+            field=models.CharField(blank=True, editable=False, help_text='SHA-256 of the image file', max_length=64),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.9 on 2026-10-18 23:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0015_cardimage_image_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripeWebhookEvent',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('event_id', models.CharField(db_index=True, max_length=255)),
+                ('event_type', models.CharField(max_length=100)),
+                ('payload', models.TextField(help_text='Raw event body as delivered by Stripe')),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, default='')),
+            ],
+            options={
+                'verbose_name': 'Stripe Webhook Event',
+                'verbose_name_plural': 'Stripe Webhook Events',
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['processed_at', 'id'], name='stripe_event_pending_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.9 on 2026-10-18 23:36
+
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def drop_duplicate_events(apps, schema_editor):
+    # Keep the first delivery of each event id before the column becomes unique
+    StripeWebhookEvent = apps.get_model('home', 'StripeWebhookEvent')
+    first_ids = StripeWebhookEvent.objects.values('event_id').annotate(first_id=Min('id')).values('first_id')
+    StripeWebhookEvent.objects.exclude(id__in=list(first_ids)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0016_stripewebhookevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='stripe_event_created',
+            field=models.BigIntegerField(blank=True, help_text='Creation time of the last Stripe event applied', null=True),
+        ),
+        migrations.RunPython(drop_duplicate_events, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='stripewebhookevent',
+            name='event_id',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.2.9 on 2026-10-18 23:37
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def dedupe_payment_intent_ids(apps, schema_editor):
+    # Empty ids become NULL, which the unique index allows any number of times.
+    # Orders duplicated by the old get_or_create race keep the id only on the oldest row.
+    Order = apps.get_model('home', 'Order')
+    Order.objects.filter(stripe_payment_intent_id='').update(stripe_payment_intent_id=None)
+    duplicated = (
+        Order.objects.exclude(stripe_payment_intent_id=None)
+        .values('stripe_payment_intent_id')
+        .annotate(orders=Count('id'))
+        .filter(orders__gt=1)
+        .values_list('stripe_payment_intent_id', flat=True)
+    )
+    for payment_intent_id in list(duplicated):
+        orders = Order.objects.filter(stripe_payment_intent_id=payment_intent_id).order_by('created_at')
+        Order.objects.filter(pk__in=[order.pk for order in orders[1:]]).update(stripe_payment_intent_id=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0017_stripe_event_ledger'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_payment_intent_ids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='order',
+            name='stripe_payment_intent_id',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['-created_at'], name='order_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['status', '-created_at'], name='order_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['kiosk_id', '-created_at'], name='order_kiosk_created_idx'),
+        ),
+    ]
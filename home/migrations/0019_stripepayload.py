@@ -0,0 +1,58 @@
+# Generated by Django 4.2.9 on 2026-10-18 23:40
+
+import json
+import zlib
+
+from django.db import migrations, models
+
+
+def archive_stripe_responses(apps, schema_editor):
+    # The payload stored on each order is the last one received; archive it before dropping the column
+    Order = apps.get_model('home', 'Order')
+    StripePayload = apps.get_model('home', 'StripePayload')
+    orders = Order.objects.exclude(stripe_response=None).values_list(
+        'id', 'transaction_id', 'stripe_payment_intent_id', 'stripe_response'
+    )
+    batch = []
+    for order_id, transaction_id, payment_intent_id, response in orders.iterator(chunk_size=1000):
+        batch.append(StripePayload(
+            payment_intent_id=payment_intent_id or transaction_id,
+            event_id=f'legacy-{order_id}',
+            event_type='legacy',
+            data=zlib.compress(json.dumps(response, separators=(',', ':')).encode('utf-8')),
+        ))
+        if len(batch) >= 1000:
+            StripePayload.objects.bulk_create(batch)
+            batch = []
+    StripePayload.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0018_order_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripePayload',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('payment_intent_id', models.CharField(db_index=True, max_length=100)),
+                ('event_id', models.CharField(max_length=255, unique=True)),
+                ('event_type', models.CharField(max_length=100)),
+                ('data', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Stripe Payload',
+                'verbose_name_plural': 'Stripe Payloads',
+                'ordering': ['id'],
+            },
+        ),
+        migrations.RunPython(archive_stripe_responses, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='order',
+            name='stripe_response',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.9 on 2026-10-18 23:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0019_stripepayload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='currency',
+            field=models.CharField(blank=True, default='', max_length=3),
+        ),
+    ]
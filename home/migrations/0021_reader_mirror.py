@@ -0,0 +1,58 @@
+# Generated by Django 4.2.9 on 2026-10-18 23:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0020_order_currency'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='readerdevice',
+            name='device_type',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='readerdevice',
+            name='status',
+            field=models.CharField(blank=True, default='', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='readerdevice',
+            name='stripe_object',
+            field=models.JSONField(blank=True, help_text='Reader as last seen from Stripe', null=True),
+        ),
+        migrations.AddField(
+            model_name='readerdevice',
+            name='synced_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='readerdevice',
+            name='address',
+            field=models.CharField(max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='readerdevice',
+            name='city',
+            field=models.CharField(max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='readerdevice',
+            name='name',
+            field=models.CharField(max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='readerdevice',
+            name='postalCode',
+            field=models.CharField(max_length=16),
+        ),
+        migrations.AlterField(
+            model_name='readerdevice',
+            name='state',
+            field=models.CharField(max_length=100),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.9 on 2026-10-19 00:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0021_reader_mirror'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('value', models.BigIntegerField(help_text='Unix timestamp the next run starts from')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.9 on 2026-10-19 00:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0022_sync_watermark'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cardchange',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,48 @@
+import hashlib
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import migrations
+from django.utils import timezone
+
+
+def backfill_image_hash(apps, schema_editor):
+    """
+    Move cards stored before content addressing to cards/<sha256>.<ext>.
+
+    Each moved card gets a new version and a change feed entry, so kiosks
+    pick up the new URL. The old files are left for collect_card_media.
+    """
+    CardImage = apps.get_model('home', 'CardImage')
+    CardChange = apps.get_model('home', 'CardChange')
+
+    for card in CardImage.objects.filter(image_hash='').exclude(image='').iterator():
+        try:
+            with default_storage.open(card.image.name, 'rb') as image_file:
+                content = image_file.read()
+        except OSError:
+            continue
+
+        image_hash = hashlib.sha256(content).hexdigest()
+        path = f"cards/{image_hash}.{card.image.name.rsplit('.', 1)[-1].lower()}"
+        if not default_storage.exists(path):
+            path = default_storage.save(path, ContentFile(content))
+
+        version = card.version + 1
+        CardImage.objects.filter(pk=card.pk).update(
+            image=path, image_hash=image_hash, version=version, updated_at=timezone.now(),
+        )
+        CardChange.objects.create(
+            card_id=card.pk, action='upsert' if card.is_enabled else 'disable', version=version,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0023_cardchange_created_at_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_image_hash, migrations.RunPython.noop),
+    ]
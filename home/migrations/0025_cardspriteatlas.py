@@ -0,0 +1,26 @@
+# Generated by Django 4.2.9 on 2026-10-19 00:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0024_backfill_card_image_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CardSpriteAtlas',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('etag', models.CharField(max_length=32, unique=True)),
+                ('atlas', models.JSONField(help_text='Pages, tile size and per-card coordinates')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'verbose_name': 'Card Sprite Atlas',
+                'verbose_name_plural': 'Card Sprite Atlases',
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.9 on 2026-10-19 00:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0025_cardspriteatlas'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CardImportJob',
+            fields=[
+                ('id', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('progress', models.JSONField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Card Import Job',
+                'verbose_name_plural': 'Card Import Jobs',
+            },
+        ),
+    ]
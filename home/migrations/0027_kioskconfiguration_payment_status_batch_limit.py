@@ -0,0 +1,18 @@
+# Generated by Django 4.2.9 on 2026-10-19 00:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0026_cardimportjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='kioskconfiguration',
+            name='payment_status_batch_limit',
+            field=models.PositiveIntegerField(blank=True, help_text='Most order ids per batch payment status request (empty for the server default)', null=True),
+        ),
+    ]
@@ -1,9 +1,11 @@
 from django.db import models
 from django.contrib.auth.hashers import make_password, check_password
 import uuid
+import hashlib
+import json
+import zlib
 from django.core.exceptions import ValidationError
 from django.utils import timezone
-import os
 
 import stripe
 
@@ -61,6 +63,16 @@ class KioskConfiguration(models.Model):
         default=False,
         help_text="Put kiosk in maintenance mode"
     )
+    instagram_image_width = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="Target width in pixels for Instagram post images (empty for full resolution)"
+    )
+    payment_status_batch_limit = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="Most order ids per batch payment status request (empty for the server default)"
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -92,17 +104,93 @@ class Order(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
 
     # Stripe fields
-    stripe_payment_intent_id = models.CharField(max_length=100, blank=True, null=True)
+    stripe_payment_intent_id = models.CharField(max_length=100, blank=True, null=True, unique=True)
     stripe_charge_id = models.CharField(max_length=100, blank=True, null=True)
     stripe_payment_status = models.CharField(max_length=50, blank=True, null=True)
-    stripe_response = models.JSONField(blank=True, null=True)  # Store full Stripe payload if needed
+    currency = models.CharField(max_length=3, blank=True, default='')
+    stripe_event_created = models.BigIntegerField(blank=True, null=True, help_text="Creation time of the last Stripe event applied")
 
     def __str__(self):
         return f"Order {self.transaction_id} - {self.status}"
 
+    class Meta:
+        indexes = [
+            # Admin changelist ordering and its status/date filters
+            models.Index(fields=["-created_at"], name="order_created_idx"),
+            models.Index(fields=["status", "-created_at"], name="order_status_created_idx"),
+            # Per-kiosk order history
+            models.Index(fields=["kiosk_id", "-created_at"], name="order_kiosk_created_idx"),
+        ]
+
+
+class StripePayload(models.Model):
+    """
+    Append-only archive of the full Stripe objects received for an order, zlib-compressed.
+    Kept out of Order so order rows stay small; only read when an order is opened in the admin.
+    """
+    id = models.BigAutoField(primary_key=True)
+    payment_intent_id = models.CharField(max_length=100, db_index=True)
+    event_id = models.CharField(max_length=255, unique=True)
+    event_type = models.CharField(max_length=100)
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @staticmethod
+    def compress(payload) -> bytes:
+        return zlib.compress(json.dumps(payload, separators=(",", ":")).encode("utf-8"))
+
+    @property
+    def payload(self):
+        return json.loads(zlib.decompress(bytes(self.data)))
+
+    def __str__(self):
+        return f"Stripe payload {self.event_id} for {self.payment_intent_id}"
+
+    class Meta:
+        ordering = ["id"]
+        verbose_name = "Stripe Payload"
+        verbose_name_plural = "Stripe Payloads"
+
+
+class StripeWebhookEvent(models.Model):
+    """
+    Inbox of verified Stripe webhook events, applied to orders by the process_stripe_events
+    command. Unique on the event id, so it is also the ledger of events already received.
+    """
+    id = models.BigAutoField(primary_key=True)
+    event_id = models.CharField(max_length=255, unique=True)
+    event_type = models.CharField(max_length=100)
+    payload = models.TextField(help_text="Raw event body as delivered by Stripe")
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+
+    def __str__(self):
+        return f"Stripe event {self.event_id} ({self.event_type})"
+
+    class Meta:
+        ordering = ["id"]
+        indexes = [models.Index(fields=["processed_at", "id"], name="stripe_event_pending_idx")]
+        verbose_name = "Stripe Webhook Event"
+        verbose_name_plural = "Stripe Webhook Events"
+
+
+class SyncWatermark(models.Model):
+    """How far a periodic sync job has got, so its next run only covers the new window"""
+    name = models.CharField(max_length=100, unique=True)
+    value = models.BigIntegerField(help_text="Unix timestamp the next run starts from")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} @ {self.value}"
+
 
 def card_image_upload_path(instance, filename):
-    ext = filename.split('.')[-1]
+    ext = filename.split('.')[-1].lower()
+    # Content-addressed, so a replaced image always gets a new, immutable URL
+    if instance.image_hash:
+        return f'cards/{instance.image_hash}.{ext}'
     return f'cards/{instance.id}.{ext}'
 
 class KioskDevice(models.Model):
@@ -127,17 +215,27 @@ class KioskDevice(models.Model):
 
 
 class ReaderDevice(models.Model):
+    """
+    A Stripe Terminal reader. Rows double as the local mirror of the account's readers,
+    kept current by terminal webhooks and the sync_stripe_readers command.
+    """
     reader_id = models.CharField(max_length=64, unique=True)
-    name = models.CharField(max_length=100, unique=True)
+    name = models.CharField(max_length=100)
     country = models.CharField(max_length=16)
-    city = models.CharField(max_length=16)
-    state = models.CharField(max_length=16)
-    address = models.CharField(max_length=16)
-    postalCode = models.CharField(max_length=10)
+    city = models.CharField(max_length=100)
+    state = models.CharField(max_length=100)
+    address = models.CharField(max_length=255)
+    postalCode = models.CharField(max_length=16)
     kiosk = models.ForeignKey("home.KioskDevice", related_name="readers", on_delete=models.SET_NULL, null=True, blank=True)
     stripe_location_id = models.CharField(max_length=64, blank=True, null=True)  # ✅ Added
     registered_at = models.DateTimeField(default=timezone.now)
 
+    # Mirror of the Stripe reader object
+    device_type = models.CharField(max_length=64, blank=True, default='')
+    status = models.CharField(max_length=16, blank=True, default='')
+    stripe_object = models.JSONField(blank=True, null=True, help_text="Reader as last seen from Stripe")
+    synced_at = models.DateTimeField(blank=True, null=True)
+
     def clean(self):
         required_fields = ["country", "city", "state", "address", "postalCode", "reader_id", "name"]
         for field in required_fields:
@@ -172,6 +270,10 @@ class ReaderDevice(models.Model):
 
                 # Store Stripe reader ID (optional)
                 self.reader_id = reader.id
+                self.device_type = reader.device_type or ''
+                self.status = reader.status or ''
+                self.stripe_object = reader.to_dict_recursive()
+                self.synced_at = timezone.now()
             except Exception as e:
                 raise ValidationError(f"Stripe registration failed: {str(e)}")
 
@@ -183,18 +285,25 @@ class ReaderDevice(models.Model):
 class CardImage(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     image = models.ImageField(upload_to=card_image_upload_path)
+    image_hash = models.CharField(max_length=64, blank=True, editable=False, help_text="SHA-256 of the image file")
     version = models.PositiveIntegerField(default=1, editable=False)
     is_enabled = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     def save(self, *args, **kwargs):
-        if not self.pk:
-            super().save(*args, **kwargs)
-
-        if self.image and not self.image.name.startswith(f'cards/{self.id}'):
-            ext = os.path.splitext(self.image.name)[1]
-            self.image.name = f'cards/{self.id}{ext}'
+        if self.image and not self.image._committed:
+            hasher = hashlib.sha256()
+            for chunk in self.image.file.chunks():
+                hasher.update(chunk)
+            self.image.file.seek(0)
+            self.image_hash = hasher.hexdigest()
+
+            # Identical content is already stored under its hash; reference it instead of uploading again
+            path = card_image_upload_path(self, self.image.name)
+            if self.image.storage.exists(path):
+                self.image.name = path
+                self.image._committed = True
 
         self.version += 1 if self.pk else 0
         super().save(*args, **kwargs)
@@ -205,3 +314,84 @@ class CardImage(models.Model):
     class Meta:
         verbose_name = "Card Image"
         verbose_name_plural = "Card Images"
+
+
+def card_rendition_upload_path(instance, filename):
+    ext = filename.split('.')[-1]
+    return f'cards/renditions/{instance.content_hash}.{ext}'
+
+class CardImageRendition(models.Model):
+    FORMAT_CHOICES = [
+        ("webp", "WebP"),
+        ("jpeg", "JPEG"),
+    ]
+
+    card = models.ForeignKey(CardImage, related_name="renditions", on_delete=models.CASCADE)
+    file = models.FileField(upload_to=card_rendition_upload_path, max_length=255)
+    format = models.CharField(max_length=10, choices=FORMAT_CHOICES)
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    bytes = models.PositiveIntegerField()
+    content_hash = models.CharField(max_length=64, help_text="SHA-256 of the rendition file")
+    source_hash = models.CharField(max_length=64, help_text="SHA-256 of the original it was generated from")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Rendition {self.width}px {self.format} of card {self.card_id}"
+
+    class Meta:
+        ordering = ["width", "format"]
+        unique_together = [("card", "width", "format")]
+        verbose_name = "Card Image Rendition"
+        verbose_name_plural = "Card Image Renditions"
+
+
+class CardSpriteAtlas(models.Model):
+    """Sprite atlas built for a catalog version, kept so its media outlives the cache"""
+    etag = models.CharField(max_length=32, unique=True)
+    atlas = models.JSONField(help_text="Pages, tile size and per-card coordinates")
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"Sprite atlas {self.etag}"
+
+    class Meta:
+        verbose_name = "Card Sprite Atlas"
+        verbose_name_plural = "Card Sprite Atlases"
+
+
+class CardImportJob(models.Model):
+    """Progress of a bulk card import, readable from any worker"""
+    id = models.CharField(primary_key=True, max_length=32)
+    progress = models.JSONField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Card import {self.id}"
+
+    class Meta:
+        verbose_name = "Card Import Job"
+        verbose_name_plural = "Card Import Jobs"
+
+
+class CardChange(models.Model):
+    """Append-only change log of the card catalog, read by kiosks as a delta feed"""
+    ACTION_CHOICES = [
+        ("upsert", "Created or updated"),
+        ("disable", "Disabled"),
+        ("delete", "Deleted"),
+    ]
+
+    seq = models.BigAutoField(primary_key=True)
+    card_id = models.UUIDField(db_index=True)
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES)
+    version = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"Change {self.seq}: {self.action} card {self.card_id}"
+
+    class Meta:
+        ordering = ["seq"]
+        verbose_name = "Card Change"
+        verbose_name_plural = "Card Changes"
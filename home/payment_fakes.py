@@ -0,0 +1,425 @@
+"""
+Offline stand-ins for the Stripe and PayPal APIs the kiosk payment flow uses.
+
+FakePaymentProviders is a small threaded HTTP server speaking the subset of
+the Stripe PaymentIntent/Terminal and PayPal REST APIs called by this app,
+with in-memory state. It adds configurable latency, injects failures and card
+declines, and delivers signed Stripe webhooks back to the app, so the whole
+purchase flow can be exercised and load-tested without network access.
+Point the app at it with STRIPE_API_BASE and PAYPAL_API_BASE; see the
+run_payment_fakes and load_test_payments commands.
+"""
+import hashlib
+import hmac
+import json
+import logging
+import queue
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import parse_qsl, urlsplit
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+def _id(prefix: str) -> str:
+    return f"{prefix}_{uuid.uuid4().hex[:24]}"
+
+
+def _unflatten(pairs) -> Dict:
+    """Turn Stripe's form encoding (metadata[kiosk_id]=1&types[0]=card) back into nested dicts and lists"""
+    result = {}
+    for key, value in pairs:
+        parts = re.findall(r"[^\[\]]+", key)
+        target = result
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return _lists(result)
+
+
+def _lists(value):
+    if isinstance(value, dict):
+        if value and all(key.isdigit() for key in value):
+            return [_lists(value[key]) for key in sorted(value, key=int)]
+        return {key: _lists(item) for key, item in value.items()}
+    return value
+
+
+class FakeApiError(Exception):
+    def __init__(self, status: int, message: str, error_type: str = "invalid_request_error", code: str = None):
+        super().__init__(message)
+        self.status = status
+        self.body = {"error": {"type": error_type, "message": message, "code": code}}
+
+
+class FakeProviderState:
+    """In-memory Stripe and PayPal objects, plus the outgoing webhook queue"""
+
+    def __init__(self, decline_rate: float = 0.0):
+        self.decline_rate = decline_rate
+        self.lock = threading.Lock()
+        self.payment_intents = {}
+        self.readers = {}
+        self.locations = {}
+        self.paypal_payments = {}
+        self.idempotent_results = {}
+        self.events = queue.Queue()
+
+    def idempotent(self, key: Optional[str], call) -> Dict:
+        """Like Stripe, answer a POST retried with the same Idempotency-Key with the first result"""
+        if key and key in self.idempotent_results:
+            return self.idempotent_results[key]
+        result = call()
+        if key:
+            with self.lock:
+                result = self.idempotent_results.setdefault(key, result)
+        return result
+
+    # Stripe
+
+    def create_payment_intent(self, params: Dict) -> Dict:
+        intent = {
+            "id": _id("pi"),
+            "object": "payment_intent",
+            "amount": int(params.get("amount", 0)),
+            "currency": params.get("currency", "chf"),
+            "capture_method": params.get("capture_method", "automatic"),
+            "payment_method_types": params.get("payment_method_types", ["card_present"]),
+            "metadata": params.get("metadata", {}),
+            "status": "requires_payment_method",
+            "created": int(time.time()),
+            "latest_charge": None,
+            "charges": {"object": "list", "data": [], "has_more": False},
+            "livemode": False,
+        }
+        with self.lock:
+            self.payment_intents[intent["id"]] = intent
+        self.emit("payment_intent.created", intent)
+        return intent
+
+    def payment_intent(self, payment_intent_id: str) -> Dict:
+        intent = self.payment_intents.get(payment_intent_id)
+        if intent is None:
+            raise FakeApiError(404, f"No such payment_intent: '{payment_intent_id}'", code="resource_missing")
+        return intent
+
+    def cancel_payment_intent(self, payment_intent_id: str) -> Dict:
+        with self.lock:
+            intent = self.payment_intent(payment_intent_id)
+            if intent["status"] == "succeeded":
+                raise FakeApiError(400, "This PaymentIntent has already succeeded", code="payment_intent_unexpected_state")
+            intent["status"] = "canceled"
+        self.emit("payment_intent.canceled", intent)
+        return intent
+
+    def create_location(self, params: Dict) -> Dict:
+        location = {
+            "id": _id("tml"),
+            "object": "terminal.location",
+            "display_name": params.get("display_name", ""),
+            "address": params.get("address", {}),
+            "metadata": {},
+            "livemode": False,
+        }
+        with self.lock:
+            self.locations[location["id"]] = location
+        return location
+
+    def create_reader(self, params: Dict) -> Dict:
+        reader = self._new_reader(_id("tmr"), params.get("label"), params.get("location"))
+        with self.lock:
+            self.readers[reader["id"]] = reader
+        return reader
+
+    def reader(self, reader_id: str) -> Dict:
+        """Readers are simulated: any reader id is known from its first use"""
+        with self.lock:
+            if reader_id not in self.readers:
+                self.readers[reader_id] = self._new_reader(reader_id, reader_id, None)
+            return self.readers[reader_id]
+
+    @staticmethod
+    def _new_reader(reader_id: str, label: Optional[str], location: Optional[str]) -> Dict:
+        return {
+            "id": reader_id,
+            "object": "terminal.reader",
+            "label": label or reader_id,
+            "location": location,
+            "device_type": "simulated_wisepos_e",
+            "status": "online",
+            "action": None,
+            "serial_number": uuid.uuid4().hex[:12],
+            "metadata": {},
+            "livemode": False,
+        }
+
+    def process_payment_intent(self, reader_id: str, params: Dict) -> Dict:
+        reader = self.reader(reader_id)
+        with self.lock:
+            intent = self.payment_intent(params.get("payment_intent"))
+            if intent["status"] != "requires_payment_method":
+                raise FakeApiError(400, "This PaymentIntent cannot be processed", code="payment_intent_unexpected_state")
+            if reader["action"] and reader["action"]["status"] == "in_progress":
+                raise FakeApiError(409, "Reader is busy", code="terminal_reader_busy")
+            reader["action"] = {
+                "type": "process_payment_intent",
+                "status": "in_progress",
+                "failure_code": None,
+                "failure_message": None,
+                "process_payment_intent": {"payment_intent": intent["id"]},
+            }
+        return reader
+
+    def cancel_action(self, reader_id: str) -> Dict:
+        reader = self.reader(reader_id)
+        with self.lock:
+            reader["action"] = None
+        return reader
+
+    def present_payment_method(self, reader_id: str) -> Dict:
+        """Simulate a card tap on the reader: the pending PaymentIntent succeeds or is declined"""
+        reader = self.reader(reader_id)
+        with self.lock:
+            action = reader["action"]
+            if not action or action["status"] != "in_progress":
+                raise FakeApiError(400, "Reader has no action in progress", code="terminal_reader_timeout")
+            intent = self.payment_intent(action["process_payment_intent"]["payment_intent"])
+            declined = random.random() < self.decline_rate
+            if declined:
+                intent["status"] = "requires_payment_method"
+                intent["last_payment_error"] = {"code": "card_declined", "message": "Your card was declined."}
+                action.update(status="failed", failure_code="card_declined", failure_message="Your card was declined.")
+            else:
+                charge = {"id": _id("ch"), "object": "charge", "amount": intent["amount"], "status": "succeeded"}
+                intent.update(status="succeeded", latest_charge=charge["id"])
+                intent["charges"]["data"] = [charge]
+                action["status"] = "succeeded"
+        if declined:
+            self.emit("payment_intent.payment_failed", intent)
+            self.emit("terminal.reader.action_failed", reader)
+        else:
+            self.emit("payment_intent.succeeded", intent)
+            self.emit("terminal.reader.action_succeeded", reader)
+        return reader
+
+    def list_objects(self, objects: Dict, url: str, params: Dict) -> Dict:
+        """Stripe list with created[gte], starting_after and limit"""
+        with self.lock:
+            items = sorted(objects.values(), key=lambda item: (item.get("created", 0), item["id"]), reverse=True)
+        created = params.get("created")
+        if isinstance(created, dict) and "gte" in created:
+            items = [item for item in items if item.get("created", 0) >= int(created["gte"])]
+        if params.get("starting_after"):
+            ids = [item["id"] for item in items]
+            if params["starting_after"] in ids:
+                items = items[ids.index(params["starting_after"]) + 1:]
+        limit = min(int(params.get("limit", 10)), 100)
+        return {"object": "list", "url": url, "data": items[:limit], "has_more": len(items) > limit}
+
+    def emit(self, event_type: str, obj: Dict):
+        self.events.put({
+            "id": _id("evt"),
+            "object": "event",
+            "type": event_type,
+            "created": int(time.time()),
+            "livemode": False,
+            "data": {"object": json.loads(json.dumps(obj))},
+        })
+
+    # PayPal
+
+    def create_paypal_payment(self, body: Dict) -> Dict:
+        payment_id = f"PAYID-{uuid.uuid4().hex[:20].upper()}"
+        payment = dict(
+            body,
+            id=payment_id,
+            state="created",
+            create_time=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            links=[
+                {"href": f"https://www.sandbox.paypal.com/checkoutnow?token=EC-{payment_id}", "rel": "approval_url", "method": "REDIRECT"},
+                {"href": f"/v1/payments/payment/{payment_id}/execute", "rel": "execute", "method": "POST"},
+            ],
+        )
+        with self.lock:
+            self.paypal_payments[payment_id] = payment
+        return payment
+
+    def paypal_payment(self, payment_id: str) -> Dict:
+        payment = self.paypal_payments.get(payment_id)
+        if payment is None:
+            raise FakeApiError(404, "The requested resource ID was not found", error_type="INVALID_RESOURCE_ID")
+        return payment
+
+    def execute_paypal_payment(self, payment_id: str, body: Dict) -> Dict:
+        with self.lock:
+            payment = self.paypal_payment(payment_id)
+            payment["state"] = "approved"
+            payment["payer"] = dict(payment.get("payer", {}), payer_info={"payer_id": body.get("payer_id")})
+        return payment
+
+
+class FakeProviderHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "FakeProviderServer"
+
+    ROUTES = [
+        ("POST", r"/v1/payment_intents", lambda s, p, m: s.create_payment_intent(p)),
+        ("GET", r"/v1/payment_intents", lambda s, p, m: s.list_objects(s.payment_intents, "/v1/payment_intents", p)),
+        ("GET", r"/v1/payment_intents/(?P<id>[^/]+)", lambda s, p, m: s.payment_intent(m["id"])),
+        ("POST", r"/v1/payment_intents/(?P<id>[^/]+)/cancel", lambda s, p, m: s.cancel_payment_intent(m["id"])),
+        ("POST", r"/v1/terminal/locations", lambda s, p, m: s.create_location(p)),
+        ("GET", r"/v1/terminal/locations", lambda s, p, m: s.list_objects(s.locations, "/v1/terminal/locations", p)),
+        ("POST", r"/v1/terminal/readers", lambda s, p, m: s.create_reader(p)),
+        ("GET", r"/v1/terminal/readers", lambda s, p, m: s.list_objects(s.readers, "/v1/terminal/readers", p)),
+        ("GET", r"/v1/terminal/readers/(?P<id>[^/]+)", lambda s, p, m: s.reader(m["id"])),
+        ("POST", r"/v1/terminal/readers/(?P<id>[^/]+)/process_payment_intent", lambda s, p, m: s.process_payment_intent(m["id"], p)),
+        ("POST", r"/v1/terminal/readers/(?P<id>[^/]+)/cancel_action", lambda s, p, m: s.cancel_action(m["id"])),
+        ("POST", r"/v1/test_helpers/terminal/readers/(?P<id>[^/]+)/present_payment_method", lambda s, p, m: s.present_payment_method(m["id"])),
+        ("POST", r"/v1/oauth2/token", lambda s, p, m: {
+            "access_token": _id("A21AA"), "token_type": "Bearer", "app_id": "APP-FAKE", "expires_in": 32400,
+            "scope": "https://uri.paypal.com/services/payments/payment",
+        }),
+        ("POST", r"/v1/payments/payment", lambda s, p, m: s.create_paypal_payment(p)),
+        ("GET", r"/v1/payments/payment/(?P<id>[^/]+)", lambda s, p, m: s.paypal_payment(m["id"])),
+        ("POST", r"/v1/payments/payment/(?P<id>[^/]+)/execute", lambda s, p, m: s.execute_paypal_payment(m["id"], p)),
+    ]
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def dispatch(self, method: str):
+        url = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode() if length else ""
+        server = self.server
+
+        server.delay()
+        try:
+            if random.random() < server.failure_rate:
+                raise FakeApiError(500, "Injected failure", error_type="api_error")
+            if "json" in (self.headers.get("Content-Type") or ""):
+                params = json.loads(body or "{}")
+            else:
+                params = _unflatten(parse_qsl(body or url.query, keep_blank_values=True))
+            for route_method, pattern, handler in self.ROUTES:
+                match = re.fullmatch(pattern, url.path)
+                if route_method == method and match:
+                    key = self.headers.get("Idempotency-Key") if method == "POST" else None
+                    self.respond(200, server.state.idempotent(key, lambda: handler(server.state, params, match.groupdict())))
+                    return
+            raise FakeApiError(404, f"Unrecognized request URL ({method}: {url.path})")
+        except FakeApiError as e:
+            self.respond(e.status, e.body)
+
+    def respond(self, status: int, payload: Dict):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Request-Id", _id("req"))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(f"Fake provider {self.address_string()} {format % args}")
+
+
+class FakeProviderServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, state: FakeProviderState, latency_ms: float, jitter_ms: float, failure_rate: float):
+        super().__init__(address, FakeProviderHandler)
+        self.state = state
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+
+    def delay(self):
+        delay_ms = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000)
+
+
+class FakePaymentProviders:
+    """
+    Runs the fake Stripe/PayPal server and its webhook sender in background threads.
+
+    Usage::
+
+        fakes = FakePaymentProviders(webhook_url="http://localhost:8000/api/webhook/stripe",
+                                     webhook_secret="whsec_test", latency_ms=150)
+        fakes.start()   # STRIPE_API_BASE / PAYPAL_API_BASE = fakes.url
+        ...
+        fakes.stop()
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency_ms: float = 0, jitter_ms: float = 0,
+                 failure_rate: float = 0.0, decline_rate: float = 0.0, webhook_url: Optional[str] = None,
+                 webhook_secret: Optional[str] = None, webhook_delay_ms: float = 0):
+        self.state = FakeProviderState(decline_rate=decline_rate)
+        self.server = FakeProviderServer((host, port), self.state, latency_ms, jitter_ms, failure_rate)
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret or ""
+        self.webhook_delay_ms = webhook_delay_ms
+        self.webhooks_sent = 0
+        self.webhooks_failed = 0
+        self._threads = []
+        self._stopping = threading.Event()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Serve in the background; without a webhook_url, events are left on state.events for the caller"""
+        self._threads = [threading.Thread(target=self.server.serve_forever, name="fake-providers", daemon=True)]
+        if self.webhook_url:
+            self._threads.append(threading.Thread(target=self._send_webhooks, name="fake-provider-webhooks", daemon=True))
+        for thread in self._threads:
+            thread.start()
+        logger.info(f"Fake payment providers listening on {self.url}")
+
+    def stop(self):
+        self._stopping.set()
+        self.server.shutdown()
+        self.server.server_close()
+        for thread in self._threads:
+            thread.join(timeout=5)
+
+    def sign(self, payload: str, timestamp: Optional[int] = None) -> str:
+        """Stripe-Signature header for payload, as stripe.Webhook.construct_event expects it"""
+        timestamp = timestamp or int(time.time())
+        signature = hmac.new(self.webhook_secret.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+        return f"t={timestamp},v1={signature}"
+
+    def _send_webhooks(self):
+        with requests.Session() as webhook_session:
+            while not self._stopping.is_set():
+                try:
+                    event = self.state.events.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if self.webhook_delay_ms:
+                    time.sleep(self.webhook_delay_ms / 1000)
+                payload = json.dumps(event)
+                try:
+                    response = webhook_session.post(
+                        self.webhook_url, data=payload, timeout=10,
+                        headers={"Content-Type": "application/json", "Stripe-Signature": self.sign(payload)},
+                    )
+                    response.raise_for_status()
+                    self.webhooks_sent += 1
+                except requests.RequestException as e:
+                    self.webhooks_failed += 1
+                    logger.warning(f"Fake provider webhook {event['type']} failed: {e}")
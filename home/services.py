@@ -3,19 +3,276 @@ from http.cookiejar import debug
 import instaloader
 import tempfile
 import os
+import asyncio
 import base64
-from datetime import datetime
+import csv
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import tarfile
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from io import BytesIO, TextIOWrapper
 from django.core.cache import cache
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Set
 import logging
 import paypalrestsdk
+import stripe
 from django.conf import settings
-from .models import Order
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Count, F, Max, Min, Q, Sum
+from django.utils import timezone
+from PIL import Image, ImageOps
+from .http_client import paypal_api
+from .models import Order, ReaderDevice, StripePayload, StripeWebhookEvent, SyncWatermark, CardImage, CardChange, CardImageRendition, CardImportJob, CardSpriteAtlas, card_image_upload_path
 
 logger = logging.getLogger(__name__)
 
+
+def insert_ignoring_duplicates(model, objs: List, key_field: str) -> List:
+    """
+    bulk_create that skips rows whose unique key already exists, in one statement.
+
+    On MySQL ignore_conflicts means INSERT IGNORE, which also turns data errors
+    (NULL in a NOT NULL column, truncation) into warnings and stores coerced
+    rows, and on SQLite it is INSERT OR IGNORE, which skips NOT NULL failures
+    as well. There the key is "updated" to itself instead (ON DUPLICATE KEY
+    UPDATE / ON CONFLICT DO UPDATE), which only lets duplicate key conflicts
+    through. PostgreSQL's ON CONFLICT DO NOTHING already ignores nothing else.
+    :param key_field: A unique, non primary key field of the model
+    """
+    if connection.vendor == 'mysql':
+        return model.objects.bulk_create(objs, update_conflicts=True, update_fields=[key_field])
+    if connection.vendor == 'sqlite':
+        return model.objects.bulk_create(
+            objs, update_conflicts=True, unique_fields=[key_field], update_fields=[key_field],
+        )
+    return model.objects.bulk_create(objs, ignore_conflicts=True)
+
+
+class InstagramRateLimited(Exception):
+    """Raised when the outbound Instagram budget cannot serve a request"""
+
+
+class InstagramRateLimiter:
+    """
+    Outbound request budget for Instagram shared by every worker.
+
+    The token bucket and the backoff state live in the cache, so all gunicorn
+    workers draw from the same budget when a shared cache backend is configured.
+    Inside a process, waiting callers are served in priority order, and
+    background callers may not dip into the tokens reserved for live kiosks.
+    The priority queue itself is per process: across workers, tokens go to
+    whichever worker takes them first, and only the reserve protects live kiosks.
+    """
+    PRIORITY_LIVE = 0
+    PRIORITY_BACKGROUND = 1
+
+    STATE_KEY = 'instagram_rate_limit_state'
+    LOCK_KEY = 'instagram_rate_limit_lock'
+    LOCK_TIMEOUT = 5
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._condition = threading.Condition()
+        self._waiters = []
+        self._sequence = itertools.count()
+
+    @property
+    def capacity(self) -> float:
+        return float(settings.INSTAGRAM_BURST)
+
+    @property
+    def refill_rate(self) -> float:
+        """Tokens added per second"""
+        return settings.INSTAGRAM_REQUESTS_PER_MINUTE / 60.0
+
+    def acquire(self, priority: int = PRIORITY_LIVE, timeout: float = 10) -> bool:
+        """
+        Wait for a token from the shared budget
+        :param priority: PRIORITY_LIVE or PRIORITY_BACKGROUND
+        :param timeout: Maximum seconds to wait
+        :return: True if a token was taken, False if the wait timed out
+        """
+        deadline = time.monotonic() + timeout
+        entry = (priority, next(self._sequence))
+        with self._condition:
+            heapq.heappush(self._waiters, entry)
+        try:
+            while True:
+                with self._condition:
+                    first = self._waiters[0] == entry
+                # The shared lock can take a while; other threads keep queueing meanwhile
+                wait = self._take_token(priority) if first else self.POLL_INTERVAL
+                if wait == 0:
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (first and wait > remaining):
+                    # No token before the deadline (e.g. during a backoff), so give up right away
+                    return False
+                with self._condition:
+                    self._condition.wait(min(wait, remaining, self.POLL_INTERVAL))
+        finally:
+            with self._condition:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._condition.notify_all()
+
+    def record_rate_limit(self):
+        """Back off exponentially after Instagram answered with a rate limit"""
+        with self._shared_lock():
+            state = self._load_state()
+            state['backoff_level'] += 1
+            delay = min(
+                settings.INSTAGRAM_BACKOFF_BASE_SECONDS * 2 ** (state['backoff_level'] - 1),
+                settings.INSTAGRAM_BACKOFF_MAX_SECONDS,
+            )
+            state['backoff_until'] = self.clock() + delay
+            state['tokens'] = 0.0
+            state['rate_limited_total'] += 1
+            self._save_state(state)
+        logger.warning(f"Instagram rate limit hit, backing off for {delay} seconds")
+
+    def record_success(self):
+        """Reset the backoff level once Instagram answers normally again"""
+        state = cache.get(self.STATE_KEY)
+        if not state or not state['backoff_level']:
+            return
+        with self._shared_lock():
+            state = self._load_state()
+            state['backoff_level'] = 0
+            self._save_state(state)
+
+    def snapshot(self) -> Dict:
+        """Current budget and backoff state for instrumentation"""
+        state = self._load_state()
+        now = self.clock()
+        with self._condition:
+            waiting = [priority for priority, _ in self._waiters]
+        return {
+            'tokens': round(state['tokens'], 2),
+            'capacity': self.capacity,
+            'refill_per_second': round(self.refill_rate, 4),
+            'background_reserve': settings.INSTAGRAM_BACKGROUND_RESERVE,
+            'backoff_level': state['backoff_level'],
+            'backoff_remaining_seconds': round(max(state['backoff_until'] - now, 0), 1),
+            'backoff_until': (
+                datetime.utcfromtimestamp(state['backoff_until']).isoformat()
+                if state['backoff_until'] > now else None
+            ),
+            'granted_total': state['granted_total'],
+            'rate_limited_total': state['rate_limited_total'],
+            'waiting_live': waiting.count(self.PRIORITY_LIVE),
+            'waiting_background': waiting.count(self.PRIORITY_BACKGROUND),
+        }
+
+    def _take_token(self, priority: int) -> float:
+        """Take a token if one is available, otherwise return seconds to wait"""
+        with self._shared_lock():
+            state = self._load_state()
+            now = self.clock()
+            if state['backoff_until'] > now:
+                return state['backoff_until'] - now
+
+            needed = 1.0
+            if priority > self.PRIORITY_LIVE:
+                needed += settings.INSTAGRAM_BACKGROUND_RESERVE
+            if state['tokens'] >= needed:
+                state['tokens'] -= 1.0
+                state['granted_total'] += 1
+                self._save_state(state)
+                return 0
+            return (needed - state['tokens']) / self.refill_rate
+
+    def _load_state(self) -> Dict:
+        now = self.clock()
+        state = cache.get(self.STATE_KEY) or {
+            'tokens': self.capacity,
+            'updated': now,
+            'backoff_until': 0.0,
+            'backoff_level': 0,
+            'granted_total': 0,
+            'rate_limited_total': 0,
+        }
+        elapsed = max(now - state['updated'], 0)
+        state['tokens'] = min(self.capacity, state['tokens'] + elapsed * self.refill_rate)
+        state['updated'] = now
+        return state
+
+    def _save_state(self, state: Dict):
+        cache.set(self.STATE_KEY, state, None)
+
+    def _shared_lock(self):
+        return _CacheLock(self.LOCK_KEY, self.LOCK_TIMEOUT)
+
+
+class _CacheLock:
+    """
+    Short-lived mutex across workers built on the atomic cache.add.
+
+    Each holder stores its own token and only releases the lock while it still
+    holds that token, so a holder whose lock was taken over as stale does not
+    release the new holder's lock.
+    """
+
+    def __init__(self, key: str, timeout: int):
+        self.key = key
+        self.timeout = timeout
+        self.token = None
+
+    def __enter__(self):
+        self.token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.timeout
+        while not cache.add(self.key, self.token, self.timeout):
+            if time.monotonic() > deadline:
+                logger.warning(f"Stale cache lock {self.key}, taking it over")
+                cache.set(self.key, self.token, self.timeout)
+                break
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # The cache API has no compare-and-delete; the check narrows the window to the two calls
+        if cache.get(self.key) == self.token:
+            cache.delete(self.key)
+
+
+instagram_rate_limiter = InstagramRateLimiter()
+
+
+class _BudgetedRateController(instaloader.RateController):
+    """Routes every Instagram query through the shared outbound budget"""
+
+    def __init__(self, context, priority: int, timeout: float):
+        super().__init__(context)
+        self.priority = priority
+        self.timeout = timeout
+
+    def wait_before_query(self, query_type: str) -> None:
+        if not instagram_rate_limiter.acquire(self.priority, self.timeout):
+            raise InstagramRateLimited("Outbound Instagram budget exhausted")
+
+    def handle_429(self, query_type: str) -> None:
+        instagram_rate_limiter.record_rate_limit()
+        raise InstagramRateLimited("Instagram responded with 429 Too Many Requests")
+
+
 class InstagramService:
-    def __init__(self):
+    # Last good result per profile, served while the outbound budget is exhausted
+    STALE_CACHE_TIMEOUT = 7 * 24 * 3600
+    # Widths of the display_resources renditions Instagram serves for a post
+    DISPLAY_WIDTHS = (640, 750, 1080)
+
+    def __init__(self, priority: int = InstagramRateLimiter.PRIORITY_LIVE, budget_timeout: float = 10):
         self.loader = instaloader.Instaloader(
             download_pictures=True,
             download_videos=False,
@@ -24,6 +281,7 @@ class InstagramService:
             download_comments=False,
             save_metadata=False,
             compress_json=False,
+            rate_controller=lambda context: _BudgetedRateController(context, priority, budget_timeout),
             # debug=True
         )
         self.temp_dir = tempfile.mkdtemp()
@@ -48,9 +306,55 @@ class InstagramService:
             logger.error(f"Error during authentication: {str(e)}")
         return False
 
-    def get_profile_posts(self, username: str, limit: int = 10, cache_timeout: int = 3600) -> List[Dict]:
-        cache_key = f'instagram_posts_{username}'
-        cached_posts = cache.get(cache_key)
+    @classmethod
+    def width_bucket(cls, target_width: Optional[int]) -> Optional[int]:
+        """
+        Round a requested width up to the rendition width Instagram serves for it.
+
+        :param target_width: Width in pixels the kiosk renders the image at
+        :return: One of DISPLAY_WIDTHS, or None for full resolution
+        """
+        if not target_width:
+            return None
+        for width in cls.DISPLAY_WIDTHS:
+            if width >= target_width:
+                return width
+        return cls.DISPLAY_WIDTHS[-1]
+
+    @staticmethod
+    def select_image_url(post, target_width: Optional[int] = None) -> str:
+        """
+        Pick the smallest display rendition that is at least target_width wide.
+
+        :param post: instaloader Post
+        :param target_width: Width in pixels the kiosk renders the image at, None for full resolution
+        :return: URL of the chosen rendition
+        """
+        # instaloader has no public accessor for the renditions, so fall back to post.url if the node changes
+        try:
+            resources = [
+                resource for resource in post._node.get('display_resources') or []
+                if resource.get('src') and resource.get('config_width')
+            ]
+        except (AttributeError, TypeError):
+            resources = []
+        if not target_width or not resources:
+            return post.url
+
+        resources = sorted(resources, key=lambda resource: resource['config_width'])
+        for resource in resources:
+            if resource['config_width'] >= target_width:
+                return resource['src']
+        return resources[-1]['src']
+
+    def get_profile_posts(self, username: str, limit: int = 10, cache_timeout: int = 3600,
+                          refresh: bool = False, target_width: Optional[int] = None) -> List[Dict]:
+        # Every width in a bucket gets the same rendition, so they share one cache entry and one fetch
+        target_width = self.width_bucket(target_width)
+        width_key = target_width or 'full'
+        cache_key = f'instagram_posts_{username}_{width_key}'
+        stale_cache_key = f'instagram_posts_stale_{username}_{width_key}'
+        cached_posts = None if refresh else cache.get(cache_key)
 
         if cached_posts:
             logger.info(f"Returning cached posts for {username}.")
@@ -71,7 +375,7 @@ class InstagramService:
                 # Download image
                 try:
                     logger.info(f"Downloading image for post {post.shortcode} to {temp_path}")
-                    self.loader.download_pic(temp_path, post.url, post.date_utc)
+                    self.loader.download_pic(temp_path, self.select_image_url(post, target_width), post.date_utc)
                     temp_path += '.jpg'
                     if not os.path.exists(temp_path):
                         logger.warning(f"Image file does not exist: {temp_path}")
@@ -101,13 +405,20 @@ class InstagramService:
                 posts.append(post_data)
 
             cache.set(cache_key, posts, cache_timeout)
+            cache.set(stale_cache_key, posts, self.STALE_CACHE_TIMEOUT)
+            instagram_rate_limiter.record_success()
             return posts
+        except InstagramRateLimited as e:
+            logger.warning(f"{e}. Serving last known posts for {username}.")
+            return cache.get(stale_cache_key, [])
         except instaloader.exceptions.ProfileNotExistsException:
             logger.warning(f"Profile '{username}' does not exist.")
         except instaloader.exceptions.LoginRequiredException:
             logger.warning("Login required to fetch this profile. Please authenticate.")
-        except instaloader.exceptions.RateLimitExceeded:
-            logger.warning("Rate limit exceeded. Please wait before trying again.")
+        except instaloader.exceptions.TooManyRequestsException:
+            instagram_rate_limiter.record_rate_limit()
+            logger.warning(f"Rate limit exceeded. Serving last known posts for {username}.")
+            return cache.get(stale_cache_key, [])
         except instaloader.exceptions.InstaloaderException as e:
             logger.error(f"An error occurred while fetching the profile: {e}")
         except Exception as e:
@@ -180,13 +491,1399 @@ class ImageUploadService:
             logger.warning(f"No image found to delete for key: {cache_key}")
         return result
 
+class CardCatalogService:
+    """
+    Versioned card catalog served to kiosks.
+
+    The catalog version is an ETag fingerprint of the CardImage table kept in
+    the cache together with its Last-Modified time. It is refreshed on every
+    CardImage save and delete, and re-checked against the database at most once
+    per RECHECK_SECONDS so that workers with a private cache converge as well.
+    The rendered JSON body is cached per version.
+
+    Every mutation is also appended to the CardChange feed, so kiosks holding a
+    cursor can fetch only what changed since.
+    """
+    STATE_KEY = 'card_catalog_state'
+    BODY_KEY = 'card_catalog_body_{etag}'
+    CARDS_KEY = 'card_catalog_cards_{etag}'
+    RECHECK_SECONDS = 60
+    BODY_TIMEOUT = 24 * 3600
+
+    @classmethod
+    def get_state(cls) -> Dict:
+        """
+        Current catalog version without touching the database when cached
+        :return: Dict with etag and last_modified (unix timestamp)
+        """
+        state = cache.get(cls.STATE_KEY)
+        if state and time.time() - state['checked_at'] < cls.RECHECK_SECONDS:
+            return state
+        return cls.refresh_state()
+
+    @classmethod
+    def refresh_state(cls) -> Dict:
+        """Recompute the catalog version from the database"""
+        previous = cache.get(cls.STATE_KEY)
+        aggregate = CardImage.objects.aggregate(
+            count=Count('id'),
+            enabled=Count('id', filter=Q(is_enabled=True)),
+            updated=Max('updated_at'),
+            versions=Sum('version'),
+        )
+        updated = aggregate['updated'].isoformat() if aggregate['updated'] else ''
+        fingerprint = f"{aggregate['count']}:{aggregate['enabled']}:{updated}:{aggregate['versions'] or 0}"
+        etag = hashlib.md5(fingerprint.encode()).hexdigest()
+
+        now = time.time()
+        if previous and previous['etag'] == etag:
+            last_modified = previous['last_modified']
+        else:
+            last_modified = int(now)
+
+        cursor = cls.settled_changes(0).aggregate(cursor=Max('seq'))['cursor'] or 0
+        state = {'etag': etag, 'last_modified': last_modified, 'cursor': cursor, 'checked_at': now}
+        cache.set(cls.STATE_KEY, state, None)
+        return state
+
+    @classmethod
+    def get_cards(cls, state: Dict) -> List[Dict]:
+        """
+        Enabled cards for the given version, loaded with a single query
+        :param state: Catalog state from get_state
+        :return: List of card dicts as served to kiosks
+        """
+        cards_key = cls.CARDS_KEY.format(etag=state['etag'])
+        cards = cache.get(cards_key)
+        if cards is None:
+            cards = [
+                cls.serialize_card(card)
+                for card in CardImage.objects.filter(is_enabled=True).prefetch_related('renditions')
+            ]
+            cache.set(cards_key, cards, cls.BODY_TIMEOUT)
+        return cards
+
+    @staticmethod
+    def serialize_card(card: CardImage) -> Dict:
+        """Card as served to kiosks, with media URLs relative to the host"""
+        return {
+            "id": str(card.id),
+            "image_url": f"{settings.MEDIA_URL}{card.image}",
+            "version": card.version,
+            "is_enabled": card.is_enabled,
+            "created_at": card.created_at.isoformat(),
+            "updated_at": card.updated_at.isoformat(),
+            "renditions": [
+                CardRenditionService.serialize_rendition(rendition)
+                for rendition in card.renditions.all()
+            ],
+        }
+
+    @classmethod
+    def get_body(cls, state: Dict) -> bytes:
+        """
+        Pre-rendered JSON catalog for the given version
+        :param state: Catalog state from get_state
+        :return: UTF-8 encoded JSON body
+        """
+        body_key = cls.BODY_KEY.format(etag=state['etag'])
+        body = cache.get(body_key)
+        if body is None:
+            body = json.dumps({"cards": cls.get_cards(state)}).encode('utf-8')
+            cache.set(body_key, body, cls.BODY_TIMEOUT)
+        return body
+
+    @staticmethod
+    def record_change(card: CardImage, deleted: bool = False) -> CardChange:
+        """
+        Append a catalog mutation to the change feed
+        :param card: The saved or deleted card
+        :param deleted: True when the card was deleted
+        :return: The recorded change
+        """
+        change = CardCatalogService.change_for(card, deleted)
+        change.save()
+        return change
+
+    @staticmethod
+    def change_for(card: CardImage, deleted: bool = False) -> CardChange:
+        """Unsaved change feed entry for a card, for callers that insert in bulk"""
+        if deleted:
+            action = 'delete'
+        elif not card.is_enabled:
+            action = 'disable'
+        else:
+            action = 'upsert'
+        return CardChange(card_id=card.id, action=action, version=card.version)
+
+    @staticmethod
+    def settled_changes(cursor: int):
+        """
+        Changes after the cursor that no uncommitted change can precede any more.
+
+        seq is allocated at insert but becomes visible at commit, so a change
+        may show up after a kiosk has already read past its seq. Changes are
+        only served once every change younger than CARD_CHANGES_SETTLE_SECONDS
+        is excluded along with all seqs after it.
+        :param cursor: Last seq the kiosk has applied
+        :return: CardChange queryset
+        """
+        changes = CardChange.objects.filter(seq__gt=cursor)
+        if settings.CARD_CHANGES_SETTLE_SECONDS:
+            settled_before = timezone.now() - timedelta(seconds=settings.CARD_CHANGES_SETTLE_SECONDS)
+            unsettled = CardChange.objects.filter(created_at__gte=settled_before).aggregate(seq=Min('seq'))['seq']
+            if unsettled is not None:
+                changes = changes.filter(seq__lt=unsettled)
+        return changes
+
+    @staticmethod
+    def changes_since(cursor: int, limit: int = 100) -> Dict:
+        """
+        Catalog mutations after the kiosk's cursor, one page at a time
+        :param cursor: Last seq the kiosk has applied
+        :param limit: Maximum number of changes to read
+        :return: Dict with changes, next_cursor and has_more
+        """
+        rows = list(CardCatalogService.settled_changes(cursor).order_by('seq')[:limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        # Only the latest change per card in this page matters to the kiosk
+        latest = {}
+        for row in rows:
+            latest.pop(row.card_id, None)
+            latest[row.card_id] = row
+
+        upserted_ids = [row.card_id for row in latest.values() if row.action == 'upsert']
+        cards = CardImage.objects.filter(
+            id__in=upserted_ids, is_enabled=True,
+        ).prefetch_related('renditions').in_bulk() if upserted_ids else {}
+
+        changes = []
+        for card_id, row in latest.items():
+            card = cards.get(card_id)
+            if row.action == 'upsert' and card is None:
+                # Removed again later; its tombstone follows further down the feed
+                continue
+            changes.append({
+                "seq": row.seq,
+                "card_id": str(card_id),
+                "action": row.action,
+                "card": CardCatalogService.serialize_card(card) if row.action == 'upsert' else None,
+            })
+
+        return {
+            'changes': changes,
+            'next_cursor': rows[-1].seq if rows else cursor,
+            'has_more': has_more,
+        }
+
+    @staticmethod
+    def changed_since(cursor: int) -> Dict:
+        """
+        Net effect of all catalog mutations after the cursor
+        :param cursor: Last seq the kiosk has applied
+        :return: Dict with upserted and removed card ids and the new cursor
+        """
+        latest = {}
+        next_cursor = cursor
+        for seq, card_id, action in CardCatalogService.settled_changes(cursor).order_by('seq').values_list(
+                'seq', 'card_id', 'action').iterator():
+            latest[card_id] = action
+            next_cursor = seq
+        return {
+            'upserted': [card_id for card_id, action in latest.items() if action == 'upsert'],
+            'removed': [str(card_id) for card_id, action in latest.items() if action != 'upsert'],
+            'cursor': next_cursor,
+        }
+
+    @classmethod
+    def diff(cls, client_versions: Dict) -> Dict:
+        """
+        Compare a kiosk's {id: version} map against the catalog
+        :param client_versions: Card versions the kiosk currently holds
+        :return: Dict with updated cards, new cards and removed card ids
+        """
+        catalog = {card['id']: card for card in cls.get_cards(cls.get_state())}
+        known = {}
+        removed = []
+        for card_id, client_version in client_versions.items():
+            try:
+                normalized_id = str(uuid.UUID(str(card_id)))
+            except ValueError:
+                removed.append(card_id)
+                continue
+            if normalized_id not in catalog:
+                removed.append(card_id)
+                continue
+            try:
+                known[normalized_id] = int(client_version)
+            except (TypeError, ValueError):
+                known[normalized_id] = 0
+
+        return {
+            'updates': [catalog[card_id] for card_id, version in known.items() if catalog[card_id]['version'] > version],
+            'new': [card for card_id, card in catalog.items() if card_id not in known],
+            'removed': removed,
+        }
+
+class CardRenditionService:
+    """
+    Generates resized WebP and JPEG renditions of card images.
+
+    Generation runs on a small background thread pool after the saving
+    transaction commits, so admin uploads return immediately. Renditions are
+    only rebuilt when the original image content changes, and are stored under
+    their content hash so replaced files never reuse a URL.
+    """
+    WEBP_QUALITY = 80
+    JPEG_QUALITY = 85
+
+    _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='card-renditions')
+    _pending = set()
+    _pending_lock = threading.Lock()
+
+    @classmethod
+    def schedule(cls, card_id):
+        """Queue rendition generation for a card once the current transaction commits"""
+        if not settings.CARD_RENDITIONS_ASYNC:
+            cls._generate_safely(card_id)
+            return
+        transaction.on_commit(lambda: cls._submit(card_id))
+
+    @classmethod
+    def _submit(cls, card_id):
+        with cls._pending_lock:
+            if card_id in cls._pending:
+                return
+            cls._pending.add(card_id)
+        cls._executor.submit(cls._run_in_background, card_id)
+
+    @classmethod
+    def schedule_many(cls, card_ids: List):
+        """
+        Queue rendition generation for a batch of cards once the current transaction commits.
+
+        The catalog state is refreshed once, after the whole batch, rather than per card.
+        """
+        if not settings.CARD_RENDITIONS_ASYNC:
+            cls._generate_batch(card_ids)
+            return
+        transaction.on_commit(lambda: cls._executor.submit(cls._run_batch_in_background, card_ids))
+
+    @classmethod
+    def _run_in_background(cls, card_id):
+        with cls._pending_lock:
+            cls._pending.discard(card_id)
+        close_old_connections()
+        try:
+            cls._generate_safely(card_id)
+        finally:
+            close_old_connections()
+
+    @classmethod
+    def _run_batch_in_background(cls, card_ids):
+        close_old_connections()
+        try:
+            cls._generate_batch(card_ids)
+        finally:
+            close_old_connections()
+
+    @classmethod
+    def _generate_batch(cls, card_ids):
+        for card_id in card_ids:
+            cls._generate_safely(card_id, refresh=False)
+        CardCatalogService.refresh_state()
+
+    @classmethod
+    def _generate_safely(cls, card_id, refresh: bool = True):
+        try:
+            cls.generate(card_id, refresh)
+        except CardImage.DoesNotExist:
+            logger.info(f"Card {card_id} was deleted before its renditions were generated")
+        except Exception as e:
+            logger.error(f"Error generating renditions for card {card_id}: {str(e)}")
+
+    @classmethod
+    def generate(cls, card_id, refresh: bool = True) -> List[CardImageRendition]:
+        """
+        Build the rendition set for a card.
+
+        New renditions change the card as served to kiosks, so the card gets a
+        new version and a change feed entry along with them.
+        :param card_id: CardImage primary key
+        :param refresh: Refresh the catalog state afterwards; batch callers do it once at the end
+        :return: The card's renditions
+        """
+        card = CardImage.objects.get(pk=card_id)
+        with card.image.open('rb') as image_file:
+            original = image_file.read()
+        source_hash = hashlib.sha256(original).hexdigest()
+
+        existing = list(card.renditions.all())
+        if existing and all(rendition.source_hash == source_hash for rendition in existing):
+            return existing
+
+        image = ImageOps.exif_transpose(Image.open(BytesIO(original)))
+        widths = sorted({min(width, image.width) for width in settings.CARD_RENDITION_WIDTHS})
+
+        renditions = []
+        for width in widths:
+            resized = image.copy()
+            resized.thumbnail((width, image.height), Image.LANCZOS)
+            for image_format, extension in (('webp', 'webp'), ('jpeg', 'jpg')):
+                data = cls._encode(resized, image_format)
+                rendition = CardImageRendition(
+                    card=card,
+                    format=image_format,
+                    width=resized.width,
+                    height=resized.height,
+                    bytes=len(data),
+                    content_hash=hashlib.sha256(data).hexdigest(),
+                    source_hash=source_hash,
+                )
+                name = f'{resized.width}.{extension}'
+                path = rendition.file.field.generate_filename(rendition, name)
+                if default_storage.exists(path):
+                    rendition.file.name = path
+                else:
+                    rendition.file.save(name, ContentFile(data), save=False)
+                renditions.append(rendition)
+
+        with transaction.atomic():
+            card.renditions.all().delete()
+            CardImageRendition.objects.bulk_create(renditions)
+            # update() rather than save(), which would schedule the renditions again
+            CardImage.objects.filter(pk=card.pk).update(version=F('version') + 1, updated_at=timezone.now())
+            card.refresh_from_db(fields=['version', 'is_enabled', 'updated_at'])
+            CardCatalogService.record_change(card)
+        if refresh:
+            CardCatalogService.refresh_state()
+
+        logger.info(f"Generated {len(renditions)} renditions for card {card.id}")
+        return renditions
+
+    @classmethod
+    def _encode(cls, image: Image.Image, image_format: str) -> bytes:
+        buffer = BytesIO()
+        if image_format == 'jpeg':
+            image.convert('RGB').save(buffer, 'JPEG', quality=cls.JPEG_QUALITY, optimize=True, progressive=True)
+        else:
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+            image.save(buffer, 'WEBP', quality=cls.WEBP_QUALITY, method=4)
+        return buffer.getvalue()
+
+    @staticmethod
+    def serialize_rendition(rendition: CardImageRendition) -> Dict:
+        """Rendition as served to kiosks, with its URL relative to the host"""
+        return {
+            "url": f"{settings.MEDIA_URL}{rendition.file}",
+            "format": rendition.format,
+            "width": rendition.width,
+            "height": rendition.height,
+            "bytes": rendition.bytes,
+            "hash": rendition.content_hash,
+        }
+
+class CardMediaService:
+    """
+    Garbage collection for content-addressed card media.
+
+    Replacing a card image or its renditions leaves the old hash-named files
+    behind, since kiosks and caches may still reference them. Files that no
+    card or rendition references are removed once they are older than the
+    grace period.
+    """
+    MEDIA_DIRS = ('cards', 'cards/renditions', 'cards/sprites')
+
+    @classmethod
+    def collect_garbage(cls, grace_seconds: int, dry_run: bool = False) -> List[str]:
+        """
+        Delete unreferenced card media older than the grace period
+        :param grace_seconds: Minimum age of a file before it may be deleted
+        :param dry_run: Only report what would be deleted
+        :return: Paths of deleted (or deletable) files
+        """
+        cutoff = timezone.now() - timedelta(seconds=grace_seconds)
+        referenced = set(CardImage.objects.values_list('image', flat=True))
+        referenced.update(CardImageRendition.objects.values_list('file', flat=True))
+        referenced.update(CardSpriteService.referenced_paths(cutoff))
+
+        collected = []
+        for directory in cls.MEDIA_DIRS:
+            if not default_storage.exists(directory):
+                continue
+            _, files = default_storage.listdir(directory)
+            for filename in files:
+                path = f'{directory}/{filename}'
+                if path in referenced:
+                    continue
+                try:
+                    if default_storage.get_modified_time(path) > cutoff:
+                        continue
+                    if not dry_run:
+                        default_storage.delete(path)
+                    collected.append(path)
+                except Exception as e:
+                    logger.warning(f"Could not collect card media {path}: {str(e)}")
+        if not dry_run:
+            CardSpriteService.prune(cutoff)
+        return collected
+
+class CardSpriteService:
+    """
+    Sprite atlas of card thumbnails for the kiosk card picker.
+
+    WebP pages hold a thumbnail of every enabled card, with a coordinate map
+    per card; a catalog only spills onto further pages when it no longer fits
+    within the WebP size limit. The atlas is built once per catalog version,
+    by one request at a time, and recorded in CardSpriteAtlas so its pages are
+    found again without the cache and kept by media garbage collection. Pages
+    are stored under their content hash, so URLs change with the catalog.
+    """
+    ATLAS_KEY = 'card_sprite_{etag}'
+    ATLAS_TIMEOUT = 24 * 3600
+    BUILD_LOCK_KEY = 'card_sprite_build_{etag}'
+    BUILD_LOCK_TIMEOUT = 300
+    MAX_DIMENSION = 16383  # WebP limit
+    WEBP_QUALITY = 80
+
+    @classmethod
+    def get_atlas(cls, state: Dict) -> Optional[Dict]:
+        """
+        Atlas for the given catalog version, built on first use
+        :param state: Catalog state from CardCatalogService.get_state
+        :return: Dict with the atlas pages, tile size and per-card coordinates,
+                 or None while another request is building it
+        """
+        atlas_key = cls.ATLAS_KEY.format(etag=state['etag'])
+        atlas = cache.get(atlas_key)
+        if atlas is not None:
+            return atlas
+
+        atlas = CardSpriteAtlas.objects.filter(etag=state['etag']).values_list('atlas', flat=True).first()
+        if atlas is None:
+            lock_key = cls.BUILD_LOCK_KEY.format(etag=state['etag'])
+            if not cache.add(lock_key, 1, cls.BUILD_LOCK_TIMEOUT):
+                return None
+            try:
+                atlas = cls.build()
+                atlas = CardSpriteAtlas.objects.get_or_create(etag=state['etag'], defaults={'atlas': atlas})[0].atlas
+            finally:
+                cache.delete(lock_key)
+        cache.set(atlas_key, atlas, cls.ATLAS_TIMEOUT)
+        return atlas
+
+    @classmethod
+    def referenced_paths(cls, since: datetime) -> Set[str]:
+        """
+        Pages kiosks may still load: those of the newest atlas and of every atlas built after since
+        :param since: Start of the garbage collection grace period
+        """
+        atlases = list(CardSpriteAtlas.objects.filter(created_at__gte=since).values_list('atlas', flat=True))
+        atlases += CardSpriteAtlas.objects.order_by('-created_at').values_list('atlas', flat=True)[:1]
+        return {page['path'] for atlas in atlases for page in atlas['pages']}
+
+    @classmethod
+    def prune(cls, before: datetime):
+        """Forget atlases built before the given time, except the newest"""
+        latest = CardSpriteAtlas.objects.order_by('-created_at').values_list('pk', flat=True).first()
+        CardSpriteAtlas.objects.filter(created_at__lt=before).exclude(pk=latest).delete()
+
+    @classmethod
+    def build(cls) -> Dict:
+        tile_width, tile_height = settings.CARD_SPRITE_TILE_SIZE
+        cards = list(CardImage.objects.filter(is_enabled=True).order_by('created_at').prefetch_related('renditions'))
+        atlas = {'pages': [], 'tile_width': tile_width, 'tile_height': tile_height, 'tiles': {}}
+
+        max_columns = cls.MAX_DIMENSION // tile_width
+        per_page = max_columns * (cls.MAX_DIMENSION // tile_height)
+        for start in range(0, len(cards), per_page):
+            atlas['pages'].append(cls._build_page(cards[start:start + per_page], len(atlas['pages']), atlas['tiles']))
+
+        logger.info(f"Built card sprite atlas with {len(atlas['tiles'])} tiles on {len(atlas['pages'])} pages")
+        return atlas
+
+    @classmethod
+    def _build_page(cls, cards: List[CardImage], page: int, tiles: Dict) -> Dict:
+        tile_width, tile_height = settings.CARD_SPRITE_TILE_SIZE
+        max_columns = cls.MAX_DIMENSION // tile_width
+        columns = max(1, min(math.ceil(math.sqrt(len(cards) * tile_height / tile_width)), max_columns, len(cards)))
+        rows = math.ceil(len(cards) / columns)
+
+        sheet = Image.new('RGBA', (columns * tile_width, rows * tile_height), (0, 0, 0, 0))
+        for index, card in enumerate(cards):
+            try:
+                thumbnail = cls._thumbnail(card, tile_width, tile_height)
+            except Exception as e:
+                logger.error(f"Skipping card {card.id} in sprite atlas: {str(e)}")
+                continue
+            x = (index % columns) * tile_width
+            y = (index // columns) * tile_height
+            sheet.paste(thumbnail, (x, y))
+            tiles[str(card.id)] = {
+                'page': page, 'x': x, 'y': y, 'w': thumbnail.width, 'h': thumbnail.height, 'version': card.version,
+            }
+
+        buffer = BytesIO()
+        sheet.save(buffer, 'WEBP', quality=cls.WEBP_QUALITY, method=4)
+        data = buffer.getvalue()
+        path = f'cards/sprites/{hashlib.sha256(data).hexdigest()}.webp'
+        if not default_storage.exists(path):
+            default_storage.save(path, ContentFile(data))
+        return {'path': path, 'width': sheet.width, 'height': sheet.height}
+
+    @staticmethod
+    def _thumbnail(card: CardImage, tile_width: int, tile_height: int) -> Image.Image:
+        # The smallest rendition that still covers the tile is much cheaper to decode than the original
+        renditions = [rendition for rendition in card.renditions.all() if rendition.width >= tile_width]
+        source = min(renditions, key=lambda rendition: rendition.bytes).file if renditions else card.image
+        with source.open('rb') as image_file:
+            image = ImageOps.exif_transpose(Image.open(image_file))
+            image.thumbnail((tile_width, tile_height), Image.LANCZOS)
+            return image.convert('RGBA')
+
+class CardImportService:
+    """
+    Bulk card ingestion from a CSV of media paths or a zip of images.
+
+    The source is read incrementally and handled BATCH_SIZE cards at a time:
+    images are validated, hashed and written to their content-addressed path
+    on a thread pool, then the batch is inserted with one bulk_create for the
+    cards and one for their change feed entries. Content already in the
+    catalog is skipped, and the catalog version is refreshed once at the end.
+    Renditions are generated per batch without bumping the catalog.
+
+    Imports started from the admin run in the background; their progress is
+    kept in a CardImportJob row so any worker can report it.
+    """
+    BATCH_SIZE = 200
+    WORKERS = 4
+    MAX_ERRORS = 50
+    IMAGE_EXTENSIONS = ('jpg', 'jpeg', 'png', 'webp', 'gif')
+
+    _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='card-import')
+
+    @classmethod
+    def start(cls, upload) -> str:
+        """
+        Copy an uploaded CSV or zip to a temporary file and import it in the background
+        :param upload: The uploaded file
+        :return: Import id to poll with get_progress
+        """
+        suffix = '.zip' if upload.name.lower().endswith('.zip') else '.csv'
+        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as source:
+            for chunk in upload.chunks():
+                source.write(chunk)
+
+        import_id = uuid.uuid4().hex
+        cls._save_progress(cls._new_progress(import_id, upload.name))
+        cls._executor.submit(cls._run_in_background, import_id, source.name, upload.name)
+        return import_id
+
+    @classmethod
+    def get_progress(cls, import_id: str) -> Optional[Dict]:
+        return CardImportJob.objects.filter(id=import_id).values_list('progress', flat=True).first()
+
+    @classmethod
+    def _run_in_background(cls, import_id, path, name):
+        close_old_connections()
+        try:
+            cls.run(path, import_id=import_id, name=name)
+        except Exception as e:
+            logger.error(f"Card import {import_id} failed: {str(e)}")
+        finally:
+            os.remove(path)
+            close_old_connections()
+
+    @classmethod
+    def run(cls, path: str, import_id: Optional[str] = None, name: Optional[str] = None, on_progress=None) -> Dict:
+        """
+        Import every card in a CSV (image_path, is_enabled columns) or zip file
+        :param path: Local path of the CSV or zip file
+        :param import_id: Id to publish progress under, generated when omitted
+        :param name: Source name shown in the progress, the file name when omitted
+        :param on_progress: Called with the progress dict after every batch
+        :return: Final progress dict
+        """
+        progress = cls._new_progress(import_id or uuid.uuid4().hex, name or os.path.basename(path))
+        seen = set()
+
+        try:
+            items = cls._zip_items(path) if zipfile.is_zipfile(path) else cls._csv_items(path)
+            with ThreadPoolExecutor(max_workers=cls.WORKERS, thread_name_prefix='card-import-worker') as workers:
+                batch = []
+                for item in items:
+                    batch.append(item)
+                    if len(batch) >= cls.BATCH_SIZE:
+                        cls._import_batch(batch, workers, seen, progress, on_progress)
+                        batch = []
+                if batch:
+                    cls._import_batch(batch, workers, seen, progress, on_progress)
+            progress['status'] = 'done'
+        except Exception as e:
+            progress['status'] = 'failed'
+            progress['errors'].append(str(e))
+            raise
+        finally:
+            progress['finished_at'] = time.time()
+            cls._save_progress(progress)
+            if progress['created']:
+                CardCatalogService.refresh_state()
+            if on_progress:
+                on_progress(progress)
+
+        logger.info(f"Card import {progress['id']}: {progress['created']} created, {progress['skipped']} skipped, {progress['failed']} failed")
+        return progress
+
+    @staticmethod
+    def _csv_items(path):
+        with open(path, 'rb') as raw:
+            for row in csv.DictReader(TextIOWrapper(raw, encoding='utf-8-sig', newline='')):
+                if row.get('image_path'):
+                    yield row['image_path'], None, (row.get('is_enabled') or 'True').lower() == 'true'
+
+    @classmethod
+    def _zip_items(cls, path):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                extension = info.filename.rsplit('.', 1)[-1].lower()
+                if not info.is_dir() and extension in cls.IMAGE_EXTENSIONS:
+                    # Members are read one at a time here; ZipFile is not safe to read from several threads
+                    yield info.filename, archive.read(info), True
+
+    @classmethod
+    def _import_batch(cls, batch, workers, seen, progress, on_progress):
+        cards = []
+        for name, card, error in workers.map(cls._prepare_safely, batch):
+            if error:
+                progress['failed'] += 1
+                if len(progress['errors']) < cls.MAX_ERRORS:
+                    progress['errors'].append(f"{name}: {error}")
+            elif card.image_hash in seen:
+                progress['skipped'] += 1
+            else:
+                seen.add(card.image_hash)
+                cards.append(card)
+
+        existing = set(CardImage.objects.filter(
+            image_hash__in=[card.image_hash for card in cards]
+        ).values_list('image_hash', flat=True))
+        progress['skipped'] += sum(card.image_hash in existing for card in cards)
+        cards = [card for card in cards if card.image_hash not in existing]
+
+        with transaction.atomic():
+            CardImage.objects.bulk_create(cards)
+            CardChange.objects.bulk_create([CardCatalogService.change_for(card) for card in cards])
+        if cards:
+            CardRenditionService.schedule_many([card.pk for card in cards])
+
+        progress['processed'] += len(batch)
+        progress['created'] += len(cards)
+        cls._save_progress(progress)
+        if on_progress:
+            on_progress(progress)
+
+    @classmethod
+    def _prepare_safely(cls, item):
+        name = item[0]
+        try:
+            return name, cls._prepare(*item), None
+        except Exception as e:
+            return name, None, str(e)
+
+    @staticmethod
+    def _prepare(name: str, data: Optional[bytes], is_enabled: bool) -> CardImage:
+        """Validate and store one image, returning its unsaved card"""
+        if data is None:
+            with default_storage.open(name, 'rb') as image_file:
+                data = image_file.read()
+
+        image = Image.open(BytesIO(data))
+        image.verify()
+
+        card = CardImage(image_hash=hashlib.sha256(data).hexdigest(), is_enabled=is_enabled)
+        path = card_image_upload_path(card, f'card.{image.format.lower()}')
+        if not default_storage.exists(path):
+            saved = default_storage.save(path, ContentFile(data))
+            if saved != path:
+                # Another worker stored the same content first
+                default_storage.delete(saved)
+        card.image.name = path
+        return card
+
+    @staticmethod
+    def _new_progress(import_id: str, source: str) -> Dict:
+        return {
+            'id': import_id,
+            'source': source,
+            'status': 'running',
+            'processed': 0,
+            'created': 0,
+            'skipped': 0,
+            'failed': 0,
+            'errors': [],
+            'started_at': time.time(),
+            'finished_at': None,
+        }
+
+    @classmethod
+    def _save_progress(cls, progress: Dict):
+        CardImportJob.objects.update_or_create(id=progress['id'], defaults={'progress': progress})
+
+class CardArchiveService:
+    """
+    Streams card images to kiosks as a single tar archive.
+
+    The archive is written entry by entry while it is sent: a manifest.json
+    first, then every image in chunks straight from storage, so memory use
+    stays flat however many cards are included.
+    """
+    BLOCK_SIZE = tarfile.BLOCKSIZE
+
+    @staticmethod
+    def select_file(card: CardImage, width: Optional[int] = None, image_format: Optional[str] = None):
+        """
+        Pick the rendition closest to the requested size, or the original
+        :return: The chosen FieldFile
+        """
+        if not width and not image_format:
+            return card.image
+        renditions = [
+            rendition for rendition in card.renditions.all()
+            if not image_format or rendition.format == image_format
+        ]
+        if not renditions:
+            return card.image
+        if width:
+            large_enough = [rendition for rendition in renditions if rendition.width >= width]
+            if large_enough:
+                return min(large_enough, key=lambda rendition: rendition.width).file
+        return max(renditions, key=lambda rendition: rendition.width).file
+
+    @classmethod
+    def stream(cls, cards: List[CardImage], removed: List[str] = None, cursor: Optional[int] = None,
+               width: Optional[int] = None, image_format: Optional[str] = None):
+        """
+        Generate the tar archive for the given cards
+        :param cards: Cards to include, with renditions prefetched
+        :param removed: Card ids the kiosk should drop
+        :param cursor: Change feed cursor the archive brings the kiosk up to
+        :return: Iterator of byte chunks
+        """
+        entries = []
+        for card in cards:
+            file = cls.select_file(card, width, image_format)
+            if not file:
+                continue
+            entries.append((card, file, f"cards/{card.id}{os.path.splitext(file.name)[1]}"))
+
+        manifest = json.dumps({
+            "cursor": cursor,
+            "cards": [
+                {"id": str(card.id), "version": card.version, "file": name}
+                for card, file, name in entries
+            ],
+            "removed": removed or [],
+        }).encode('utf-8')
+        yield from cls._entry(BytesIO(manifest), "manifest.json", len(manifest), time.time())
+
+        for card, file, name in entries:
+            try:
+                size = file.size
+                file.open('rb')
+            except (OSError, ValueError) as e:
+                logger.error(f"Skipping card {card.id} in archive: {str(e)}")
+                continue
+            try:
+                yield from cls._entry(file, name, size, card.updated_at.timestamp())
+            finally:
+                file.close()
+
+        # End-of-archive marker: two empty blocks
+        yield b"\0" * (2 * cls.BLOCK_SIZE)
+
+    @classmethod
+    def _entry(cls, fileobj, name: str, size: int, mtime: float):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(mtime)
+        info.mode = 0o644
+        yield info.tobuf(tarfile.PAX_FORMAT)
+
+        written = 0
+        while written < size:
+            chunk = fileobj.read(min(64 * 1024, size - written))
+            if not chunk:
+                raise IOError(f"{name} ended after {written} of {size} bytes")
+            written += len(chunk)
+            yield chunk
+
+        padding = (cls.BLOCK_SIZE - size % cls.BLOCK_SIZE) % cls.BLOCK_SIZE
+        if padding:
+            yield b"\0" * padding
+
+class StripeWebhookService:
+    """
+    Applies Stripe webhook events to orders.
+
+    The webhook view only verifies the signature and stores the raw event in
+    the StripeWebhookEvent inbox, so Stripe gets its 200 without waiting on
+    order writes. The inbox is unique on the Stripe event id, so re-delivered
+    events are dropped on arrival. drain() picks up pending events in arrival
+    order, in batches, and marks each one processed; failures are kept with
+    their error and retried until MAX_ATTEMPTS. Events that used up their
+    attempts are listed by failed() and put back in line with retry(), which
+    the admin offers as an action.
+    """
+    MAX_ATTEMPTS = 5
+
+    EVENT_STATUS = {
+        "payment_intent.created": "created",
+        "payment_intent.processing": "processing",
+        "payment_intent.payment_failed": "failed",
+        "payment_intent.succeeded": "paid",
+    }
+    # Lifecycle order of order statuses; a failed payment may still be retried, paid is final
+    STATUS_RANK = {"created": 0, "processing": 1, "failed": 2, "paid": 3}
+
+    @staticmethod
+    def receive(payload: bytes, event):
+        """Store a verified event in the inbox, which doubles as the ledger of seen event ids"""
+        # A single insert skipping a duplicate event_id, so a re-delivery costs one statement
+        insert_ignoring_duplicates(StripeWebhookEvent, [
+            StripeWebhookEvent(
+                event_id=event["id"],
+                event_type=event["type"],
+                payload=payload.decode("utf-8"),
+            )
+        ], "event_id")
+
+    @classmethod
+    def drain(cls, batch_size: int = 100) -> int:
+        """
+        Apply one batch of pending inbox events
+        :param batch_size: Maximum number of events to apply
+        :return: Number of events attempted
+        """
+        with transaction.atomic():
+            # skip_locked lets several drainers run side by side on MySQL
+            events = list(
+                StripeWebhookEvent.objects.select_for_update(skip_locked=True)
+                .filter(processed_at__isnull=True, attempts__lt=cls.MAX_ATTEMPTS)
+                .order_by("id")[:batch_size]
+            )
+            for event in events:
+                event.attempts += 1
+                try:
+                    with transaction.atomic():
+                        cls.apply(json.loads(event.payload))
+                    event.processed_at = timezone.now()
+                    event.last_error = ""
+                except Exception as e:
+                    event.last_error = str(e)
+                    logger.error(f"Failed to apply Stripe event {event.event_id}: {str(e)}")
+                    if event.attempts >= cls.MAX_ATTEMPTS:
+                        logger.error(
+                            f"Giving up on Stripe event {event.event_id} ({event.event_type}) after "
+                            f"{event.attempts} attempts; retry it from the admin once fixed"
+                        )
+            StripeWebhookEvent.objects.bulk_update(events, ["processed_at", "attempts", "last_error"])
+        return len(events)
+
+    @classmethod
+    def failed(cls):
+        """Inbox events drain() gave up on"""
+        return StripeWebhookEvent.objects.filter(processed_at__isnull=True, attempts__gte=cls.MAX_ATTEMPTS)
+
+    @staticmethod
+    def retry(events) -> int:
+        """
+        Put unprocessed events back in line with a fresh set of attempts
+        :param events: StripeWebhookEvent queryset
+        :return: Number of events queued again
+        """
+        return events.filter(processed_at__isnull=True).update(attempts=0)
+
+    @classmethod
+    def apply(cls, event: Dict):
+        """
+        Apply a PaymentIntent event to its order, creating the order if this is
+        the first event seen for the PaymentIntent. An event older than the one
+        the order already reflects is ignored, and a paid order is final, so
+        out-of-order deliveries never move an order backwards. The full
+        PaymentIntent is archived in StripePayload rather than on the order.
+        terminal.reader.* events carry the full reader and update the reader
+        mirror instead.
+        """
+        event_type = event["type"]
+        if event_type.startswith("terminal.reader."):
+            StripeReaderService.store([event["data"]["object"]])
+            return
+
+        status = cls.EVENT_STATUS.get(event_type)
+        if status is None:
+            logger.info(f"Unhandled event type {event_type}")
+            return
+
+        data = event["data"]["object"]
+        occurred_at = event.get("created", 0)
+        fields = {
+            "status": status,
+            "stripe_payment_status": data["status"],
+            "currency": data.get("currency", ""),
+            "stripe_event_created": occurred_at,
+        }
+        if status == "paid":
+            fields["stripe_charge_id"] = (
+                data["charges"]["data"][0]["id"]
+                if data.get("charges", {}).get("data")
+                else None
+            )
+
+        insert_ignoring_duplicates(StripePayload, [
+            StripePayload(
+                payment_intent_id=data["id"],
+                event_id=event["id"],
+                event_type=event_type,
+                data=StripePayload.compress(data),
+            )
+        ], "event_id")
+
+        transaction.on_commit(lambda: PaymentIntentStatusService.invalidate(data["id"]))
+        # Webhook-created orders use the PaymentIntent id as their transaction id
+        transaction.on_commit(lambda: OrderStatusWaitService.notify(data["id"]))
+
+        if status == "created":
+            # Nothing to move forward on an existing order; the whole create path is one statement
+            cls._insert_missing(data, fields)
+            return
+
+        if not cls._update_if_newer(data["id"], status, occurred_at, fields):
+            # No order yet (or a newer state already applied): create it, then re-apply in
+            # case another drainer created it between the two statements
+            cls._insert_missing(data, fields)
+            cls._update_if_newer(data["id"], status, occurred_at, fields)
+
+    @staticmethod
+    def _insert_missing(data: Dict, fields: Dict):
+        """Create the PaymentIntent's order unless it exists, in one statement"""
+        metadata = data.get("metadata", {})
+        insert_ignoring_duplicates(Order, [
+            Order(
+                transaction_id=data["id"],
+                stripe_payment_intent_id=data["id"],
+                kiosk_id=metadata.get("kiosk_id"),
+                num_pictures=int(metadata.get("num_pictures", 0)),
+                price=data["amount"] / 100,  # convert cents to units
+                **fields,
+            )
+        ], "stripe_payment_intent_id")
+
+    @classmethod
+    def _update_if_newer(cls, payment_intent_id: str, status: str, occurred_at: int, fields: Dict) -> int:
+        """Apply fields unless the order already reflects a later event or is paid"""
+        # Stripe timestamps have one second resolution; within the same second the later lifecycle stage wins
+        rank = cls.STATUS_RANK[status]
+        not_newer_status = [other for other, other_rank in cls.STATUS_RANK.items() if other_rank <= rank]
+        is_newer = (
+            Q(stripe_event_created__isnull=True)
+            | Q(stripe_event_created__lt=occurred_at)
+            | Q(stripe_event_created=occurred_at, status__in=not_newer_status)
+        )
+        return (
+            Order.objects.filter(is_newer, stripe_payment_intent_id=payment_intent_id)
+            .exclude(status="paid")
+            .update(**fields)
+        )
+
+class PaymentIntentStatusService:
+    """
+    PaymentIntent status for kiosk polling, answered locally where possible.
+
+    The webhook keeps the order's Stripe status current, so a poll is served
+    from the cache, or from the order row on a cache miss. Stripe is only
+    asked when the local state has not been confirmed within
+    PAYMENT_STATUS_FRESHNESS_SECONDS and the payment is not final yet. Every
+    answer records its source and when it was last confirmed.
+    """
+    CACHE_KEY = 'payment_intent_status_{payment_intent_id}'
+    CACHE_TIMEOUT = 3600
+    FINAL_STATUSES = ('succeeded', 'canceled')
+
+    @classmethod
+    def get_status(cls, payment_intent_id: str) -> Dict:
+        """
+        :param payment_intent_id: Stripe PaymentIntent id
+        :return: Dict with id, status, amount, currency, source and checked_at
+        """
+        key = cls.CACHE_KEY.format(payment_intent_id=payment_intent_id)
+        state = cache.get(key)
+        if state and cls._is_fresh(state):
+            return dict(state, source='cache')
+
+        order = (
+            Order.objects.filter(stripe_payment_intent_id=payment_intent_id)
+            .values('stripe_payment_status', 'price', 'currency', 'updated_at')
+            .first()
+        )
+        if order and order['stripe_payment_status']:
+            state = {
+                'id': payment_intent_id,
+                'status': order['stripe_payment_status'],
+                'amount': int(order['price'] * 100),
+                'currency': order['currency'],
+                'checked_at': order['updated_at'].timestamp(),
+                'source': 'database',
+            }
+            if cls._is_fresh(state):
+                cache.set(key, state, cls.CACHE_TIMEOUT)
+                return state
+
+        intent = stripe.PaymentIntent.retrieve(payment_intent_id)
+        state = {
+            'id': intent.id,
+            'status': intent.status,
+            'amount': intent.amount,
+            'currency': intent.currency,
+            'checked_at': time.time(),
+            'source': 'stripe',
+        }
+        cache.set(key, state, cls.CACHE_TIMEOUT)
+        return state
+
+    @classmethod
+    def invalidate(cls, payment_intent_id: str):
+        cache.delete(cls.CACHE_KEY.format(payment_intent_id=payment_intent_id))
+
+    @classmethod
+    def _is_fresh(cls, state: Dict) -> bool:
+        return (
+            state['status'] in cls.FINAL_STATUSES
+            or time.time() - state['checked_at'] < settings.PAYMENT_STATUS_FRESHNESS_SECONDS
+        )
+
+class OrderStatusWaitService:
+    """
+    Long-poll support for kiosks waiting on an order's status.
+
+    The current status of each order is kept in the cache. Whatever changes an
+    order calls notify(), which drops the entry; waiters only watch the cache
+    and read the order row again once their entry is gone. The entry also
+    expires after one poll interval, so a change is seen within about
+    PAYMENT_STATUS_WAIT_INTERVAL even when notify() runs in a process that
+    does not share this one's cache (e.g. LocMemCache and the webhook worker).
+    With a shared cache, all waiters on an order cost one indexed read per
+    interval between them.
+    """
+    CACHE_KEY = 'order_status_{transaction_id}'
+
+    @classmethod
+    async def wait(cls, transaction_id: str, since: Optional[str], timeout: float) -> Optional[Dict]:
+        """
+        Wait until the order's status differs from since, or timeout seconds pass
+        :param transaction_id: Order transaction id
+        :param since: Status the caller last saw; None answers right away
+        :param timeout: Longest time to hold the request, in seconds
+        :return: Dict with status and changed, or None if there is no such order
+        """
+        key = cls.CACHE_KEY.format(transaction_id=transaction_id)
+        deadline = time.monotonic() + timeout
+        while True:
+            current = await cache.aget(key)
+            if current is None:
+                current = await (
+                    Order.objects.filter(transaction_id=transaction_id)
+                    .values_list('status', flat=True)
+                    .afirst()
+                )
+                if current is None:
+                    return None
+                await cache.aset(key, current, cls._cache_timeout())
+
+            remaining = deadline - time.monotonic()
+            if since is None or current != since or remaining <= 0:
+                return {'status': current, 'changed': since is not None and current != since}
+            await asyncio.sleep(min(settings.PAYMENT_STATUS_WAIT_INTERVAL, remaining))
+
+    @classmethod
+    def notify(cls, transaction_id: str):
+        cache.delete(cls.CACHE_KEY.format(transaction_id=transaction_id))
+
+    @staticmethod
+    def _cache_timeout() -> int:
+        # Cache backends take whole seconds; a timeout of 0 means "do not store" on some of them
+        return max(math.ceil(settings.PAYMENT_STATUS_WAIT_INTERVAL), 1)
+
+class IdempotencyService:
+    """
+    Replay of responses to requests retried with the same Idempotency-Key.
+
+    The first request with a key claims it with cache.add, so of several
+    concurrent attempts only one goes on to do the work. Its response is then
+    kept for IDEMPOTENCY_KEY_TTL_SECONDS and handed back to retries, which
+    must carry the same request data. A claim whose request failed is
+    released so the client can try again.
+    """
+    CACHE_KEY = 'idempotency_{scope}_{key}'
+    # How long a claim blocks retries if its worker dies before finishing
+    CLAIM_TIMEOUT = 60
+
+    @classmethod
+    def fingerprint(cls, data: Dict) -> str:
+        return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+    @classmethod
+    async def claim(cls, scope: str, key: str, fingerprint: str) -> Optional[Dict]:
+        """
+        Claim an idempotency key for a request
+        :param scope: Endpoint the key belongs to
+        :param key: Client supplied Idempotency-Key
+        :param fingerprint: fingerprint() of the request data
+        :return: None if the caller now owns the key, otherwise the stored entry,
+                 whose status is None while the first request is still running
+        """
+        cache_key = cls._cache_key(scope, key)
+        claim = {'fingerprint': fingerprint, 'status': None, 'body': None}
+        if await cache.aadd(cache_key, claim, cls.CLAIM_TIMEOUT):
+            return None
+        # The claim may have been released between add and get
+        return await cache.aget(cache_key) or claim
+
+    @classmethod
+    async def complete(cls, scope: str, key: str, fingerprint: str, status_code: int, body: Dict):
+        await cache.aset(
+            cls._cache_key(scope, key),
+            {'fingerprint': fingerprint, 'status': status_code, 'body': body},
+            settings.IDEMPOTENCY_KEY_TTL_SECONDS,
+        )
+
+    @classmethod
+    async def release(cls, scope: str, key: str):
+        await cache.adelete(cls._cache_key(scope, key))
+
+    @classmethod
+    def _cache_key(cls, scope: str, key: str) -> str:
+        # Client keys may hold characters or lengths the cache backend does not accept
+        return cls.CACHE_KEY.format(scope=scope, key=hashlib.sha256(key.encode()).hexdigest())
+
+class StripeReaderService:
+    """
+    Local mirror of the account's Stripe Terminal readers.
+
+    Reader endpoints answer from ReaderDevice rows, cached as one dict, instead
+    of calling Stripe. The mirror is filled by sync() (auto-paging through all
+    readers and their locations; run periodically with sync_stripe_readers),
+    by terminal.reader.* webhook events and by live refreshes. Writes are
+    native upserts on reader_id and bypass ReaderDevice.save, which registers
+    new readers with Stripe.
+    """
+    CACHE_KEY = 'stripe_reader_mirror'
+    CACHE_TIMEOUT = 3600
+    READER_FIELDS = ['name', 'device_type', 'status', 'stripe_location_id', 'stripe_object', 'synced_at']
+    LOCATION_FIELDS = ['country', 'city', 'state', 'address', 'postalCode']
+
+    @classmethod
+    def list_readers(cls) -> List[Dict]:
+        return list(cls._mirror().values())
+
+    @classmethod
+    def get_reader(cls, reader_id: str) -> Optional[Dict]:
+        return cls._mirror().get(reader_id)
+
+    @classmethod
+    def _mirror(cls) -> Dict[str, Dict]:
+        mirror = cache.get(cls.CACHE_KEY)
+        if mirror is None:
+            mirror = dict(
+                ReaderDevice.objects.exclude(stripe_object=None)
+                .order_by('registered_at', 'id')
+                .values_list('reader_id', 'stripe_object')
+            )
+            cache.set(cls.CACHE_KEY, mirror, cls.CACHE_TIMEOUT)
+        return mirror
+
+    @classmethod
+    def invalidate(cls):
+        cache.delete(cls.CACHE_KEY)
+
+    @classmethod
+    def sync(cls) -> Dict:
+        """
+        Mirror every reader of the account and drop readers deleted in Stripe.
+
+        Only rows last written before the listing started are dropped; a reader
+        registered or updated by a webhook while paging may be missing from it.
+        :return: Dict with readers and removed counts
+        """
+        started = timezone.now()
+        locations = {
+            location["id"]: location
+            for location in stripe.terminal.Location.list(limit=100).auto_paging_iter()
+        }
+        readers = list(stripe.terminal.Reader.list(limit=100).auto_paging_iter())
+
+        cls.store(readers, locations)
+        removed, _ = (
+            ReaderDevice.objects.exclude(reader_id__in=[reader["id"] for reader in readers])
+            .filter(Q(synced_at__isnull=True) | Q(synced_at__lt=started), registered_at__lt=started)
+            .delete()
+        )
+        cls.invalidate()
+
+        logger.info(f"Synced {len(readers)} Stripe readers, removed {removed}")
+        return {"readers": len(readers), "removed": removed}
+
+    @classmethod
+    def refresh_reader(cls, reader_id: str) -> Dict:
+        """Read one reader live from Stripe and update the mirror"""
+        reader = stripe.terminal.Reader.retrieve(reader_id)
+        cls.store([reader])
+        return cls.get_reader(reader_id)
+
+    @classmethod
+    def store(cls, readers, locations: Optional[Dict] = None):
+        """
+        Upsert Stripe reader objects into the mirror
+        :param readers: Reader objects from the API or from webhook payloads
+        :param locations: Location objects by id; the address columns are left alone when omitted
+        """
+        now = timezone.now()
+        rows = []
+        for reader in readers:
+            if isinstance(reader, stripe.StripeObject):
+                reader = reader.to_dict_recursive()
+            location_id = reader.get("location")
+            if isinstance(location_id, dict):
+                location_id = location_id.get("id")
+            address = ((locations or {}).get(location_id) or {}).get("address") or {}
+            rows.append(ReaderDevice(
+                reader_id=reader["id"],
+                name=(reader.get("label") or reader["id"])[:100],
+                device_type=reader.get("device_type") or "",
+                status=reader.get("status") or "",
+                stripe_location_id=location_id,
+                stripe_object=reader,
+                synced_at=now,
+                country=address.get("country") or "",
+                city=address.get("city") or "",
+                state=address.get("state") or "",
+                address=address.get("line1") or "",
+                postalCode=address.get("postal_code") or "",
+            ))
+
+        update_fields = cls.READER_FIELDS + (cls.LOCATION_FIELDS if locations is not None else [])
+        ReaderDevice.objects.bulk_create(
+            rows, update_conflicts=True, unique_fields=["reader_id"], update_fields=update_fields,
+        )
+        cls.invalidate()
+
+class StripeReconciliationService:
+    """
+    Repairs orders whose Stripe webhooks were missed.
+
+    Pages through the PaymentIntents created since the stored watermark,
+    diffs them in chunks against their orders (one query per chunk) and
+    writes the corrections with bulk_update; orders never seen by a webhook
+    are created. Paid orders are final, as in StripeWebhookService. The
+    watermark then moves to the start of the run minus
+    STRIPE_RECONCILE_OVERLAP_SECONDS, so payments still in flight are
+    checked again by the next run.
+    """
+    WATERMARK = 'stripe_reconciliation'
+    UPDATE_FIELDS = ['status', 'stripe_payment_status', 'stripe_charge_id', 'currency', 'stripe_event_created', 'updated_at']
+
+    @classmethod
+    def run(cls, since: Optional[int] = None, chunk_size: int = 500, dry_run: bool = False) -> Dict:
+        """
+        :param since: Unix timestamp to start from instead of the watermark
+        :param chunk_size: PaymentIntents diffed and written per batch
+        :param dry_run: Count the corrections without writing them or moving the watermark
+        :return: Dict with seen, created, corrected and since
+        """
+        started = int(time.time())
+        if since is None:
+            watermark = SyncWatermark.objects.filter(name=cls.WATERMARK).values_list('value', flat=True).first()
+            since = watermark if watermark is not None else started - settings.STRIPE_RECONCILE_LOOKBACK_HOURS * 3600
+
+        result = {'since': since, 'seen': 0, 'created': 0, 'corrected': 0}
+        intents = stripe.PaymentIntent.list(created={'gte': since}, limit=100).auto_paging_iter()
+        for chunk in iter(lambda: list(itertools.islice(intents, chunk_size)), []):
+            created, corrected = cls._reconcile_chunk(chunk, started, dry_run)
+            result['seen'] += len(chunk)
+            result['created'] += created
+            result['corrected'] += corrected
+
+        if not dry_run:
+            SyncWatermark.objects.update_or_create(
+                name=cls.WATERMARK,
+                defaults={'value': started - settings.STRIPE_RECONCILE_OVERLAP_SECONDS},
+            )
+        logger.info(f"Stripe reconciliation since {since}: {result}")
+        return result
+
+    @classmethod
+    def _reconcile_chunk(cls, intents: List, checked_at: int, dry_run: bool):
+        orders = Order.objects.in_bulk([intent['id'] for intent in intents], field_name='stripe_payment_intent_id')
+        now = timezone.now()
+        missing, changed = [], []
+
+        for intent in intents:
+            fields = cls._order_fields(intent)
+            order = orders.get(intent['id'])
+            if order is None:
+                if fields.get('status') and (intent.get('metadata') or {}).get('kiosk_id'):
+                    metadata = intent['metadata']
+                    missing.append(Order(
+                        transaction_id=intent['id'],
+                        stripe_payment_intent_id=intent['id'],
+                        kiosk_id=metadata['kiosk_id'],
+                        num_pictures=int(metadata.get('num_pictures') or 0),
+                        price=intent['amount'] / 100,  # convert cents to units
+                        stripe_event_created=checked_at,
+                        **fields,
+                    ))
+                continue
+
+            if order.status == 'paid':
+                fields.pop('status', None)
+            if all(getattr(order, name) == value for name, value in fields.items()):
+                continue
+            for name, value in fields.items():
+                setattr(order, name, value)
+            # Later webhooks for events older than this check must not undo it
+            order.stripe_event_created = max(order.stripe_event_created or 0, checked_at)
+            order.updated_at = now
+            changed.append(order)
+
+        if not dry_run and (missing or changed):
+            with transaction.atomic():
+                insert_ignoring_duplicates(Order, missing, "stripe_payment_intent_id")
+                Order.objects.bulk_update(changed, cls.UPDATE_FIELDS)
+            for order in itertools.chain(missing, changed):
+                PaymentIntentStatusService.invalidate(order.stripe_payment_intent_id)
+                OrderStatusWaitService.notify(order.transaction_id)
+        return len(missing), len(changed)
+
+    @staticmethod
+    def _order_fields(intent) -> Dict:
+        """Order fields implied by a PaymentIntent's current state"""
+        fields = {'stripe_payment_status': intent['status'], 'currency': intent.get('currency') or ''}
+        if intent['status'] == 'succeeded':
+            fields['status'] = 'paid'
+            charges = (intent.get('charges') or {}).get('data') or []
+            fields['stripe_charge_id'] = charges[0]['id'] if charges else intent.get('latest_charge')
+        elif intent['status'] == 'processing':
+            fields['status'] = 'processing'
+        elif intent['status'] == 'requires_payment_method':
+            fields['status'] = 'failed' if intent.get('last_payment_error') else 'created'
+        return fields
+
 class PayPalService:
     def __init__(self):
-        paypalrestsdk.configure({
-            "mode": settings.PAYPAL_MODE,
-            "client_id": settings.PAYPAL_CLIENT_ID,
-            "client_secret": settings.PAYPAL_CLIENT_SECRET
-        })
+        # Configured once per process, on the shared keep-alive session
+        self.api = paypal_api()
 
     def create_payment(self, transaction_id, kiosk_id, price, num_pictures):
         # Create an order in the database
@@ -222,7 +1919,7 @@ class PayPalService:
                 },
                 "description": f"Payment for kiosk {kiosk_id}"
             }]
-        })
+        }, api=self.api)
 
         if payment.create():
             order.paypal_payment_id = payment.id
@@ -234,10 +1931,14 @@ class PayPalService:
             return None
 
     def execute_payment(self, payment_id, payer_id):
-        payment = paypalrestsdk.Payment.find(payment_id)
+        payment = paypalrestsdk.Payment.find(payment_id, api=self.api)
         if payment.execute({"payer_id": payer_id}):
             logger.info(f"Payment executed successfully for payment ID {payment_id}")
             return payment
         else:
             logger.error(f"Error while executing payment: {payment.error}")
-            return None
\ No newline at end of file
+            return None
+
+
+# Process-wide PayPal service; its client and cached token are shared by every request
+paypal_service = PayPalService()
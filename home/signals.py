@@ -0,0 +1,32 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import CardImage, Order, ReaderDevice
+from .services import CardCatalogService, CardRenditionService, OrderStatusWaitService, StripeReaderService
+
+
+@receiver(post_save, sender=CardImage)
+def record_card_saved(sender, instance, **kwargs):
+    CardCatalogService.record_change(instance)
+    CardCatalogService.refresh_state()
+    if instance.image:
+        CardRenditionService.schedule(instance.pk)
+
+
+@receiver(post_delete, sender=CardImage)
+def record_card_deleted(sender, instance, **kwargs):
+    CardCatalogService.record_change(instance, deleted=True)
+    CardCatalogService.refresh_state()
+
+
+@receiver(post_save, sender=ReaderDevice)
+@receiver(post_delete, sender=ReaderDevice)
+def invalidate_reader_mirror(sender, instance, **kwargs):
+    StripeReaderService.invalidate()
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Order)
+def notify_order_status_waiters(sender, instance, **kwargs):
+    transaction.on_commit(lambda: OrderStatusWaitService.notify(instance.transaction_id))
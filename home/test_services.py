@@ -1,8 +1,27 @@
-from django.test import TestCase
+from django.apps import apps
+from django.test import TestCase, override_settings
 from django.core.cache import cache
-from home.services import ImageUploadService
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from home.models import CardChange, CardImage
+from home import http_client
+from home.services import CardCatalogService, CardImportService, ImageUploadService, InstagramRateLimiter, InstagramService, _CacheLock
+from PIL import Image
+from requests.adapters import HTTPAdapter
+from requests.models import Response
+import paypalrestsdk
+import stripe
 import base64
+import hashlib
+import importlib
+import io
+import os
+import shutil
+import tempfile
+import time
 import uuid
+import zipfile
+from unittest.mock import patch
 
 class TestImageUploadService(TestCase):
     def setUp(self):
@@ -94,4 +113,290 @@ class TestImageUploadService(TestCase):
             self.kiosk_uuid,
             self.image_uuid
         )
-        self.assertIsNone(result) 
\ No newline at end of file
+        self.assertIsNone(result)
+
+
+class FakeClock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@override_settings(
+    INSTAGRAM_REQUESTS_PER_MINUTE=60,
+    INSTAGRAM_BURST=5,
+    INSTAGRAM_BACKGROUND_RESERVE=2,
+    INSTAGRAM_BACKOFF_BASE_SECONDS=10,
+    INSTAGRAM_BACKOFF_MAX_SECONDS=25,
+)
+class TestInstagramRateLimiter(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.clock = FakeClock()
+        self.limiter = InstagramRateLimiter(clock=self.clock)
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_bucket_drains_and_refills(self):
+        """Test that tokens are consumed and refilled over time"""
+        for _ in range(5):
+            self.assertTrue(self.limiter.acquire(timeout=0))
+        self.assertFalse(self.limiter.acquire(timeout=0))
+
+        self.clock.now += 2
+        self.assertTrue(self.limiter.acquire(timeout=0))
+        self.assertEqual(self.limiter.snapshot()['granted_total'], 6)
+
+    def test_background_keeps_reserve_for_live(self):
+        """Test that background requests leave the reserve to live kiosks"""
+        background = InstagramRateLimiter.PRIORITY_BACKGROUND
+        for _ in range(3):
+            self.assertTrue(self.limiter.acquire(background, timeout=0))
+        self.assertFalse(self.limiter.acquire(background, timeout=0))
+        self.assertTrue(self.limiter.acquire(timeout=0))
+
+    def test_backoff_is_exponential_and_capped(self):
+        """Test backoff after rate limit responses"""
+        self.limiter.record_rate_limit()
+        self.assertEqual(self.limiter.snapshot()['backoff_remaining_seconds'], 10)
+        self.limiter.record_rate_limit()
+        self.assertEqual(self.limiter.snapshot()['backoff_remaining_seconds'], 20)
+        self.limiter.record_rate_limit()
+        self.assertEqual(self.limiter.snapshot()['backoff_remaining_seconds'], 25)
+        self.assertFalse(self.limiter.acquire(timeout=0))
+
+        started = time.monotonic()
+        self.assertFalse(self.limiter.acquire(timeout=5))
+        self.assertLess(time.monotonic() - started, 1)  # no waiting out a backoff longer than the timeout
+
+        self.clock.now += 30
+        self.assertTrue(self.limiter.acquire(timeout=0))
+        self.limiter.record_success()
+        self.assertEqual(self.limiter.snapshot()['backoff_level'], 0)
+
+
+    def test_lock_release_keeps_a_takeover(self):
+        """Test that a holder whose lock was taken over as stale leaves the new holder's lock alone"""
+        stale = _CacheLock(InstagramRateLimiter.LOCK_KEY, 0.1)
+        stale.__enter__()
+        with _CacheLock(InstagramRateLimiter.LOCK_KEY, 0.1) as current:
+            stale.__exit__(None, None, None)
+            self.assertEqual(cache.get(InstagramRateLimiter.LOCK_KEY), current.token)
+        self.assertIsNone(cache.get(InstagramRateLimiter.LOCK_KEY))
+
+
+class FakePost:
+    url = 'https://cdn.example.com/full.jpg'
+
+    def __init__(self, resources):
+        self._node = {'display_resources': resources}
+
+
+class TestInstagramImageSelection(TestCase):
+    def setUp(self):
+        self.post = FakePost([
+            {'src': 'https://cdn.example.com/1080.jpg', 'config_width': 1080, 'config_height': 1080},
+            {'src': 'https://cdn.example.com/640.jpg', 'config_width': 640, 'config_height': 640},
+            {'src': 'https://cdn.example.com/750.jpg', 'config_width': 750, 'config_height': 750},
+        ])
+
+    def test_smallest_rendition_meeting_target(self):
+        """Test that the smallest sufficient rendition is chosen"""
+        self.assertEqual(InstagramService.select_image_url(self.post, 320), 'https://cdn.example.com/640.jpg')
+        self.assertEqual(InstagramService.select_image_url(self.post, 700), 'https://cdn.example.com/750.jpg')
+
+    def test_largest_rendition_when_target_exceeds_all(self):
+        """Test fallback to the largest rendition"""
+        self.assertEqual(InstagramService.select_image_url(self.post, 2000), 'https://cdn.example.com/1080.jpg')
+
+    def test_full_resolution_without_target(self):
+        """Test that no target keeps the full resolution image"""
+        self.assertEqual(InstagramService.select_image_url(self.post), FakePost.url)
+        self.assertEqual(InstagramService.select_image_url(FakePost([]), 320), FakePost.url)
+
+    def test_missing_node_falls_back_to_full_resolution(self):
+        """Test that a post without the private node data still yields an image URL"""
+        post = FakePost([])
+        del post._node
+        self.assertEqual(InstagramService.select_image_url(post, 320), FakePost.url)
+
+    def test_widths_share_a_bucket_per_rendition(self):
+        """Test that requested widths round up to the rendition Instagram serves for them"""
+        self.assertEqual([InstagramService.width_bucket(width) for width in (1, 2, 640)], [640, 640, 640])
+        self.assertEqual(InstagramService.width_bucket(700), 750)
+        self.assertEqual(InstagramService.width_bucket(5000), 1080)
+        self.assertIsNone(InstagramService.width_bucket(None))
+
+
+class TestCardImportService(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root, CARD_RENDITIONS_ASYNC=False)
+        self.settings_override.enable()
+        cache.clear()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+        cache.clear()
+
+    def image_bytes(self, color):
+        buffer = io.BytesIO()
+        Image.new('RGB', (40, 60), color).save(buffer, 'PNG')
+        return buffer.getvalue()
+
+    def write_source(self, name, content):
+        path = os.path.join(self.media_root, name)
+        with open(path, 'wb') as source:
+            source.write(content)
+        return path
+
+    def test_zip_import_in_batches(self):
+        """Test that a zip is imported in bulk batches with one change per new card"""
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as archive:
+            for index in range(5):
+                archive.writestr(f'cards/{index}.png', self.image_bytes((index * 40, 0, 0)))
+            archive.writestr('cards/duplicate.png', self.image_bytes((0, 0, 0)))
+            archive.writestr('cards/broken.png', b'not an image')
+            archive.writestr('readme.txt', b'ignored')
+        path = self.write_source('cards.zip', buffer.getvalue())
+
+        reports = []
+        with self.settings(CARD_RENDITION_WIDTHS=[20]), patch.object(CardImportService, 'BATCH_SIZE', 3), \
+                patch.object(CardCatalogService, 'refresh_state', wraps=CardCatalogService.refresh_state) as refresh_state:
+            progress = CardImportService.run(path, on_progress=lambda progress: reports.append(progress['processed']))
+        # One catalog refresh per batch of renditions and one for the import, not one per card
+        self.assertEqual(refresh_state.call_count, 3)
+        self.assertEqual(CardImportService.get_progress(progress['id']), progress)
+
+        self.assertEqual(progress['status'], 'done')
+        self.assertEqual((progress['created'], progress['skipped'], progress['failed']), (5, 1, 1))
+        self.assertEqual(reports, [3, 6, 7, 7])
+        self.assertTrue(progress['errors'][0].startswith('cards/broken.png'))
+
+        cards = list(CardImage.objects.all())
+        self.assertEqual(len(cards), 5)
+        for card in cards:
+            self.assertEqual(card.image.name, f'cards/{card.image_hash}.png')
+            self.assertTrue(default_storage.exists(card.image.name))
+            self.assertEqual(card.renditions.count(), 2)
+        # Each card is announced once when inserted and once more when its renditions exist
+        self.assertEqual(CardChange.objects.filter(action='upsert').count(), 10)
+        self.assertEqual(CardCatalogService.get_state()['etag'], CardCatalogService.refresh_state()['etag'])
+
+    def test_csv_import_skips_existing_content(self):
+        """Test that CSV rows are read from media and content already in the catalog is skipped"""
+        default_storage.save('uploads/a.png', ContentFile(self.image_bytes((255, 0, 0))))
+        default_storage.save('uploads/b.png', ContentFile(self.image_bytes((0, 255, 0))))
+        path = self.write_source('cards.csv', b'image_path,is_enabled\nuploads/a.png,True\nuploads/b.png,False\nuploads/missing.png,True\n')
+
+        progress = CardImportService.run(path)
+        self.assertEqual((progress['created'], progress['skipped'], progress['failed']), (2, 0, 1))
+        self.assertEqual(CardImage.objects.filter(is_enabled=False).count(), 1)
+
+        progress = CardImportService.run(path)
+        self.assertEqual((progress['created'], progress['skipped']), (0, 2))
+        self.assertEqual(CardImage.objects.count(), 2)
+
+
+    def test_backfill_moves_legacy_cards_to_content_hash_paths(self):
+        """Test that the data migration hashes cards stored before content addressing and announces the new URL"""
+        content = self.image_bytes((0, 0, 255))
+        card = CardImage.objects.create(image=ContentFile(content, name='legacy.png'))
+        legacy_path = default_storage.save(f'cards/{card.id}.png', ContentFile(content))
+        CardImage.objects.filter(pk=card.pk).update(image=legacy_path, image_hash='')
+        card.refresh_from_db()
+        version, changes = card.version, CardChange.objects.count()
+
+        importlib.import_module('home.migrations.0024_backfill_card_image_hash').backfill_image_hash(apps, None)
+
+        card.refresh_from_db()
+        self.assertEqual(card.image_hash, hashlib.sha256(content).hexdigest())
+        self.assertEqual(card.image.name, f'cards/{card.image_hash}.png')
+        self.assertEqual(card.version, version + 1)
+        self.assertEqual(CardChange.objects.count(), changes + 1)
+        self.assertTrue(default_storage.exists(legacy_path))
+
+class TestOutboundHttpClient(TestCase):
+    def setUp(self):
+        http_client.outbound_stats.reset()
+
+    def fake_send(self, status_code):
+        def send(adapter, request, **kwargs):
+            self.sent.append(kwargs)
+            response = Response()
+            response.status_code = status_code
+            response.url = request.url
+            response.request = request
+            response._content = b'{}'
+            return response
+        self.sent = []
+        return send
+
+    def test_default_timeouts_and_stats(self):
+        """Test that calls get explicit timeouts and are timed per host"""
+        with patch.object(HTTPAdapter, 'send', self.fake_send(200)):
+            http_client.session.get('https://api.stripe.com/v1/readers')
+            http_client.session.get('https://api.stripe.com/v1/readers', timeout=5)
+        with patch.object(HTTPAdapter, 'send', self.fake_send(503)):
+            http_client.session.post('https://api.sandbox.paypal.com/v1/oauth2/token')
+
+        self.assertEqual(self.sent[0]['timeout'], (3.05, 30))
+        stats = http_client.outbound_stats.snapshot()
+        self.assertEqual((stats['api.stripe.com']['calls'], stats['api.stripe.com']['errors']), (2, 0))
+        self.assertEqual((stats['api.sandbox.paypal.com']['calls'], stats['api.sandbox.paypal.com']['errors']), (1, 1))
+
+    def test_connections_are_pooled_per_host(self):
+        """Test that one adapter with a keep-alive pool and jittered retries serves all hosts"""
+        adapter = http_client.session.get_adapter('https://api.stripe.com')
+        self.assertIs(adapter, http_client.session.get_adapter('https://api-m.paypal.com'))
+        self.assertEqual(adapter._pool_maxsize, 10)
+        self.assertEqual(adapter.max_retries.total, 2)
+        self.assertGreater(adapter.max_retries.backoff_jitter, 0)
+
+    def test_sdks_use_shared_session(self):
+        """Test that Stripe and PayPal send their requests through the shared session"""
+        self.assertIs(stripe.default_http_client._session, http_client.stripe_session)
+        # Stripe retries failed responses itself, so its adapter only retries connections that never opened
+        retry = http_client.stripe_session.get_adapter('https://api.stripe.com').max_retries
+        self.assertEqual((retry.connect, retry.read, retry.status, retry.status_forcelist), (None, 0, 0, set()))
+
+        api = http_client.paypal_api()
+        self.assertIs(http_client.paypal_api(), api)
+        self.assertIs(paypalrestsdk.api.default(), api)
+        with patch.object(HTTPAdapter, 'send', self.fake_send(200)):
+            api.http_call('https://api.sandbox.paypal.com/v1/payments/payment/PAY-1', 'GET', headers={})
+        self.assertEqual(http_client.outbound_stats.snapshot()['api.sandbox.paypal.com']['calls'], 1)
+
+    def test_paypal_token_shared_and_refreshed_early(self):
+        """Test that the PayPal access token is fetched once for all workers and replaced before it expires"""
+        cache.clear()
+        self.addCleanup(cache.clear)
+        tokens = iter(['A1', 'A2', 'A3'])
+
+        def http_call(api, url, method, **kwargs):
+            self.assertTrue(url.endswith('/v1/oauth2/token'))
+            return {'access_token': next(tokens), 'token_type': 'Bearer', 'expires_in': 32400}
+
+        # Two instances stand in for two worker processes sharing the cache
+        first, second = (
+            http_client.PooledPayPalApi(mode='sandbox', client_id='id', client_secret='secret') for _ in range(2)
+        )
+        with patch.object(http_client.PooledPayPalApi, 'http_call', http_call):
+            self.assertEqual(first.get_access_token(), 'A1')
+            self.assertEqual(second.get_access_token(), 'A1')
+            self.assertEqual(first.headers()['Authorization'], 'Bearer A1')
+
+            # Replaced PAYPAL_TOKEN_REFRESH_MARGIN_SECONDS before PayPal would expire it
+            with patch('home.http_client.time.time', return_value=time.time() + 32400 - 299):
+                self.assertEqual(second.get_access_token(), 'A2')
+
+            # A token PayPal rejected (the SDK then drops it) is not handed to other workers
+            second.token_hash = None
+            self.assertEqual(second.get_access_token(), 'A3')
+            first.token_hash = None
+            self.assertEqual(first.get_access_token(), 'A3')
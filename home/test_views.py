@@ -1,12 +1,41 @@
-from django.test import TestCase, Client
+from django.test import TestCase, TransactionTestCase, Client, RequestFactory, override_settings
+from django.http import HttpResponse
+from django.contrib.auth.models import User
 from django.urls import reverse
 from django.core.cache import cache
+from django.core.management import call_command
+from django.core.handlers.asgi import ASGIHandler
+from django.db import OperationalError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test.utils import CaptureQueriesContext
 from rest_framework.test import APIClient
-from home.models import KioskClient, KioskHealthCheck
+from home.models import KioskClient, KioskConfiguration, KioskHealthCheck, CardChange, CardImage, Order, ReaderDevice, StripePayload, StripeWebhookEvent, SyncWatermark
+from home.http_client import PooledPayPalApi
+from home.middleware.media_cache import ImmutableMediaMiddleware
+from home.payment_fakes import FakePaymentProviders
+from home.views import CardArchiveAPI, ThreadedFileResponse
+from home.services import CardCatalogService, CardMediaService, CardRenditionService, CardSpriteService, OrderStatusWaitService, StripeReaderService, StripeReconciliationService, StripeWebhookService, insert_ignoring_duplicates
+import asyncio
+import hashlib
+import hmac
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
 import uuid
+from PIL import Image
 import base64
+import stripe
 import json
+import paypalrestsdk
+from unittest.mock import MagicMock, patch
+from django.core.files.storage import default_storage
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.utils import timezone
+from datetime import timedelta
 
 class TestImageUploadViews(TestCase):
     def setUp(self):
@@ -163,4 +192,1008 @@ class TestKioskHealthCheckView(TestCase):
         response = self.client.get('/api/health/', **self.auth_headers)
         
         self.assertEqual(response.status_code, 401)
-  
\ No newline at end of file
+
+
+class TestCardImageAPI(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(
+            MEDIA_ROOT=self.media_root,
+            CARD_RENDITIONS_ASYNC=False,
+            CARD_RENDITION_WIDTHS=[320, 640, 1280],
+            CARD_CHANGES_SETTLE_SECONDS=0,
+        )
+        self.settings_override.enable()
+        cache.clear()
+
+        self.client = APIClient()
+        self.kiosk = KioskClient.objects.create(login_name='test_kiosk')
+        self.kiosk.set_password('test_password')
+        self.kiosk.save()
+
+        credentials = base64.b64encode(b'test_kiosk:test_password').decode()
+        self.auth_headers = {'HTTP_AUTHORIZATION': f'Basic {credentials}'}
+
+        self.card = self.create_card()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+        cache.clear()
+
+    def create_card(self, is_enabled=True, content=b'card_image_content'):
+        return CardImage.objects.create(
+            image=SimpleUploadedFile('card.jpg', content, content_type='image/jpeg'),
+            is_enabled=is_enabled,
+        )
+
+    def image_bytes(self, size=(800, 600)):
+        buffer = io.BytesIO()
+        Image.new('RGB', size, (200, 30, 30)).save(buffer, 'PNG')
+        return buffer.getvalue()
+
+    def test_list_returns_etag(self):
+        """Test that the catalog is returned with validators"""
+        response = self.client.get('/api/cards/', **self.auth_headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('ETag', response)
+        self.assertIn('Last-Modified', response)
+        data = json.loads(response.content)
+        self.assertEqual([card['id'] for card in data['cards']], [str(self.card.id)])
+
+    def test_if_none_match_returns_not_modified(self):
+        """Test that an unchanged catalog is answered with 304 without catalog queries"""
+        etag = self.client.get('/api/cards/', **self.auth_headers)['ETag']
+
+        # Only the kiosk authentication lookup and last_login update remain
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/cards/', HTTP_IF_NONE_MATCH=etag, **self.auth_headers)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_etag_changes_on_save_and_delete(self):
+        """Test that card changes produce a new catalog version"""
+        first = self.client.get('/api/cards/', **self.auth_headers)['ETag']
+
+        new_card = self.create_card()
+        second = self.client.get('/api/cards/', HTTP_IF_NONE_MATCH=first, **self.auth_headers)
+        self.assertEqual(second.status_code, 200)
+        self.assertNotEqual(second['ETag'], first)
+        self.assertEqual(len(json.loads(second.content)['cards']), 2)
+
+        new_card.delete()
+        third = self.client.get('/api/cards/', HTTP_IF_NONE_MATCH=second['ETag'], **self.auth_headers)
+        self.assertEqual(third.status_code, 200)
+        self.assertEqual(len(json.loads(third.content)['cards']), 1)
+
+    def test_updates_diff(self):
+        """Test that the version diff reports updated, new and removed cards"""
+        new_card = self.create_card()
+        disabled_card = self.create_card(is_enabled=False)
+        self.card.save()  # bump to a newer version than the kiosk holds
+
+        versions = {
+            str(self.card.id): 1,
+            str(disabled_card.id): disabled_card.version,
+            str(uuid.uuid4()): 1,
+            'not-a-uuid': 1,
+        }
+        # Kiosk authentication plus a single catalog query and its renditions
+        with self.assertNumQueries(4):
+            response = self.client.post(
+                '/api/cards/updates/', {'versions': json.dumps(versions)}, format='json', **self.auth_headers
+            )
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([card['id'] for card in data['updates']], [str(self.card.id)])
+        self.assertEqual([card['id'] for card in data['new']], [str(new_card.id)])
+        self.assertCountEqual(data['removed'], list(versions)[1:])
+
+    def test_updates_invalid_format(self):
+        """Test that malformed version maps are rejected"""
+        response = self.client.post(
+            '/api/cards/updates/', {'versions': 'not json'}, format='json', **self.auth_headers
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_changes_feed(self):
+        """Test that the change feed returns only mutations after the cursor"""
+        cursor = self.client.get('/api/cards/', **self.auth_headers)['X-Card-Cursor']
+
+        new_card = self.create_card()
+        self.card.is_enabled = False
+        self.card.save()
+
+        response = self.client.get('/api/cards/changes/', {'since': cursor}, **self.auth_headers)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertFalse(data['has_more'])
+        actions = {change['card_id']: change['action'] for change in data['changes']}
+        self.assertEqual(actions, {str(new_card.id): 'upsert', str(self.card.id): 'disable'})
+
+        deleted_id = str(new_card.id)
+        new_card.delete()
+        response = self.client.get('/api/cards/changes/', {'since': data['next_cursor']}, **self.auth_headers)
+        changes = response.json()['changes']
+        self.assertEqual([(change['card_id'], change['action'], change['card']) for change in changes],
+                         [(deleted_id, 'delete', None)])
+
+    @override_settings(CARD_CHANGES_SETTLE_SECONDS=5)
+    def test_changes_feed_waits_for_earlier_changes_to_settle(self):
+        """Test that the feed never moves past a change whose seq an uncommitted change could precede"""
+        CardChange.objects.update(created_at=timezone.now() - timedelta(minutes=1))
+        settled = self.client.get('/api/cards/changes/', {'since': 0}, **self.auth_headers).json()
+
+        new_card = self.create_card()
+        data = self.client.get('/api/cards/changes/', {'since': settled['next_cursor']}, **self.auth_headers).json()
+        self.assertEqual((data['changes'], data['next_cursor']), ([], settled['next_cursor']))
+
+        CardChange.objects.update(created_at=timezone.now() - timedelta(minutes=1))
+        data = self.client.get('/api/cards/changes/', {'since': settled['next_cursor']}, **self.auth_headers).json()
+        self.assertEqual([change['card_id'] for change in data['changes']], [str(new_card.id)])
+
+    def test_changes_feed_pagination(self):
+        """Test that the change feed is paginated by cursor"""
+        for _ in range(3):
+            self.create_card()
+
+        response = self.client.get('/api/cards/changes/', {'since': 0, 'limit': 2}, **self.auth_headers)
+        data = response.json()
+        self.assertTrue(data['has_more'])
+
+        seen = [change['seq'] for change in data['changes']]
+        while data['has_more']:
+            data = self.client.get(
+                '/api/cards/changes/', {'since': data['next_cursor'], 'limit': 2}, **self.auth_headers
+            ).json()
+            seen += [change['seq'] for change in data['changes']]
+        self.assertEqual(seen, sorted(seen))
+        self.assertEqual(len(set(seen)), len(seen))
+
+    def test_renditions_generated_on_save(self):
+        """Test that WebP and JPEG renditions are generated and listed"""
+        card = self.create_card(content=self.image_bytes())
+
+        renditions = list(card.renditions.all())
+        self.assertEqual(
+            sorted((rendition.width, rendition.format) for rendition in renditions),
+            [(320, 'jpeg'), (320, 'webp'), (640, 'jpeg'), (640, 'webp'), (800, 'jpeg'), (800, 'webp')],
+        )
+        small = next(r for r in renditions if r.width == 320 and r.format == 'webp')
+        self.assertEqual(small.height, 240)
+        self.assertEqual(small.bytes, small.file.size)
+        self.assertEqual(len(small.content_hash), 64)
+
+        data = json.loads(self.client.get('/api/cards/', **self.auth_headers).content)
+        listed = next(c for c in data['cards'] if c['id'] == str(card.id))
+        self.assertEqual(len(listed['renditions']), 6)
+        # The renditions are announced as a new version of the card
+        self.assertEqual(listed['version'], card.version + 1)
+        self.assertEqual(list(CardChange.objects.filter(card_id=card.id).values_list('version', flat=True)), [card.version, card.version + 1])
+
+        # Saving without changing the image keeps the same rendition set
+        card.save()
+        self.assertEqual(
+            sorted(card.renditions.values_list('id', flat=True)),
+            sorted(rendition.id for rendition in renditions),
+        )
+
+    def test_catalog_etag_changes_when_renditions_finish(self):
+        """Test that kiosks holding the catalog from before a card's renditions existed fetch it again"""
+        with patch('home.services.CardRenditionService.schedule'):
+            card = self.create_card(content=self.image_bytes())
+        response = self.client.get('/api/cards/', **self.auth_headers)
+        etag, cursor = response['ETag'], response['X-Card-Cursor']
+        self.assertEqual(next(c for c in json.loads(response.content)['cards'] if c['id'] == str(card.id))['renditions'], [])
+
+        CardRenditionService.generate(card.id)
+
+        response = self.client.get('/api/cards/', HTTP_IF_NONE_MATCH=etag, **self.auth_headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        listed = next(c for c in json.loads(response.content)['cards'] if c['id'] == str(card.id))
+        self.assertEqual(len(listed['renditions']), 6)
+
+        changes = self.client.get('/api/cards/changes/', {'since': cursor}, **self.auth_headers).json()['changes']
+        self.assertEqual([(change['card_id'], len(change['card']['renditions'])) for change in changes], [(str(card.id), 6)])
+
+
+    def read_archive(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-tar')
+        archive = tarfile.open(fileobj=io.BytesIO(b''.join(response.streaming_content)))
+        manifest = json.loads(archive.extractfile('manifest.json').read())
+        return archive, manifest
+
+    def test_archive_of_requested_ids(self):
+        """Test that requested cards are streamed as one tar archive"""
+        disabled_card = self.create_card(is_enabled=False)
+        response = self.client.post(
+            '/api/cards/archive/', {'ids': [str(self.card.id), str(disabled_card.id), 'bad']},
+            format='json', **self.auth_headers
+        )
+
+        archive, manifest = self.read_archive(response)
+        self.assertEqual([card['id'] for card in manifest['cards']], [str(self.card.id)])
+        self.assertCountEqual(manifest['removed'], [str(disabled_card.id), 'bad'])
+        member = archive.extractfile(manifest['cards'][0]['file'])
+        self.assertEqual(member.read(), b'card_image_content')
+
+    def test_archive_since_cursor(self):
+        """Test that the archive can be built from the change feed cursor"""
+        cursor = int(self.client.get('/api/cards/', **self.auth_headers)['X-Card-Cursor'])
+        new_card = self.create_card(content=self.image_bytes())
+
+        response = self.client.get(
+            '/api/cards/archive/', {'since': cursor, 'width': 300, 'image_format': 'webp'}, **self.auth_headers
+        )
+
+        archive, manifest = self.read_archive(response)
+        self.assertEqual([card['id'] for card in manifest['cards']], [str(new_card.id)])
+        self.assertEqual(manifest['cursor'], int(response['X-Card-Cursor']))
+        self.assertTrue(manifest['cards'][0]['file'].endswith('.webp'))
+        data = archive.extractfile(manifest['cards'][0]['file']).read()
+        self.assertEqual(Image.open(io.BytesIO(data)).width, 320)
+
+    def test_content_addressed_image_paths(self):
+        """Test that images are stored under their content hash"""
+        content_hash = hashlib.sha256(b'card_image_content').hexdigest()
+        self.assertEqual(self.card.image.name, f'cards/{content_hash}.jpg')
+
+        duplicate = self.create_card()
+        self.assertEqual(duplicate.image.name, self.card.image.name)
+
+        self.card.image = SimpleUploadedFile('card.jpg', b'replaced_content', content_type='image/jpeg')
+        self.card.save()
+        self.assertNotEqual(self.card.image.name, duplicate.image.name)
+
+    def test_unreferenced_media_collected_after_grace_period(self):
+        """Test that replaced media is only deleted once unreferenced and past the grace period"""
+        old_name = self.card.image.name
+        self.card.image = SimpleUploadedFile('card.jpg', b'replaced_content', content_type='image/jpeg')
+        self.card.save()
+
+        self.assertEqual(CardMediaService.collect_garbage(grace_seconds=3600), [])
+        self.assertEqual(CardMediaService.collect_garbage(grace_seconds=0), [old_name])
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, old_name)))
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, self.card.image.name)))
+
+    def test_immutable_cache_headers(self):
+        """Test that only content-addressed media is marked immutable"""
+        middleware = ImmutableMediaMiddleware(lambda request: HttpResponse('image'))
+        factory = RequestFactory()
+
+        response = middleware(factory.get(f'/media/{self.card.image.name}'))
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+
+        response = middleware(factory.get(f'/media/cards/{self.card.id}.jpg'))
+        self.assertNotIn('Cache-Control', response)
+
+    def test_sprite_atlas(self):
+        """Test that the sprite atlas covers every enabled card and follows the catalog version"""
+        self.card.delete()
+        cards = [self.create_card(content=self.image_bytes((400, 600))) for _ in range(3)]
+
+        response = self.client.get('/api/cards/sprite/', **self.auth_headers)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(set(data['tiles']), {str(card.id) for card in cards})
+
+        path = data['image_url'].split('/media/', 1)[1]
+        with open(os.path.join(self.media_root, path), 'rb') as sprite_file:
+            sprite = Image.open(sprite_file)
+            self.assertEqual((sprite.width, sprite.height), (data['width'], data['height']))
+        tile = data['tiles'][str(cards[0].id)]
+        self.assertEqual((tile['w'], tile['h']), (160, 240))
+
+        not_modified = self.client.get('/api/cards/sprite/', HTTP_IF_NONE_MATCH=response['ETag'], **self.auth_headers)
+        self.assertEqual(not_modified.status_code, 304)
+
+        cards[0].is_enabled = False
+        cards[0].save()
+        changed = self.client.get('/api/cards/sprite/', HTTP_IF_NONE_MATCH=response['ETag'], **self.auth_headers)
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotIn(str(cards[0].id), changed.json()['tiles'])
+        self.assertNotEqual(changed.json()['image_url'], data['image_url'])
+
+    def test_sprite_atlas_pages_and_build_lock(self):
+        """Test that a catalog too large for one image spans pages and concurrent builds are refused"""
+        self.card.delete()
+        cards = [self.create_card(content=self.image_bytes((400, 600))) for _ in range(5)]
+
+        catalog = CardCatalogService.get_state()
+        cache.add(CardSpriteService.BUILD_LOCK_KEY.format(etag=catalog['etag']), 1)
+        response = self.client.get('/api/cards/sprite/', **self.auth_headers)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '2')
+        cache.delete(CardSpriteService.BUILD_LOCK_KEY.format(etag=catalog['etag']))
+
+        # Two tiles of 160x240 fit per page
+        with patch.object(CardSpriteService, 'MAX_DIMENSION', 400):
+            data = self.client.get('/api/cards/sprite/', **self.auth_headers).json()
+        self.assertEqual(len(data['pages']), 3)
+        self.assertEqual([data['tiles'][str(card.id)]['page'] for card in cards], [0, 0, 1, 1, 2])
+        self.assertEqual(data['image_url'], data['pages'][0]['image_url'])
+
+    def test_sprite_atlas_survives_cache_loss_and_garbage_collection(self):
+        """Test that the live atlas is kept by media garbage collection in a process without its cache"""
+        data = self.client.get('/api/cards/sprite/', **self.auth_headers).json()
+        path = data['image_url'].split('/media/', 1)[1]
+        cache.clear()
+
+        self.assertNotIn(path, CardMediaService.collect_garbage(grace_seconds=0))
+        self.assertTrue(default_storage.exists(path))
+        self.assertEqual(self.client.get('/api/cards/sprite/', **self.auth_headers).json()['image_url'], data['image_url'])
+
+    def test_media_range_requests(self):
+        """Test that media downloads can be resumed with Range and If-Range"""
+        content = bytes(range(256)) * 4
+        self.card.image = SimpleUploadedFile('card.jpg', content, content_type='image/jpeg')
+        self.card.save()
+        url = f'/media/{self.card.image.name}'
+
+        full = self.client.get(url)
+        self.assertEqual(full.status_code, 200)
+        self.assertEqual(b''.join(full.streaming_content), content)
+        self.assertEqual(full['Accept-Ranges'], 'bytes')
+        self.assertEqual(full['Cache-Control'], 'public, max-age=31536000, immutable')
+
+        partial = self.client.get(url, HTTP_RANGE='bytes=100-199', HTTP_IF_RANGE=full['ETag'])
+        self.assertEqual(partial.status_code, 206)
+        self.assertEqual(partial['Content-Range'], f'bytes 100-199/{len(content)}')
+        self.assertEqual(partial['Content-Length'], '100')
+        self.assertEqual(b''.join(partial.streaming_content), content[100:200])
+
+        resumed = self.client.get(url, HTTP_RANGE='bytes=1000-')
+        self.assertEqual(b''.join(resumed.streaming_content), content[1000:])
+
+        suffix = self.client.get(url, HTTP_RANGE='bytes=-24')
+        self.assertEqual(b''.join(suffix.streaming_content), content[-24:])
+
+        stale = self.client.get(url, HTTP_RANGE='bytes=100-199', HTTP_IF_RANGE='"other-version"')
+        self.assertEqual(stale.status_code, 200)
+        self.assertEqual(b''.join(stale.streaming_content), content)
+
+        unsatisfiable = self.client.get(url, HTTP_RANGE=f'bytes={len(content)}-')
+        self.assertEqual(unsatisfiable.status_code, 416)
+        self.assertEqual(unsatisfiable['Content-Range'], f'bytes */{len(content)}')
+
+        not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=full['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+
+        self.assertEqual(self.client.get('/media/../manage.py').status_code, 404)
+        self.assertEqual(self.client.get('/media/cards/missing.jpg').status_code, 404)
+
+    def test_media_accel_redirect(self):
+        """Test that media is handed to nginx when X-Accel-Redirect is configured"""
+        with override_settings(MEDIA_ACCEL_REDIRECT='/protected-media/'):
+            response = self.client.get(f'/media/{self.card.image.name}')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{self.card.image.name}')
+        self.assertEqual(response.content, b'')
+
+
+class TestAsgiStreaming(TestCase):
+    """Downloads are sent chunk by chunk by Django's ASGI handler, not collected first"""
+
+    def blocking_source(self):
+        # Produces a second chunk only after the first has reached the client
+        self.first_sent = threading.Event()
+
+        def chunks():
+            yield b'a' * 16
+            if not self.first_sent.wait(5):
+                raise AssertionError("first chunk was not sent before the body was read on")
+            yield b'b' * 16
+        return chunks()
+
+    async def send_response(self, response):
+        bodies = []
+
+        async def send(message):
+            if message['type'] == 'http.response.body' and message.get('body'):
+                bodies.append(message['body'])
+                self.first_sent.set()
+        await ASGIHandler().send_response(response, send)
+        return b''.join(bodies)
+
+    async def test_card_archive_streams(self):
+        with patch('home.views.CardArchiveService.stream', return_value=self.blocking_source()):
+            response = CardArchiveAPI().archive_response([], [], None)
+        self.assertEqual(await self.send_response(response), b'a' * 16 + b'b' * 16)
+
+    async def test_media_file_streams(self):
+        source = self.blocking_source()
+        file = MagicMock(read=lambda size=-1: next(source, b''), spec=['read', 'close'])
+        response = ThreadedFileResponse(file, content_type='image/jpeg')
+        self.assertEqual(await self.send_response(response), b'a' * 16 + b'b' * 16)
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET='whsec_test', STRIPE_WEBHOOK_WORKER=True)
+class TestStripeWebhook(TestCase):
+    def setUp(self):
+        self.client = Client()
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+
+    def payment_intent_event(self, event_type, status, event_id=None, amount=1500):
+        return {
+            'id': event_id or f'evt_{uuid.uuid4().hex}',
+            'object': 'event',
+            'type': event_type,
+            'data': {'object': {
+                'id': 'pi_123',
+                'object': 'payment_intent',
+                'amount': amount,
+                'status': status,
+                'metadata': {'kiosk_id': 'kiosk-1', 'num_pictures': '3'},
+            }},
+        }
+
+    def post_event(self, event):
+        payload = json.dumps(event)
+        timestamp = int(time.time())
+        signature = hmac.new(b'whsec_test', f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+        return self.client.post(
+            '/api/webhook/stripe', payload, content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=f't={timestamp},v1={signature}',
+        )
+
+    def test_webhook_only_stores_event(self):
+        """Test that a verified event is stored in the inbox and applied later by the worker"""
+        with self.assertNumQueries(1):
+            response = self.post_event(self.payment_intent_event('payment_intent.created', 'requires_payment_method'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(StripeWebhookEvent.objects.filter(processed_at__isnull=True).count(), 1)
+        self.assertFalse(Order.objects.exists())
+
+        self.post_event(self.payment_intent_event('payment_intent.succeeded', 'succeeded'))
+        self.assertEqual(StripeWebhookService.drain(batch_size=10), 2)
+
+        order = Order.objects.get(stripe_payment_intent_id='pi_123')
+        self.assertEqual((order.status, order.kiosk_id, order.num_pictures), ('paid', 'kiosk-1', 3))
+        self.assertFalse(StripeWebhookEvent.objects.filter(processed_at__isnull=True).exists())
+        self.assertEqual(StripeWebhookService.drain(batch_size=10), 0)
+
+    @override_settings(STRIPE_WEBHOOK_WORKER=False)
+    def test_webhook_applies_event_without_worker(self):
+        """Test that the webhook applies events itself when no worker is deployed"""
+        response = self.post_event(self.payment_intent_event('payment_intent.succeeded', 'succeeded'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Order.objects.get(stripe_payment_intent_id='pi_123').status, 'paid')
+        self.assertFalse(StripeWebhookEvent.objects.filter(processed_at__isnull=True).exists())
+
+    def test_payloads_archived_outside_order(self):
+        """Test that full PaymentIntents are archived compressed and shown on the order detail page"""
+        self.post_event(self.payment_intent_event('payment_intent.created', 'requires_payment_method', event_id='evt_1'))
+        self.post_event(self.payment_intent_event('payment_intent.succeeded', 'succeeded', event_id='evt_2'))
+        StripeWebhookService.drain()
+
+        payloads = list(StripePayload.objects.filter(payment_intent_id='pi_123'))
+        self.assertEqual([payload.event_id for payload in payloads], ['evt_1', 'evt_2'])
+        self.assertEqual(payloads[1].payload['status'], 'succeeded')
+
+        order = Order.objects.get(stripe_payment_intent_id='pi_123')
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(admin)
+        changelist = self.client.get('/admin/home/order/')
+        self.assertNotContains(changelist, 'requires_payment_method')
+        detail = self.client.get(f'/admin/home/order/{order.pk}/change/')
+        self.assertContains(detail, 'payment_intent.succeeded')
+
+    def test_invalid_signature_is_not_stored(self):
+        """Test that events failing verification never reach the inbox"""
+        response = self.client.post(
+            '/api/webhook/stripe', '{}', content_type='application/json', HTTP_STRIPE_SIGNATURE='t=1,v1=bad',
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(StripeWebhookEvent.objects.exists())
+
+    def test_failed_event_is_retried(self):
+        """Test that an event that cannot be applied stays pending with its error"""
+        event = self.payment_intent_event('payment_intent.created', 'requires_payment_method')
+        del event['data']['object']['amount']
+        self.post_event(event)
+
+        self.assertEqual(StripeWebhookService.drain(), 1)
+        stored = StripeWebhookEvent.objects.get()
+        self.assertIsNone(stored.processed_at)
+        self.assertEqual(stored.attempts, 1)
+        self.assertIn('amount', stored.last_error)
+
+    def test_event_given_up_is_reported_and_retried_from_admin(self):
+        """Test that an event out of attempts is logged, listed as failed and can be queued again"""
+        event = self.payment_intent_event('payment_intent.created', 'requires_payment_method')
+        del event['data']['object']['amount']
+        self.post_event(event)
+
+        with self.assertLogs('home.services', 'ERROR') as logs:
+            for _ in range(StripeWebhookService.MAX_ATTEMPTS):
+                StripeWebhookService.drain()
+        self.assertEqual(StripeWebhookService.drain(), 0)
+        self.assertEqual(list(StripeWebhookService.failed().values_list('event_id', flat=True)), [event['id']])
+        self.assertTrue(any('Giving up on Stripe event' in line for line in logs.output))
+
+        admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(admin_user)
+        url = reverse('admin:home_stripewebhookevent_changelist')
+        self.assertContains(self.client.get(url, {'state': 'failed'}), event['id'])
+        self.client.post(url, {'action': 'retry_events', '_selected_action': [StripeWebhookEvent.objects.get().pk]})
+        self.assertEqual(StripeWebhookEvent.objects.get().attempts, 0)
+        self.assertFalse(StripeWebhookService.failed().exists())
+
+    def test_worker_survives_database_errors(self):
+        """Test that the looping worker backs off and keeps draining after a database error"""
+        with patch.object(StripeWebhookService, 'drain', side_effect=[OperationalError('gone away'), 0, KeyboardInterrupt]) as drain, \
+                patch('home.management.commands.process_stripe_events.close_old_connections') as close_connections, \
+                patch('home.management.commands.process_stripe_events.time.sleep') as sleep:
+            with self.assertRaises(KeyboardInterrupt):
+                call_command('process_stripe_events', '--loop', stdout=io.StringIO())
+        self.assertEqual(drain.call_count, 3)
+        close_connections.assert_called_once()
+        self.assertEqual(sleep.call_args_list[0].args, (1.0,))
+
+    def test_duplicate_delivery_is_dropped(self):
+        """Test that a re-delivered event costs one statement and is applied once"""
+        event = self.payment_intent_event('payment_intent.created', 'requires_payment_method', event_id='evt_1')
+        self.post_event(event)
+        with self.assertNumQueries(1):
+            response = self.post_event(event)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(StripeWebhookEvent.objects.count(), 1)
+        self.assertEqual(StripeWebhookService.drain(), 1)
+
+    def test_out_of_order_events_never_move_order_backwards(self):
+        """Test that late processing or created events do not undo a later state"""
+        events = [
+            dict(self.payment_intent_event('payment_intent.succeeded', 'succeeded'), created=1002),
+            dict(self.payment_intent_event('payment_intent.processing', 'processing'), created=1001),
+            dict(self.payment_intent_event('payment_intent.created', 'requires_payment_method'), created=1000),
+        ]
+        for event in events:
+            self.post_event(event)
+        StripeWebhookService.drain()
+
+        order = Order.objects.get(stripe_payment_intent_id='pi_123')
+        self.assertEqual((order.status, order.stripe_event_created, order.num_pictures), ('paid', 1002, 3))
+
+        # A failed attempt can be followed by a retry within the same second
+        order.status, order.stripe_event_created = 'processing', 2000
+        order.save()
+        self.post_event(dict(self.payment_intent_event('payment_intent.payment_failed', 'requires_payment_method'), created=2000))
+        self.post_event(dict(self.payment_intent_event('payment_intent.processing', 'processing'), created=1999))
+        StripeWebhookService.drain()
+        self.assertEqual(Order.objects.get(pk=order.pk).status, 'failed')
+
+        self.post_event(dict(self.payment_intent_event('payment_intent.processing', 'processing'), created=2001))
+        StripeWebhookService.drain()
+        self.assertEqual(Order.objects.get(pk=order.pk).status, 'processing')
+
+    def test_order_insert_skips_only_duplicate_keys(self):
+        """Test that the webhook order insert ignores an existing order but not bad data"""
+        for _ in range(2):
+            self.post_event(self.payment_intent_event('payment_intent.created', 'requires_payment_method'))
+        StripeWebhookService.drain()
+        self.assertEqual(Order.objects.filter(stripe_payment_intent_id='pi_123').count(), 1)
+
+        event = self.payment_intent_event('payment_intent.created', 'requires_payment_method')
+        event['data']['object'].update(id='pi_456', metadata={})
+        self.post_event(event)
+        StripeWebhookService.drain()
+        self.assertFalse(Order.objects.filter(stripe_payment_intent_id='pi_456').exists())
+        self.assertIn('kiosk_id', StripeWebhookEvent.objects.get(event_id=event['id']).last_error)
+
+        # MySQL gets ON DUPLICATE KEY UPDATE rather than INSERT IGNORE, which would store the row coerced
+        with patch('home.services.connection') as connection_mock, patch.object(Order.objects, 'bulk_create') as bulk_create:
+            connection_mock.vendor = 'mysql'
+            insert_ignoring_duplicates(Order, [Order(stripe_payment_intent_id='pi_123')], 'stripe_payment_intent_id')
+        self.assertEqual(bulk_create.call_args.kwargs, {'update_conflicts': True, 'update_fields': ['stripe_payment_intent_id']})
+
+    def test_update_if_newer_orders_by_event_time_then_lifecycle(self):
+        """Test which events may overwrite an order's state"""
+        self.post_event(dict(self.payment_intent_event('payment_intent.processing', 'processing'), created=3000))
+        StripeWebhookService.drain()
+        fields = {'stripe_event_created': 3000}
+
+        update = StripeWebhookService._update_if_newer
+        self.assertEqual(update('pi_123', 'created', 2999, dict(fields, status='created')), 0)
+        self.assertEqual(update('pi_123', 'created', 3000, dict(fields, status='created')), 0)
+        self.assertEqual(update('pi_123', 'failed', 3000, dict(fields, status='failed')), 1)
+        self.assertEqual(update('pi_123', 'processing', 3000, dict(fields, status='processing')), 0)
+        self.assertEqual(update('pi_123', 'paid', 3000, dict(fields, status='paid')), 1)
+        self.assertEqual(update('pi_123', 'failed', 3001, dict(fields, status='failed', stripe_event_created=3001)), 0)
+        self.assertEqual(Order.objects.get(stripe_payment_intent_id='pi_123').status, 'paid')
+
+    @patch.dict(os.environ, {'CLIENT_SECRET_KEY': 'kiosk-secret'})
+    def test_payment_status_answered_locally(self):
+        """Test that status polls are served from webhook state and only go to Stripe when it is stale"""
+        self.post_event(dict(
+            self.payment_intent_event('payment_intent.created', 'requires_payment_method'),
+            created=int(time.time()),
+        ))
+        StripeWebhookService.drain()
+        url = '/api/payment-intent-status/pi_123/'
+
+        with patch('stripe.PaymentIntent.retrieve') as retrieve:
+            first = self.client.get(url, HTTP_CLIENT_SECRET_KEY='kiosk-secret')
+            with self.assertNumQueries(0):
+                second = self.client.get(url, HTTP_CLIENT_SECRET_KEY='kiosk-secret')
+        retrieve.assert_not_called()
+        self.assertEqual(first.json()['source'], 'database')
+        self.assertEqual(second.json()['source'], 'cache')
+        self.assertEqual((second.json()['status'], second.json()['amount']), ('requires_payment_method', 1500))
+
+        # A webhook update replaces the cached answer
+        self.post_event(dict(self.payment_intent_event('payment_intent.succeeded', 'succeeded'), created=int(time.time()) + 1))
+        with self.captureOnCommitCallbacks(execute=True):
+            StripeWebhookService.drain()
+        self.assertEqual(self.client.get(url, HTTP_CLIENT_SECRET_KEY='kiosk-secret').json()['status'], 'succeeded')
+
+        intent = type('Intent', (), {'id': 'pi_456', 'status': 'processing', 'amount': 900, 'currency': 'chf'})
+        with self.settings(PAYMENT_STATUS_FRESHNESS_SECONDS=0), patch('stripe.PaymentIntent.retrieve', return_value=intent) as retrieve:
+            response = self.client.get('/api/payment-intent-status/pi_456/', HTTP_CLIENT_SECRET_KEY='kiosk-secret')
+        retrieve.assert_called_once_with('pi_456')
+        self.assertEqual((response.json()['source'], response.json()['status']), ('stripe', 'processing'))
+
+    @patch.dict(os.environ, {'CLIENT_SECRET_KEY': 'kiosk-secret'})
+    def test_readers_served_from_mirror(self):
+        """Test that reader endpoints answer from the synced mirror and terminal webhooks keep it current"""
+        def reader(reader_id, status='online', label='Front desk'):
+            return stripe.terminal.Reader.construct_from({
+                'id': reader_id, 'object': 'terminal.reader', 'label': label, 'status': status,
+                'device_type': 'bbpos_wisepos_e', 'location': 'tml_1',
+            }, 'sk_test')
+
+        def paged(*objects):
+            return MagicMock(auto_paging_iter=MagicMock(return_value=iter(objects)))
+
+        location = stripe.terminal.Location.construct_from({
+            'id': 'tml_1', 'object': 'terminal.location',
+            'address': {'line1': '1 Main St', 'city': 'Zurich', 'state': 'ZH', 'postal_code': '8001', 'country': 'CH'},
+        }, 'sk_test')
+        ReaderDevice.objects.bulk_create([ReaderDevice(reader_id='tmr_gone', name='Gone')])
+
+        def list_readers(**kwargs):
+            # A reader registered while the listing pages is not in it, and must survive the sync
+            ReaderDevice.objects.bulk_create([ReaderDevice(reader_id='tmr_new', name='New')])
+            return paged(reader('tmr_1'), reader('tmr_2'))
+
+        with patch('stripe.terminal.Location.list', return_value=paged(location)), \
+                patch('stripe.terminal.Reader.list', side_effect=list_readers):
+            self.assertEqual(StripeReaderService.sync(), {'readers': 2, 'removed': 1})
+        self.assertEqual(ReaderDevice.objects.get(reader_id='tmr_1').city, 'Zurich')
+        self.assertFalse(ReaderDevice.objects.filter(reader_id='tmr_gone').exists())
+        ReaderDevice.objects.filter(reader_id='tmr_new').delete()
+
+        with patch('stripe.terminal.Reader.list') as list_readers, patch('stripe.terminal.Reader.retrieve') as retrieve:
+            self.client.get('/api/readers/', HTTP_CLIENT_SECRET_KEY='kiosk-secret')
+            with self.assertNumQueries(0):
+                response = self.client.get('/api/readers/', HTTP_CLIENT_SECRET_KEY='kiosk-secret')
+            single = self.client.get('/api/readers/tmr_2/', HTTP_CLIENT_SECRET_KEY='kiosk-secret')
+        list_readers.assert_not_called()
+        retrieve.assert_not_called()
+        self.assertEqual(response['X-Data-Source'], 'mirror')
+        self.assertEqual([r['id'] for r in response.json()['data']], ['tmr_1', 'tmr_2'])
+        self.assertEqual(single.json()['status'], 'online')
+
+        # A terminal webhook updates the mirror without touching the address
+        self.post_event({
+            'id': 'evt_reader', 'object': 'event', 'type': 'terminal.reader.action_succeeded',
+            'data': {'object': reader('tmr_2', status='offline').to_dict_recursive()},
+        })
+        StripeWebhookService.drain()
+        self.assertEqual(self.client.get('/api/readers/tmr_2/', HTTP_CLIENT_SECRET_KEY='kiosk-secret').json()['status'], 'offline')
+        self.assertEqual(ReaderDevice.objects.get(reader_id='tmr_2').city, 'Zurich')
+
+        # Readers missing from the mirror are read live from Stripe
+        with patch('stripe.terminal.Reader.retrieve', return_value=reader('tmr_3')) as retrieve:
+            response = self.client.get('/api/readers/tmr_3/', HTTP_CLIENT_SECRET_KEY='kiosk-secret')
+        retrieve.assert_called_once_with('tmr_3')
+        self.assertEqual((response['X-Data-Source'], response.json()['id']), ('stripe', 'tmr_3'))
+
+
+class TestOrderDedupeMigration(TransactionTestCase):
+    migrate_from = [('home', '0017_stripe_event_ledger')]
+    migrate_to = [('home', '0018_order_indexes')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets or executor.loader.graph.leaf_nodes())
+        return executor.loader.project_state(targets).apps if targets else None
+
+    def tearDown(self):
+        self.migrate(None)
+
+    def test_duplicate_payment_intent_ids_keep_oldest_order(self):
+        """Test that migration 0018 keeps the id on the oldest of duplicated orders and nulls empty ids"""
+        Order = self.migrate(self.migrate_from).get_model('home', 'Order')
+        for index, payment_intent_id in enumerate(['pi_1', 'pi_1', 'pi_1', 'pi_2', '', '']):
+            Order.objects.create(
+                transaction_id=f'txn_{index}', kiosk_id='kiosk-1', price=15, num_pictures=3,
+                stripe_payment_intent_id=payment_intent_id,
+            )
+            Order.objects.filter(transaction_id=f'txn_{index}').update(
+                created_at=timezone.now() - timedelta(minutes=10 - index),
+            )
+
+        Order = self.migrate(self.migrate_to).get_model('home', 'Order')
+        self.assertEqual(
+            dict(Order.objects.values_list('transaction_id', 'stripe_payment_intent_id')),
+            {'txn_0': 'pi_1', 'txn_1': None, 'txn_2': None, 'txn_3': 'pi_2', 'txn_4': None, 'txn_5': None},
+        )
+
+@override_settings(PAYMENT_STATUS_WAIT_INTERVAL=0.01)
+class TestWaitPaymentStatus(TestCase):
+    def setUp(self):
+        cache.clear()
+        kiosk = KioskClient.objects.create(login_name='test_kiosk')
+        kiosk.set_password('test_password')
+        kiosk.save()
+        credentials = base64.b64encode(b'test_kiosk:test_password').decode()
+        self.auth_headers = {'HTTP_AUTHORIZATION': f'Basic {credentials}'}
+        self.order = Order.objects.create(transaction_id='txn-1', kiosk_id='kiosk-1', price=15, num_pictures=3)
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_wait_returns_changed_status(self):
+        """Test that the long poll answers at once when the status already moved, and times out otherwise"""
+        url = '/api/payment/status/txn-1/wait/'
+        self.assertEqual(self.client.get(url).status_code, 401)
+        self.assertEqual(self.client.get('/api/payment/status/missing/wait/', **self.auth_headers).status_code, 404)
+
+        response = self.client.get(url, {'since': 'pending'}, **self.auth_headers)
+        self.assertEqual(response.json(), {'status': 'created', 'changed': True})
+
+        started = time.monotonic()
+        response = self.client.get(url, {'since': 'created', 'timeout': '0.1'}, **self.auth_headers)
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+        self.assertEqual(response.json(), {'status': 'created', 'changed': False})
+
+    async def test_wait_wakes_on_status_change(self):
+        """Test that a waiting request returns as soon as the order is saved with a new status"""
+        async def pay():
+            await asyncio.sleep(0.05)
+            self.order.status = 'completed'
+            await self.order.asave()
+            # TestCase never commits, so run the on_commit notification by hand
+            OrderStatusWaitService.notify('txn-1')
+
+        started = time.monotonic()
+        result, _ = await asyncio.gather(OrderStatusWaitService.wait('txn-1', 'created', timeout=5), pay())
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(result, {'status': 'completed', 'changed': True})
+
+    async def test_wait_sees_change_notified_elsewhere(self):
+        """Test that a change whose notify() never reached this process's cache is seen once the entry expires"""
+        async def pay_in_other_process():
+            await asyncio.sleep(0.05)
+            await Order.objects.filter(transaction_id='txn-1').aupdate(status='completed')
+
+        started = time.monotonic()
+        result, _ = await asyncio.gather(OrderStatusWaitService.wait('txn-1', 'created', timeout=5), pay_in_other_process())
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(result, {'status': 'completed', 'changed': True})
+
+
+class TestBatchPaymentStatus(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        kiosk = KioskClient.objects.create(login_name='test_kiosk')
+        kiosk.set_password('test_password')
+        kiosk.save()
+        credentials = base64.b64encode(b'test_kiosk:test_password').decode()
+        self.auth_headers = {'HTTP_AUTHORIZATION': f'Basic {credentials}'}
+        Order.objects.create(transaction_id='txn-1', kiosk_id='kiosk-1', price=15, num_pictures=3)
+        Order.objects.create(
+            transaction_id='pi_2', stripe_payment_intent_id='pi_2', kiosk_id='kiosk-1',
+            price=10, num_pictures=2, status='paid',
+        )
+
+    def test_batch_status_single_query(self):
+        """Test that a batch of transaction and PaymentIntent ids is answered with one query"""
+        ids = ['txn-1', 'pi_2', 'txn-unknown', 'txn-1']
+        with self.assertNumQueries(3):  # kiosk lookup, last_login update, orders
+            response = self.client.post('/api/payment/status/batch/', {'ids': ids}, format='json', **self.auth_headers)
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual({k: v['status'] for k, v in data['orders'].items()}, {'txn-1': 'created', 'pi_2': 'paid'})
+        self.assertIn('updated_at', data['orders']['pi_2'])
+        self.assertEqual(data['missing'], ['txn-unknown'])
+
+    @override_settings(PAYMENT_STATUS_BATCH_LIMIT=2)
+    def test_batch_status_limit(self):
+        """Test that oversized or malformed batches are rejected"""
+        url = '/api/payment/status/batch/'
+        response = self.client.post(url, {'ids': ['a', 'b', 'c']}, format='json', **self.auth_headers)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.post(url, {'ids': 'a'}, format='json', **self.auth_headers).status_code, 400)
+        self.assertEqual(self.client.post(url, {'ids': ['a']}, format='json').status_code, 401)
+
+        # A kiosk's own limit replaces the server default, in either direction
+        configuration = KioskConfiguration.objects.create(
+            kiosk=KioskClient.objects.get(login_name='test_kiosk'), location_name='Lobby', payment_status_batch_limit=3,
+        )
+        self.assertEqual(self.client.post(url, {'ids': ['a', 'b', 'c']}, format='json', **self.auth_headers).status_code, 200)
+        configuration.payment_status_batch_limit = 1
+        configuration.save()
+        response = self.client.post(url, {'ids': ['a', 'b']}, format='json', **self.auth_headers)
+        self.assertEqual((response.status_code, response.json()['error']), (400, 'At most 1 ids per request'))
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET='whsec_test')
+class TestPaymentFakes(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.fakes = FakePaymentProviders(webhook_secret='whsec_test')
+        self.fakes.start()
+        self.addCleanup(self.fakes.stop)
+        for name, value in (('api_base', self.fakes.url), ('api_key', 'sk_test_fake'), ('max_network_retries', 0)):
+            patcher = patch.object(stripe, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        cache.clear()
+
+    def deliver_webhooks(self):
+        while not self.fakes.state.events.empty():
+            payload = json.dumps(self.fakes.state.events.get())
+            response = self.client.post(
+                '/api/webhook/stripe', payload, content_type='application/json',
+                HTTP_STRIPE_SIGNATURE=self.fakes.sign(payload),
+            )
+            self.assertEqual(response.status_code, 200)
+        StripeWebhookService.drain()
+
+    @patch.dict(os.environ, {'CLIENT_SECRET_KEY': 'kiosk-secret'})
+    def test_purchase_against_fake_stripe(self):
+        """Test that a kiosk purchase runs end to end against the fake Stripe API and its signed webhooks"""
+        headers = {'HTTP_CLIENT_SECRET_KEY': 'kiosk-secret'}
+        response = self.client.post('/api/payment-intents/', {
+            'amount': 1500, 'kiosk_id': 'kiosk-1', 'num_pictures': 3,
+        }, content_type='application/json', **headers)
+        self.assertEqual(response.status_code, 201)
+        payment_intent_id = response.json()['id']
+
+        response = self.client.post('/api/process-payment-intent/', {
+            'reader_id': 'tmr_fake', 'payment_intent': payment_intent_id,
+        }, content_type='application/json', **headers)
+        self.assertEqual(response.json()['action']['status'], 'in_progress')
+        response = self.client.post('/api/present-payment-method/', {'reader_id': 'tmr_fake'}, content_type='application/json')
+        self.assertEqual(response.json()['action']['status'], 'succeeded')
+
+        self.deliver_webhooks()
+        order = Order.objects.get(transaction_id=payment_intent_id)
+        self.assertEqual((order.status, order.price, order.num_pictures), ('paid', 15, 3))
+        self.assertTrue(order.stripe_charge_id.startswith('ch_'))
+        self.assertEqual(ReaderDevice.objects.get(reader_id='tmr_fake').status, 'online')
+
+    @patch.dict(os.environ, {'CLIENT_SECRET_KEY': 'kiosk-secret'})
+    async def test_stripe_proxy_calls_overlap(self):
+        """Test that concurrent Stripe proxy requests wait on Stripe together instead of one after another"""
+        self.fakes.server.latency_ms = 300
+        started = time.monotonic()
+        responses = await asyncio.gather(*[
+            self.async_client.post(
+                '/api/payment-intents/', {'amount': 1500, 'kiosk_id': 'kiosk-1', 'num_pictures': 3},
+                content_type='application/json', headers={'Client-Secret-Key': 'kiosk-secret'},
+            )
+            for _ in range(10)
+        ])
+        self.assertLess(time.monotonic() - started, 1.5)  # 3s if served one at a time
+        self.assertEqual({response.status_code for response in responses}, {201})
+        self.assertEqual(len(self.fakes.state.payment_intents), 10)
+
+    @patch.dict(os.environ, {'CLIENT_SECRET_KEY': 'kiosk-secret'})
+    def test_payment_intent_retry_with_idempotency_key(self):
+        """Test that a retried payment intent request gets the first PaymentIntent instead of a new one"""
+        headers = {'HTTP_CLIENT_SECRET_KEY': 'kiosk-secret', 'HTTP_IDEMPOTENCY_KEY': 'kiosk-1-purchase-1'}
+        body = {'amount': 1500, 'kiosk_id': 'kiosk-1', 'num_pictures': 3}
+        first = self.client.post('/api/payment-intents/', body, content_type='application/json', **headers)
+        self.assertEqual(first.status_code, 201)
+
+        retry = self.client.post('/api/payment-intents/', body, content_type='application/json', **headers)
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.json()['id'], first.json()['id'])
+        self.assertEqual(len(self.fakes.state.payment_intents), 1)
+
+        response = self.client.post('/api/payment-intents/', dict(body, amount=2000), content_type='application/json', **headers)
+        self.assertEqual(response.status_code, 422)
+
+        # The key also reaches Stripe, which dedupes a retry this server no longer remembers
+        cache.clear()
+        retry = self.client.post('/api/payment-intents/', body, content_type='application/json', **headers)
+        self.assertEqual(retry.json()['id'], first.json()['id'])
+        self.assertEqual(len(self.fakes.state.payment_intents), 1)
+
+        # Without a key every request creates a PaymentIntent
+        del headers['HTTP_IDEMPOTENCY_KEY']
+        self.client.post('/api/payment-intents/', body, content_type='application/json', **headers)
+        self.assertEqual(len(self.fakes.state.payment_intents), 2)
+
+    @patch.dict(os.environ, {'CLIENT_SECRET_KEY': 'kiosk-secret'})
+    async def test_concurrent_idempotent_requests_create_one_payment_intent(self):
+        """Test that a retry sent while the first request is still with Stripe does not create a second PaymentIntent"""
+        self.fakes.server.latency_ms = 300
+        responses = await asyncio.gather(*[
+            self.async_client.post(
+                '/api/payment-intents/', {'amount': 1500, 'kiosk_id': 'kiosk-1', 'num_pictures': 3},
+                content_type='application/json',
+                headers={'Client-Secret-Key': 'kiosk-secret', 'Idempotency-Key': 'kiosk-1-purchase-1'},
+            )
+            for _ in range(3)
+        ])
+        self.assertEqual(sorted(response.status_code for response in responses), [201, 409, 409])
+        self.assertEqual(len(self.fakes.state.payment_intents), 1)
+
+    def test_injected_failures_and_declines(self):
+        """Test that the fakes answer with Stripe errors and declined cards when asked to"""
+        with self.assertRaises(stripe.error.InvalidRequestError):
+            stripe.PaymentIntent.retrieve('pi_missing')
+
+        self.fakes.server.failure_rate = 1.0
+        with self.assertRaises(stripe.error.APIError):
+            stripe.PaymentIntent.create(amount=100, currency='chf')
+
+        self.fakes.server.failure_rate = 0.0
+        self.fakes.state.decline_rate = 1.0
+        intent = stripe.PaymentIntent.create(amount=100, currency='chf', metadata={'kiosk_id': 'kiosk-1', 'num_pictures': 1})
+        stripe.terminal.Reader.process_payment_intent('tmr_fake', payment_intent=intent.id)
+        self.fakes.state.present_payment_method('tmr_fake')
+        self.deliver_webhooks()
+        self.assertEqual(Order.objects.get(transaction_id=intent.id).status, 'failed')
+
+    def test_reconciliation_repairs_missed_webhooks(self):
+        """Test that reconciliation pages through Stripe and bulk-repairs orders whose webhooks were missed"""
+        state = self.fakes.state
+        intents = [
+            state.create_payment_intent({'amount': 1500, 'currency': 'chf', 'metadata': {'kiosk_id': 'kiosk-1', 'num_pictures': '3'}})
+            for _ in range(5)
+        ]
+        for intent in intents[:3]:
+            intent.update(status='succeeded', latest_charge=f"ch_{intent['id']}")
+        intents[3]['status'] = 'processing'
+        Order.objects.create(transaction_id=intents[0]['id'], stripe_payment_intent_id=intents[0]['id'],
+                             kiosk_id='kiosk-1', price=15, num_pictures=3)
+        Order.objects.create(transaction_id=intents[1]['id'], stripe_payment_intent_id=intents[1]['id'],
+                             kiosk_id='kiosk-1', price=15, num_pictures=3, status='paid',
+                             stripe_payment_status='succeeded', stripe_charge_id=f"ch_{intents[1]['id']}", currency='chf')
+        Order.objects.create(transaction_id=intents[3]['id'], stripe_payment_intent_id=intents[3]['id'],
+                             kiosk_id='kiosk-1', price=15, num_pictures=3, status='failed')
+
+        with self.settings(STRIPE_RECONCILE_OVERLAP_SECONDS=60):
+            result = StripeReconciliationService.run(chunk_size=2)
+        self.assertEqual((result['seen'], result['created'], result['corrected']), (5, 2, 2))
+        statuses = dict(Order.objects.values_list('stripe_payment_intent_id', 'status'))
+        self.assertEqual([statuses[intent['id']] for intent in intents], ['paid', 'paid', 'paid', 'processing', 'created'])
+        self.assertEqual(Order.objects.get(transaction_id=intents[2]['id']).stripe_charge_id, f"ch_{intents[2]['id']}")
+
+        # The next run starts from the stored watermark and finds nothing left to repair
+        watermark = SyncWatermark.objects.get(name=StripeReconciliationService.WATERMARK).value
+        self.assertAlmostEqual(watermark, time.time() - 60, delta=5)
+        with CaptureQueriesContext(connection) as queries:
+            result = StripeReconciliationService.run(chunk_size=10)
+        self.assertEqual((result['since'], result['created'], result['corrected']), (watermark, 0, 0))
+        order_queries = [query['sql'] for query in queries.captured_queries if '"home_order"' in query['sql']]
+        self.assertEqual(len(order_queries), 1)  # one chunk lookup, nothing written
+
+    def test_paypal_payment(self):
+        """Test that the PayPal SDK can create and execute payments against the fakes"""
+        api = PooledPayPalApi(mode='sandbox', client_id='id', client_secret='secret', endpoint=self.fakes.url)
+        payment = paypalrestsdk.Payment({
+            'intent': 'sale', 'payer': {'payment_method': 'paypal'},
+            'transactions': [{'amount': {'total': '15.00', 'currency': 'USD'}}],
+        }, api=api)
+        self.assertTrue(payment.create())
+        self.assertEqual(payment.state, 'created')
+        self.assertTrue(payment.execute({'payer_id': 'PAYER1'}))
+        self.assertEqual(paypalrestsdk.Payment.find(payment.id, api=api).state, 'approved')
@@ -1,4 +1,4 @@
-from django.urls import path
+from django.urls import path, re_path
 from django.contrib.auth import views as auth_views
 from . import views
 from .views import (
@@ -6,24 +6,31 @@ from .views import (
     create_reader,
     login_view,
     InstagramPostsView,
+    InstagramBudgetView,
+    OutboundHttpStatsView,
     ImageStatusAPI,
     ImageUploadFlowAPI,
     KioskHealthCheckView,
     CreatePaymentLinkAPI,
     CheckPaymentStatusAPI,
+    BatchPaymentStatusAPI,
     PaypalAPIWebhook,
     PaypalAPIExecute,
     PaypalAPICancel,
     CardImageAPI,
+    CardChangesAPI,
+    CardArchiveAPI,
+    CardSpriteAPI,
 )
 from django.conf import settings
-from django.conf.urls.static import static
 
 urlpatterns = [    
     path('', views.index, name='index'),
     path('api/kiosk/test/', KioskTestView.as_view(), name='kiosk-test'),
     path('login/', login_view, name='login'),
     path('api/kiosk/instagram/', InstagramPostsView.as_view(), name='instagram-posts'),
+    path('api/instagram/budget/', InstagramBudgetView.as_view(), name='instagram-budget'),
+    path('api/outbound/stats/', OutboundHttpStatsView.as_view(), name='outbound-stats'),
     
     # Image upload URLs
     path('api/docs/image-upload/', ImageUploadFlowAPI.as_view(), name='image-upload-docs'),
@@ -32,13 +39,19 @@ urlpatterns = [
     path('api/kiosk/image/<kiosk_uuid>/<uuid:image_uuid>/', ImageStatusAPI.as_view(), name='image-status'),
     path('api/health/', KioskHealthCheckView.as_view(), name='kiosk-health-check'),
     path('api/payment/create/', CreatePaymentLinkAPI.as_view(), name='create-payment-link'),
+    path('api/payment/status/batch/', BatchPaymentStatusAPI.as_view(), name='batch-payment-status'),
     path('api/payment/status/<str:transaction_id>/', CheckPaymentStatusAPI.as_view(), name='check-payment-status'),
+    path('api/payment/status/<str:transaction_id>/wait/', views.wait_payment_status, name='wait-payment-status'),
     path('api/webhook/paypal/', PaypalAPIWebhook.as_view(), name='paypal-webhook'),
     path('api/payment/execute/', PaypalAPIExecute.as_view(), name='payment-execute'),
     path('api/payment/cancel/', PaypalAPICancel.as_view(), name='payment-cancel'),
     path('api/cards/', CardImageAPI.as_view(), name='card-list'),
     path('api/cards/updates/', CardImageAPI.as_view(), name='card-updates'),
+    path('api/cards/changes/', CardChangesAPI.as_view(), name='card-changes'),
+    path('api/cards/archive/', CardArchiveAPI.as_view(), name='card-archive'),
+    path('api/cards/sprite/', CardSpriteAPI.as_view(), name='card-sprite'),
     path("api/register-kiosk/", views.register_kiosk, name="register_kiosk"),
     path("api/heartbeat/", views.heartbeat, name="heartbeat"),
     path('api/create-reader/', create_reader, name='create_reader'),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    re_path(r'^%s(?P<path>.+)$' % settings.MEDIA_URL.lstrip('/'), views.serve_media, name='media'),
+]
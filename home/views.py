@@ -1,36 +1,45 @@
 import os
 from django.shortcuts import render, redirect
-from django.http import HttpResponse, FileResponse, JsonResponse
+from django.http import Http404, HttpResponse, FileResponse, JsonResponse, StreamingHttpResponse
 from django.contrib.auth import authenticate, login
 from django.contrib.auth.decorators import login_required
 from django.urls import reverse
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated, AllowAny
-from rest_framework.exceptions import ValidationError, AuthenticationFailed
+from rest_framework.permissions import IsAuthenticated, AllowAny, IsAdminUser
+from rest_framework.exceptions import ValidationError, AuthenticationFailed, NotAuthenticated
 from rest_framework import status
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
 from rest_framework.authtoken.models import Token
+from django.views import View
 from django.views.decorators.http import require_http_methods
 import hashlib, hmac
+from django.db.models import Q
 from django.utils import timezone
-
-from core import settings
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+from django.utils._os import safe_join
+from django.core.exceptions import SuspiciousFileOperation
+import mimetypes
+from asgiref.sync import sync_to_async
+import re
+
+from django.conf import settings
+from . import http_client
 from .authentication import KioskAuthentication
-from .services import InstagramService, ImageUploadService, PayPalService
+from .services import InstagramService, ImageUploadService, paypal_service, IdempotencyService, OrderStatusWaitService, PaymentIntentStatusService, StripeReaderService, StripeWebhookService, CardCatalogService, CardArchiveService, CardSpriteService, instagram_rate_limiter
 from .models import KioskHealthCheck, KioskClient, Order, CardImage, KioskDevice, ReaderDevice
 import logging
 from paypalrestsdk import Payment
 import json
 from rest_framework import viewsets
 from rest_framework.decorators import action, api_view
-from .serializers import CardImageSerializer
 from django.core.files.base import ContentFile
 import base64
+import uuid
 import stripe
-import requests
 
 stripe.api_key = settings.STRIPE_SECRET_KEY
 logger = logging.getLogger(__name__)
@@ -127,6 +136,7 @@ class KioskTestView(APIView):
 class InstagramPostsView(APIView):
     authentication_classes = [KioskAuthentication]
     permission_classes = [IsAuthenticated]
+    MAX_IMAGE_WIDTH = 4096
 
     @swagger_auto_schema(
         operation_description="Fetch recent posts from a public Instagram profile",
@@ -145,6 +155,13 @@ class InstagramPostsView(APIView):
                 type=openapi.TYPE_INTEGER,
                 required=False,
                 default=9
+            ),
+            openapi.Parameter(
+                'width',
+                openapi.IN_QUERY,
+                description="Target image width in pixels, 1-4096, rounded up to an Instagram rendition width (default: the kiosk's configured width, else full resolution)",
+                type=openapi.TYPE_INTEGER,
+                required=False
             )
         ],
         responses={
@@ -185,10 +202,22 @@ class InstagramPostsView(APIView):
         except ValueError:
             raise ValidationError({'error': 'Invalid limit value'})
 
+        width = request.query_params.get('width')
+        if width is None:
+            configuration = getattr(request.user, 'configuration', None)
+            width = configuration.instagram_image_width if configuration else None
+        else:
+            try:
+                width = int(width)
+                if not 0 < width <= self.MAX_IMAGE_WIDTH:
+                    raise ValueError(f"Width must be between 1 and {self.MAX_IMAGE_WIDTH}")
+            except ValueError:
+                raise ValidationError({'error': 'Invalid width value'})
+
         instagram_service = InstagramService()
         try:
             # if instagram_service.authenticate('Photokiosk.ek', 'POIlkj123'):
-            posts = instagram_service.get_profile_posts(username, limit)
+            posts = instagram_service.get_profile_posts(username, limit, target_width=width)
             return Response({
                 'success': True,
                 'posts': posts
@@ -206,6 +235,68 @@ class InstagramPostsView(APIView):
         finally:
             instagram_service.cleanup()
 
+class InstagramBudgetView(APIView):
+    permission_classes = [IsAdminUser]
+
+    @swagger_auto_schema(
+        operation_description="Current outbound Instagram budget and backoff state",
+        responses={
+            200: openapi.Response(
+                description="Budget state shared by all workers",
+                examples={
+                    "application/json": {
+                        "tokens": 7.5,
+                        "capacity": 10.0,
+                        "refill_per_second": 0.3333,
+                        "background_reserve": 3,
+                        "backoff_level": 0,
+                        "backoff_remaining_seconds": 0,
+                        "backoff_until": None,
+                        "granted_total": 42,
+                        "rate_limited_total": 1,
+                        "waiting_live": 0,
+                        "waiting_background": 0
+                    }
+                }
+            ),
+            403: "Admin access required"
+        },
+        tags=['Instagram Integration']
+    )
+    def get(self, request):
+        return Response(instagram_rate_limiter.snapshot())
+
+class OutboundHttpStatsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    @swagger_auto_schema(
+        operation_description="Call counts and timings of outbound HTTP calls (Stripe, PayPal) made by this worker process",
+        responses={
+            200: openapi.Response(
+                description="Per-host statistics",
+                examples={
+                    "application/json": {
+                        "pid": 12,
+                        "hosts": {
+                            "api.stripe.com": {
+                                "calls": 120,
+                                "errors": 1,
+                                "total_ms": 21840.5,
+                                "max_ms": 912.4,
+                                "last_ms": 143.2,
+                                "avg_ms": 182.0
+                            }
+                        }
+                    }
+                }
+            ),
+            403: "Admin access required"
+        },
+        tags=['Payment']
+    )
+    def get(self, request):
+        return Response({"pid": os.getpid(), "hosts": http_client.outbound_stats.snapshot()})
+
 def upload_page(request, kiosk_uuid, image_uuid):
     """Public page for image upload"""
     return render(request, 'home/upload.html', {
@@ -297,66 +388,10 @@ def stripe_webhook(request):
         logger.warning(f"⚠️ Stripe webhook verification failed: {str(e)}")
         return HttpResponse(status=200)
 
-    event_type = event["type"]
-    data = event["data"]["object"]
-    metadata = data.get("metadata", {})
-
-    # Handle PaymentIntent events
-    if event_type == "payment_intent.created":
-        try:
-            order, created = Order.objects.get_or_create(
-                stripe_payment_intent_id=data["id"],
-                defaults={
-                    "transaction_id": data["id"],
-                    "kiosk_id": metadata.get("kiosk_id"),
-                    "num_pictures": int(metadata.get("num_pictures", 0)),
-                    "price": data["amount"] / 100,  # convert cents to units
-                    "status": "created",
-                    "stripe_payment_status": data["status"],
-                    "stripe_response": data,
-                },
-            )
-        except Exception as e:
-            logger.error(f"❌ Failed to create order for {data['id']}: {str(e)}")
-
-    elif event_type == "payment_intent.processing":
-        try:
-            Order.objects.filter(stripe_payment_intent_id=data["id"]).update(
-                status="processing",
-                stripe_payment_status=data["status"],
-                stripe_response=data,
-            )
-        except Exception as e:
-            logger.error(f"❌ Failed to update processing status for {data['id']}: {str(e)}")
-
-    elif event_type == "payment_intent.succeeded":
-        try:
-            Order.objects.filter(stripe_payment_intent_id=data["id"]).update(
-                status="paid",
-                stripe_payment_status=data["status"],
-                stripe_charge_id=(
-                    data["charges"]["data"][0]["id"]
-                    if data.get("charges", {}).get("data")
-                    else None
-                ),
-                stripe_response=data,
-            )
-        except Exception as e:
-            logger.error(f"❌ Failed to mark order as paid for {data['id']}: {str(e)}")
-
-    elif event_type == "payment_intent.payment_failed":
-        try:
-            Order.objects.filter(stripe_payment_intent_id=data["id"]).update(
-                status="failed",
-                stripe_payment_status=data["status"],
-                stripe_response=data,
-            )
-        except Exception as e:
-            logger.error(f"❌ Failed to update failed status for {data['id']}: {str(e)}")
-
-    else:
-        logger.info(f"Unhandled event type {event_type}")
-
+    StripeWebhookService.receive(payload, event)
+    if not settings.STRIPE_WEBHOOK_WORKER:
+        # No process_stripe_events worker deployed, so apply the inbox here
+        StripeWebhookService.drain()
     return HttpResponse(status=200)
 
 @api_view(['POST'])
@@ -409,18 +444,10 @@ def create_reader(request):
     if kiosk_id:
         kiosk = KioskDevice.objects.filter(kiosk_id=kiosk_id).first()
 
-    # 4️⃣ save locally
-    reader_obj = ReaderDevice.objects.create(
-        reader_id=reader_id,
-        name=name,
-        country=country,
-        city=city,
-        state=state,
-        address=address,
-        postalCode=postal_code,
-        kiosk=kiosk,
-        location_id=location.id,
-    )
+    # 4️⃣ save locally; the upsert keeps ReaderDevice.save from registering the reader a second time
+    StripeReaderService.store([reader], {location.id: location})
+    ReaderDevice.objects.filter(reader_id=reader.id).update(name=name, kiosk=kiosk)
+    reader_obj = ReaderDevice.objects.get(reader_id=reader.id)
 
     return Response({
         "message": "Reader created successfully",
@@ -430,39 +457,77 @@ def create_reader(request):
             "id": reader_obj.id,
             "name": reader_obj.name,
             "reader_id": reader_obj.reader_id,
-            "location": reader_obj.location_id,
+            "location": reader_obj.stripe_location_id,
         }
     }, status=status.HTTP_201_CREATED)
 
-class CreatePaymentIntentAPI(APIView):
-    authentication_classes = []  # disable session / CSRF
-    permission_classes = [AllowAny]
+class AsyncStripeProxyView(View):
+    """
+    Base for the views that forward a kiosk request to Stripe. Handlers are
+    async and use Stripe's *_async methods on the pooled httpx client, so
+    under core.asgi a slow Stripe round trip waits on the event loop instead
+    of holding a worker. Checks the CLIENT_SECRET_KEY header, parses JSON or
+    form bodies into request.data and maps Stripe errors to 400.
+    """
+    require_client_key = True
 
-    def post(self, request):
-        try:
-            client_key = request.headers.get("CLIENT_SECRET_KEY")
-            expected_key = os.environ.get("CLIENT_SECRET_KEY")
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        view.csrf_exempt = True  # kiosks authenticate with CLIENT_SECRET_KEY, not a session
+        return view
 
+    async def dispatch(self, request, *args, **kwargs):
+        if self.require_client_key:
+            client_key = request.headers.get("CLIENT_SECRET_KEY")
             if not client_key:
-                return Response(
-                    {"error": "Missing client_secret_key header"},
-                    status=status.HTTP_401_UNAUTHORIZED,
-                )
+                return JsonResponse({"error": "Missing client_secret_key header"}, status=status.HTTP_401_UNAUTHORIZED)
+            if client_key != os.environ.get("CLIENT_SECRET_KEY"):
+                return JsonResponse({"error": "Invalid client_secret_key"}, status=status.HTTP_403_FORBIDDEN)
 
-            if client_key != expected_key:
-                return Response(
-                    {"error": "Invalid client_secret_key"},
-                    status=status.HTTP_403_FORBIDDEN,
-                )
-            
-            amount = request.data.get("amount")
-            if not amount:
-                return Response({"error": "amount is required"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            request.data = json.loads(request.body or b"{}") if request.content_type == "application/json" else request.POST.dict()
+        except ValueError:
+            request.data = None
+        if not isinstance(request.data, dict):
+            return JsonResponse({"error": "Request body must be a JSON object"}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            return await super().dispatch(request, *args, **kwargs)
+        except stripe.error.StripeError as e:
+            return JsonResponse({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            return JsonResponse({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+class CreatePaymentIntentAPI(AsyncStripeProxyView):
+    """
+    Creates a card-present PaymentIntent for a kiosk purchase.
+
+    Kiosks retry requests that time out; with an Idempotency-Key header the
+    retry gets the first response back instead of a second PaymentIntent.
+    The key is also sent to Stripe, which dedupes retries that reach it.
+    """
+    IDEMPOTENCY_SCOPE = "payment_intent"
+
+    async def post(self, request):
+        amount = request.data.get("amount")
+        if not amount:
+            return JsonResponse({"error": "amount is required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        currency = request.data.get("currency", "chf")
 
-            currency = request.data.get("currency", "chf")
+        idempotency_key = request.headers.get("Idempotency-Key")
+        if idempotency_key:
+            if len(idempotency_key) > 255:
+                return JsonResponse({"error": "Idempotency-Key is longer than 255 characters"}, status=status.HTTP_400_BAD_REQUEST)
+            fingerprint = IdempotencyService.fingerprint(request.data)
+            stored = await IdempotencyService.claim(self.IDEMPOTENCY_SCOPE, idempotency_key, fingerprint)
+            if stored is not None:
+                return self.replay(stored, fingerprint)
 
+        try:
             # Create PaymentIntent on Stripe
-            intent = stripe.PaymentIntent.create(
+            intent = await stripe.PaymentIntent.create_async(
                 amount=int(amount),  # must be integer (in cents)
                 currency=currency,
                 payment_method_types=["card_present"],
@@ -471,56 +536,54 @@ class CreatePaymentIntentAPI(APIView):
                     "kiosk_id": request.data.get("kiosk_id"),
                     "num_pictures": request.data.get("num_pictures"),
                 },
+                idempotency_key=idempotency_key,
             )
-
-            return Response(intent, status=status.HTTP_201_CREATED)
-
-        except stripe.error.StripeError as e:
-            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
-        except Exception as e:
-            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-
-class ProcessPaymentIntentAPI(APIView):
-    authentication_classes = []  # disable session / CSRF
-    permission_classes = [AllowAny]
-
-    def post(self, request):
-        try:
-            client_key = request.headers.get("CLIENT_SECRET_KEY")
-            expected_key = os.environ.get("CLIENT_SECRET_KEY")
-            
-            if not client_key:
-                return Response(
-                    {"error": "Missing client_secret_key header"},
-                    status=status.HTTP_401_UNAUTHORIZED,
-                )
-
-            if client_key != expected_key:
-                return Response(
-                    {"error": "Invalid client_secret_key"},
-                    status=status.HTTP_403_FORBIDDEN,
-                )
-            
-            reader_id = request.data.get("reader_id")
-            payment_intent = request.data.get("payment_intent")
-
-            if not reader_id:
-                return Response({"error": "reader_id is required"}, status=status.HTTP_400_BAD_REQUEST)
-            if not payment_intent:
-                return Response({"error": "payment_intent is required"}, status=status.HTTP_400_BAD_REQUEST)
-
-            # Call Stripe API: /v1/terminal/readers/{reader_id}/process_payment_intent
-            resp = stripe.terminal.Reader.process_payment_intent(
-                reader_id,
-                payment_intent=payment_intent
+        except BaseException:
+            if idempotency_key:
+                await IdempotencyService.release(self.IDEMPOTENCY_SCOPE, idempotency_key)
+            raise
+
+        if idempotency_key:
+            await IdempotencyService.complete(
+                self.IDEMPOTENCY_SCOPE, idempotency_key, fingerprint, status.HTTP_201_CREATED, intent.to_dict_recursive(),
+            )
+        return JsonResponse(intent, status=status.HTTP_201_CREATED)
+
+    @staticmethod
+    def replay(stored, fingerprint) -> JsonResponse:
+        if stored["fingerprint"] != fingerprint:
+            return JsonResponse(
+                {"error": "Idempotency-Key was already used for a different request"},
+                status=status.HTTP_422_UNPROCESSABLE_ENTITY,
             )
+        if stored["status"] is None:
+            response = JsonResponse(
+                {"error": "A request with this Idempotency-Key is still in progress"},
+                status=status.HTTP_409_CONFLICT,
+            )
+            response["Retry-After"] = "1"
+            return response
+        response = JsonResponse(stored["body"], status=stored["status"])
+        response["Idempotent-Replayed"] = "true"
+        return response
+
+class ProcessPaymentIntentAPI(AsyncStripeProxyView):
+    async def post(self, request):
+        reader_id = request.data.get("reader_id")
+        payment_intent = request.data.get("payment_intent")
 
-            return Response(resp, status=status.HTTP_200_OK)
+        if not reader_id:
+            return JsonResponse({"error": "reader_id is required"}, status=status.HTTP_400_BAD_REQUEST)
+        if not payment_intent:
+            return JsonResponse({"error": "payment_intent is required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Call Stripe API: /v1/terminal/readers/{reader_id}/process_payment_intent
+        resp = await stripe.terminal.Reader.process_payment_intent_async(
+            reader_id,
+            payment_intent=payment_intent
+        )
 
-        except stripe.error.StripeError as e:
-            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
-        except Exception as e:
-            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return JsonResponse(resp, status=status.HTTP_200_OK)
 
 
 class PaymentIntentStatusAPI(APIView):
@@ -544,14 +607,16 @@ class PaymentIntentStatusAPI(APIView):
                     status=status.HTTP_403_FORBIDDEN,
                 )
 
-            intent = stripe.PaymentIntent.retrieve(payment_intent_id)
+            intent = PaymentIntentStatusService.get_status(payment_intent_id)
 
             return Response(
                 {
-                    "id": intent.id,
-                    "status": intent.status,
-                    "amount": intent.amount,
-                    "currency": intent.currency,
+                    "id": intent["id"],
+                    "status": intent["status"],
+                    "amount": intent["amount"],
+                    "currency": intent["currency"],
+                    "source": intent["source"],
+                    "checked_at": intent["checked_at"],
                 },
                 status=status.HTTP_200_OK,
             )
@@ -561,178 +626,105 @@ class PaymentIntentStatusAPI(APIView):
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-class CancelPOSPaymentAPI(APIView):
-    authentication_classes = []  # disable session / CSRF
-    permission_classes = [AllowAny]
-
-    def post(self, request, reader_id):
+class CancelPOSPaymentAPI(AsyncStripeProxyView):
+    async def post(self, request, reader_id):
         try:
-            # Validate client secret key
-            client_key = request.headers.get("CLIENT_SECRET_KEY")
-            expected_key = os.environ.get("CLIENT_SECRET_KEY")
-
-            if not client_key:
-                return Response(
-                    {"error": "Missing CLIENT_SECRET_KEY header"},
-                    status=status.HTTP_401_UNAUTHORIZED,
-                )
-
-            if client_key != expected_key:
-                return Response(
-                    {"error": "Invalid CLIENT_SECRET_KEY"},
-                    status=status.HTTP_403_FORBIDDEN,
-                )
-
             # Cancel any ongoing action on the POS reader
-            canceled_action = stripe.terminal.Reader.cancel_action(reader_id)
-
-            return Response(
-                {
-                    "success": True,
-                    "message": "POS payment action canceled successfully.",
-                    "data": canceled_action,
-                },
-                status=status.HTTP_200_OK,
-            )
-
+            canceled_action = await stripe.terminal.Reader.cancel_action_async(reader_id)
         except stripe.error.StripeError as e:
-            return Response(
+            return JsonResponse(
                 {"error": str(e), "stripe_error": getattr(e, "user_message", None)},
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        except Exception as e:
-            return Response(
-                {"error": str(e)},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            )
-class CreateReaderAPI(APIView):
-    authentication_classes = []  # disable session / CSRF
-    permission_classes = [AllowAny]
-
-    def post(self, request):
-        try:
-            client_key = request.headers.get("CLIENT_SECRET_KEY")
-            expected_key = os.environ.get("CLIENT_SECRET_KEY")
-            
-            if not client_key:
-                return Response(
-                    {"error": "Missing client_secret_key header"},
-                    status=status.HTTP_401_UNAUTHORIZED,
-                )
-
-            if client_key != expected_key:
-                return Response(
-                    {"error": "Invalid client_secret_key"},
-                    status=status.HTTP_403_FORBIDDEN,
-                )
-            
-            registration_code = request.data.get("registration_code")
-            label = request.data.get("label")
-            location = request.data.get("location")
+        return JsonResponse(
+            {
+                "success": True,
+                "message": "POS payment action canceled successfully.",
+                "data": canceled_action,
+            },
+            status=status.HTTP_200_OK,
+        )
 
-            if not registration_code or not label or not location:
-                return Response(
-                    {"error": "registration_code, label, and location are required"},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
+class CreateReaderAPI(AsyncStripeProxyView):
+    async def post(self, request):
+        registration_code = request.data.get("registration_code")
+        label = request.data.get("label")
+        location = request.data.get("location")
 
-            # Call Stripe API
-            reader = stripe.terminal.Reader.create(
-                registration_code=registration_code,
-                label=label,
-                location=location
+        if not registration_code or not label or not location:
+            return JsonResponse(
+                {"error": "registration_code, label, and location are required"},
+                status=status.HTTP_400_BAD_REQUEST
             )
 
-            return Response(reader, status=status.HTTP_201_CREATED)
+        # Call Stripe API
+        reader = await stripe.terminal.Reader.create_async(
+            registration_code=registration_code,
+            label=label,
+            location=location
+        )
 
-        except stripe.error.StripeError as e:
-            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
-        except Exception as e:
-            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return JsonResponse(reader, status=status.HTTP_201_CREATED)
 
-class CreateLocationAPI(APIView):
-    authentication_classes = []  # disable session / CSRF
-    permission_classes = [AllowAny]
+class CreateLocationAPI(AsyncStripeProxyView):
+    async def post(self, request):
+        display_name = request.data.get("display_name")
+        address = request.data.get("address")
 
-    def post(self, request):
-        try:
-            client_key = request.headers.get("CLIENT_SECRET_KEY")
-            expected_key = os.environ.get("CLIENT_SECRET_KEY")
-            
-            if not client_key:
-                return Response(
-                    {"error": "Missing client_secret_key header"},
-                    status=status.HTTP_401_UNAUTHORIZED,
-                )
-
-            if client_key != expected_key:
-                return Response(
-                    {"error": "Invalid client_secret_key"},
-                    status=status.HTTP_403_FORBIDDEN,
-                )
-            
-            display_name = request.data.get("display_name")
-            address = request.data.get("address")
+        if not display_name or not address:
+            return JsonResponse(
+                {"error": "display_name and address are required"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
-            if not display_name or not address:
-                return Response(
-                    {"error": "display_name and address are required"},
+        # Required address fields
+        required_fields = ["line1", "city", "state", "country", "postal_code"]
+        for field in required_fields:
+            if field not in address:
+                return JsonResponse(
+                    {"error": f"Missing address field: {field}"},
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
-            # Required address fields
-            required_fields = ["line1", "city", "state", "country", "postal_code"]
-            for field in required_fields:
-                if field not in address:
-                    return Response(
-                        {"error": f"Missing address field: {field}"},
-                        status=status.HTTP_400_BAD_REQUEST
-                    )
-
-            # Call Stripe API
-            location = stripe.terminal.Location.create(
-                display_name=display_name,
-                address={
-                    "line1": address["line1"],
-                    "city": address["city"],
-                    "state": address["state"],
-                    "country": address["country"],
-                    "postal_code": address["postal_code"]
-                }
-            )
-
-            return Response(location, status=status.HTTP_201_CREATED)
+        # Call Stripe API
+        location = await stripe.terminal.Location.create_async(
+            display_name=display_name,
+            address={
+                "line1": address["line1"],
+                "city": address["city"],
+                "state": address["state"],
+                "country": address["country"],
+                "postal_code": address["postal_code"]
+            }
+        )
 
-        except stripe.error.StripeError as e:
-            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
-        except Exception as e:
-            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return JsonResponse(location, status=status.HTTP_201_CREATED)
 
-class PresentPaymentMethodAPI(APIView):
-    authentication_classes = []
-    permission_classes = [AllowAny]
+class PresentPaymentMethodAPI(AsyncStripeProxyView):
+    require_client_key = False
 
-    def post(self, request):
+    async def post(self, request):
         reader_id = request.data.get("reader_id")
         if not reader_id:
-            return Response({"error": "reader_id is required"}, status=status.HTTP_400_BAD_REQUEST)
+            return JsonResponse({"error": "reader_id is required"}, status=status.HTTP_400_BAD_REQUEST)
 
-        url = f"https://api.stripe.com/v1/test_helpers/terminal/readers/{reader_id}/present_payment_method"
+        url = f"{stripe.api_base}/v1/test_helpers/terminal/readers/{reader_id}/present_payment_method"
         headers = {"Authorization": f"Bearer {settings.STRIPE_SECRET_KEY}"}
 
-        resp = requests.post(url, headers=headers)
+        resp = await http_client.async_client().post(url, headers=headers)
         try:
             data = resp.json()
-            print(data)
-        except Exception:
+        except ValueError:
             data = {"error": "Invalid response from Stripe"}
 
-        return Response(data, status=resp.status_code)
+        return JsonResponse(data, status=resp.status_code)
 
 class ListReadersAPI(APIView):
-    print(settings.STRIPE_SECRET_KEY)
-
+    """
+    Readers of the Stripe account, answered from the local mirror.
+    Pass ?refresh=1 to sync the mirror from Stripe first.
+    """
     authentication_classes = []  # disable session / CSRF
     permission_classes = [AllowAny]
 
@@ -753,15 +745,27 @@ class ListReadersAPI(APIView):
                     status=status.HTTP_403_FORBIDDEN,
                 )
             
-            # Call Stripe API to list readers
-            readers = stripe.terminal.Reader.list()
-            return Response(readers, status=status.HTTP_200_OK)
+            source = "mirror"
+            if request.query_params.get("refresh"):
+                StripeReaderService.sync()
+                source = "stripe"
+
+            readers = StripeReaderService.list_readers()
+            return Response(
+                {"object": "list", "data": readers, "has_more": False, "url": "/v1/terminal/readers"},
+                status=status.HTTP_200_OK,
+                headers={"X-Data-Source": source},
+            )
         except stripe.error.StripeError as e:
             return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 class GetReaderByIdAPI(APIView):
+    """
+    One reader, answered from the local mirror. Readers missing from the
+    mirror, or requested with ?refresh=1, are read live from Stripe.
+    """
     authentication_classes = []  # Disable session / CSRF
     permission_classes = [AllowAny]
 
@@ -782,9 +786,14 @@ class GetReaderByIdAPI(APIView):
                     status=status.HTTP_403_FORBIDDEN,
                 )
             
-            # Retrieve reader by ID from Stripe
-            reader = stripe.terminal.Reader.retrieve(reader_id)
-            return Response(reader, status=status.HTTP_200_OK)
+            source = "mirror"
+            reader = None
+            if not request.query_params.get("refresh"):
+                reader = StripeReaderService.get_reader(reader_id)
+            if reader is None:
+                reader = StripeReaderService.refresh_reader(reader_id)
+                source = "stripe"
+            return Response(reader, status=status.HTTP_200_OK, headers={"X-Data-Source": source})
         except stripe.error.InvalidRequestError:
             return Response({"error": "Reader not found"}, status=status.HTTP_404_NOT_FOUND)
         except stripe.error.StripeError as e:
@@ -1025,7 +1034,6 @@ class CreatePaymentLinkAPI(APIView):
         if not KioskClient.objects.filter(id=kiosk_id).exists():
             return Response({"error": "Invalid kiosk ID"}, status=400)
 
-        paypal_service = PayPalService()
         payment = paypal_service.create_payment(transaction_id, kiosk_id, price, num_pictures)
 
         if payment:
@@ -1070,6 +1078,97 @@ class CheckPaymentStatusAPI(APIView):
         except Order.DoesNotExist:
             return Response({"error": "Order not found"}, status=404)
 
+class BatchPaymentStatusAPI(APIView):
+    authentication_classes = [KioskAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    @swagger_auto_schema(
+        operation_description="Check the status of several orders at once, by transaction or PaymentIntent id",
+        request_body=openapi.Schema(
+            type=openapi.TYPE_OBJECT,
+            required=['ids'],
+            properties={
+                'ids': openapi.Schema(
+                    type=openapi.TYPE_ARRAY,
+                    items=openapi.Schema(type=openapi.TYPE_STRING),
+                    description="Transaction or PaymentIntent ids, at most the kiosk's payment_status_batch_limit (PAYMENT_STATUS_BATCH_LIMIT when unset)",
+                ),
+            },
+        ),
+        responses={
+            200: openapi.Response(
+                description="Statuses of the orders found; unknown ids are listed under missing",
+                examples={
+                    "application/json": {
+                        "orders": {
+                            "pi_123": {"status": "paid", "updated_at": "2024-01-01T12:00:00Z"}
+                        },
+                        "missing": ["txn-unknown"]
+                    }
+                }
+            ),
+            400: "Invalid or too many ids",
+        },
+        tags=['Payment']
+    )
+    def post(self, request):
+        ids = request.data.get('ids')
+        if not isinstance(ids, list) or not ids or not all(isinstance(i, str) and i for i in ids):
+            return Response({"error": "ids must be a non-empty list of strings"}, status=400)
+
+        ids = list(dict.fromkeys(ids))
+        configuration = getattr(request.user, 'configuration', None)
+        limit = (configuration and configuration.payment_status_batch_limit) or settings.PAYMENT_STATUS_BATCH_LIMIT
+        if len(ids) > limit:
+            return Response({"error": f"At most {limit} ids per request"}, status=400)
+
+        # One query over the two unique indexes
+        rows = Order.objects.filter(
+            Q(transaction_id__in=ids) | Q(stripe_payment_intent_id__in=ids)
+        ).values_list('transaction_id', 'stripe_payment_intent_id', 'status', 'updated_at')
+
+        requested = set(ids)
+        orders = {}
+        for transaction_id, payment_intent_id, order_status, updated_at in rows:
+            state = {"status": order_status, "updated_at": updated_at}
+            for order_id in (transaction_id, payment_intent_id):
+                if order_id in requested:
+                    orders[order_id] = state
+
+        return Response({
+            "orders": orders,
+            "missing": [i for i in ids if i not in orders],
+        }, status=200)
+
+async def wait_payment_status(request, transaction_id):
+    """
+    Long-poll variant of CheckPaymentStatusAPI. Holds the request until the
+    order's status differs from ?since= or ?timeout= seconds pass (capped at
+    PAYMENT_STATUS_WAIT_TIMEOUT). Async, so a waiting kiosk holds no worker.
+    """
+    if request.method != "GET":
+        return JsonResponse({"error": "Method not allowed"}, status=405)
+
+    authenticator = KioskAuthentication()
+    try:
+        if await sync_to_async(authenticator.authenticate)(request) is None:
+            raise NotAuthenticated()
+    except (AuthenticationFailed, NotAuthenticated) as e:
+        response = JsonResponse({"detail": str(e.detail)}, status=401)
+        response["WWW-Authenticate"] = authenticator.authenticate_header(request)
+        return response
+
+    try:
+        timeout = float(request.GET.get("timeout", settings.PAYMENT_STATUS_WAIT_TIMEOUT))
+    except ValueError:
+        return JsonResponse({"error": "timeout must be a number of seconds"}, status=400)
+    timeout = min(max(timeout, 0), settings.PAYMENT_STATUS_WAIT_TIMEOUT)
+
+    result = await OrderStatusWaitService.wait(transaction_id, request.GET.get("since"), timeout)
+    if result is None:
+        return JsonResponse({"error": "Order not found"}, status=404)
+    return JsonResponse(result)
+
 class PaypalAPIWebhook(APIView):
     permission_classes = [AllowAny]
     @csrf_exempt
@@ -1160,7 +1259,7 @@ class PaypalAPIExecute(APIView):
             logger.error("Payment execution failed: Missing paymentId or PayerID")
             return JsonResponse({'success': False, 'message': 'Payment execution failed'}, status=400)
 
-        payment = Payment.find(payment_id)
+        payment = Payment.find(payment_id, api=http_client.paypal_api())
 
         if payment.execute({"payer_id": payer_id}):
             logger.info(f"Payment executed successfully for payment ID {payment_id}")
@@ -1190,13 +1289,178 @@ class PaypalAPICancel(APIView):
         logger.info("Payment was cancelled by the user.")
         return JsonResponse({'success': False, 'message': 'Payment was cancelled'})
 
+BYTE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+class ThreadedStreamingMixin:
+    """
+    Under ASGI, Django reads a synchronous streaming body to the end with
+    sync_to_async(list) before sending any of it, so large downloads would be
+    held in memory. Served through this mixin, the chunks are produced one at
+    a time in a worker thread and sent as they come. WSGI iteration is unchanged.
+    """
+
+    async def __aiter__(self):
+        if self.is_async:
+            async for part in super().__aiter__():
+                yield part
+            return
+
+        chunks = iter(self.streaming_content)
+        next_chunk = sync_to_async(next, thread_sensitive=False)
+        while (chunk := await next_chunk(chunks, None)) is not None:
+            yield chunk
+
+class ThreadedStreamingHttpResponse(ThreadedStreamingMixin, StreamingHttpResponse):
+    pass
+
+class ThreadedFileResponse(ThreadedStreamingMixin, FileResponse):
+    # Each chunk costs a thread hop under ASGI, so read more than the default 4 KiB at a time
+    block_size = 64 * 1024
+
+class FileRange:
+    """
+    File object limited to [start, end) so FileResponse streams (or sendfile()s
+    under gunicorn) only the requested byte range
+    """
+
+    def __init__(self, file, start, end):
+        self.file = file
+        self.name = file.name
+        self.end = end
+        file.seek(start)
+
+    def read(self, size=-1):
+        remaining = self.end - self.file.tell()
+        if remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        return self.file.read(size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_END:
+            return self.file.seek(self.end + offset)
+        return self.file.seek(offset, whence)
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.file.tell()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+def parse_byte_range(header, size):
+    """
+    Returns (start, end) for a single "bytes=" range, None when the header should be
+    ignored (multiple or malformed ranges) and raises ValueError when unsatisfiable
+    """
+    match = BYTE_RANGE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+
+    first, last = match.groups()
+    if not first:
+        length = int(last)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        return max(size - length, 0), size
+
+    start = int(first)
+    end = min(int(last) + 1, size) if last else size
+    if start >= size or start >= end:
+        raise ValueError("Range outside of the file")
+    return start, end
+
+@require_http_methods(["GET", "HEAD"])
+def serve_media(request, path):
+    """
+    Media files with ETag/Last-Modified revalidation and single Range requests, so
+    interrupted kiosk downloads resume where they stopped. With MEDIA_ACCEL_REDIRECT
+    set the file is handed to nginx through X-Accel-Redirect instead of streamed here.
+    """
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404("Media file not found")
+
+    try:
+        stat = os.stat(full_path)
+    except OSError:
+        raise Http404("Media file not found")
+    if not os.path.isfile(full_path):
+        raise Http404("Media file not found")
+
+    content_type = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+
+    if settings.MEDIA_ACCEL_REDIRECT:
+        # nginx answers Range, If-Range and conditional requests for internal locations itself
+        response = HttpResponse(content_type=content_type)
+        response["X-Accel-Redirect"] = settings.MEDIA_ACCEL_REDIRECT + path
+        return response
+
+    etag = quote_etag(f"{stat.st_mtime_ns:x}-{stat.st_size:x}")
+    last_modified = int(stat.st_mtime)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": http_date(last_modified),
+        "Accept-Ranges": "bytes",
+    }
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    byte_range = None
+    range_header = request.META.get("HTTP_RANGE")
+    if_range = request.META.get("HTTP_IF_RANGE")
+    if range_header and if_range:
+        # A stale validator means the client's partial copy is of another version: send it all
+        if if_range.startswith(('"', 'W/')):
+            if if_range != etag:
+                range_header = None
+        elif parse_http_date_safe(if_range) != last_modified:
+            range_header = None
+
+    if range_header:
+        try:
+            byte_range = parse_byte_range(range_header, stat.st_size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{stat.st_size}"
+            for header, value in headers.items():
+                response[header] = value
+            return response
+
+    file = open(full_path, "rb")
+    if byte_range is None:
+        response = ThreadedFileResponse(file, content_type=content_type)
+    else:
+        start, end = byte_range
+        response = ThreadedFileResponse(FileRange(file, start, end), status=206, content_type=content_type)
+        response["Content-Range"] = f"bytes {start}-{end - 1}/{stat.st_size}"
+
+    for header, value in headers.items():
+        response[header] = value
+    return response
+
+def absolute_renditions(request, renditions):
+    return [dict(rendition, url=request.build_absolute_uri(rendition["url"])) for rendition in renditions]
+
 class CardImageAPI(APIView):
     authentication_classes = [KioskAuthentication]
     permission_classes = [IsAuthenticated]
 
     @swagger_auto_schema(
-        operation_description="Get all available card images",
+        operation_description="Get all available card images. Send If-None-Match with the last ETag to get a 304 when the catalog is unchanged. The X-Card-Cursor header is the change feed cursor to continue from.",
         responses={
+            304: "Catalog unchanged since the ETag in If-None-Match",
             200: openapi.Response(
                 description="List of card images",
                 examples={
@@ -1207,7 +1471,17 @@ class CardImageAPI(APIView):
                                 "title": "Card Title",
                                 "description": "Card Description",
                                 "image_url": "https://example.com/image.jpg",
-                                "version": 1
+                                "version": 1,
+                                "renditions": [
+                                    {
+                                        "url": "/media/cards/renditions/uuid/320.webp",
+                                        "format": "webp",
+                                        "width": 320,
+                                        "height": 480,
+                                        "bytes": 18342,
+                                        "hash": "sha256 hex digest"
+                                    }
+                                ]
                             }
                         ]
                     }
@@ -1217,23 +1491,28 @@ class CardImageAPI(APIView):
         tags=['Cards']
     )
     def get(self, request):
-        cards = CardImage.objects.filter(is_enabled=True)
-        cards_data = [
-            {
-                "id": str(card.id),
-                "image_url": f"{settings.MEDIA_URL}{card.image}",
-                "version": card.version,
-                "is_enabled": card.is_enabled,
-                "created_at": card.created_at.isoformat(),
-                "updated_at": card.updated_at.isoformat(),
-            }
-            for card in cards
-        ]
+        catalog = CardCatalogService.get_state()
+        headers = {
+            "ETag": quote_etag(catalog["etag"]),
+            "Last-Modified": http_date(catalog["last_modified"]),
+            "Cache-Control": "no-cache",
+            "X-Card-Cursor": str(catalog.get("cursor", 0)),
+        }
+
+        response = get_conditional_response(
+            request._request,
+            etag=headers["ETag"],
+            last_modified=catalog["last_modified"],
+        )
+        if response is None:
+            response = HttpResponse(CardCatalogService.get_body(catalog), content_type="application/json")
 
-        return Response({"cards": cards_data}, status=status.HTTP_200_OK)
+        for header, value in headers.items():
+            response[header] = value
+        return response
 
     @swagger_auto_schema(
-        operation_description="Get cards that need updating based on version",
+        operation_description="Get the cards a kiosk needs to sync: updated cards, cards it lacks and removed card ids",
         manual_parameters=[
             openapi.Parameter(
                 'versions',
@@ -1243,25 +1522,293 @@ class CardImageAPI(APIView):
                 required=True
             )
         ],
+        responses={
+            200: openapi.Response(
+                description="Cards to sync",
+                examples={
+                    "application/json": {
+                        "updates": [{"id": "uuid", "image_url": "https://example.com/media/cards/uuid.jpg", "version": 3}],
+                        "new": [{"id": "uuid", "image_url": "https://example.com/media/cards/uuid.jpg", "version": 1}],
+                        "removed": ["uuid"]
+                    }
+                }
+            ),
+            400: "Invalid versions format"
+        },
         tags=['Cards']
     )
     def post(self, request):
         try:
-            versions = json.loads(request.data.get('versions', '{}'))
-            updates_needed = []
-            
-            for card_id, client_version in versions.items():
-                try:
-                    card = CardImage.objects.get(id=card_id, is_enabled=True)
-                    if card.version > int(client_version):
-                        updates_needed.append(card)
-                except CardImage.DoesNotExist:
-                    continue
-                    
-            serializer = CardImageSerializer(updates_needed, many=True)
-            return Response({"updates": serializer.data})
-        except json.JSONDecodeError:
+            versions = request.data.get('versions', '{}')
+            if isinstance(versions, str):
+                versions = json.loads(versions)
+            if not isinstance(versions, dict):
+                raise ValueError("versions must be an object")
+        except (json.JSONDecodeError, ValueError):
             return Response(
                 {"error": "Invalid versions format"}, 
                 status=400
-            )
\ No newline at end of file
+            )
+
+        changes = CardCatalogService.diff(versions)
+        for key in ('updates', 'new'):
+            changes[key] = [
+                {
+                    "id": card["id"],
+                    "image_url": request.build_absolute_uri(card["image_url"]),
+                    "version": card["version"],
+                    "renditions": absolute_renditions(request, card["renditions"]),
+                }
+                for card in changes[key]
+            ]
+        return Response(changes)
+
+class CardChangesAPI(APIView):
+    authentication_classes = [KioskAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    MAX_LIMIT = 500
+
+    @swagger_auto_schema(
+        operation_description="Get card catalog changes after a cursor. Start from 0 (or the X-Card-Cursor of the card list) and follow next_cursor while has_more is true.",
+        manual_parameters=[
+            openapi.Parameter(
+                'since',
+                openapi.IN_QUERY,
+                description="Last cursor the kiosk has applied (default: 0)",
+                type=openapi.TYPE_INTEGER,
+                required=False,
+                default=0
+            ),
+            openapi.Parameter(
+                'limit',
+                openapi.IN_QUERY,
+                description="Maximum number of changes per page (default: 100, max: 500)",
+                type=openapi.TYPE_INTEGER,
+                required=False,
+                default=100
+            )
+        ],
+        responses={
+            200: openapi.Response(
+                description="Changes after the cursor",
+                examples={
+                    "application/json": {
+                        "changes": [
+                            {
+                                "seq": 42,
+                                "card_id": "uuid",
+                                "action": "upsert",
+                                "card": {
+                                    "id": "uuid",
+                                    "image_url": "https://example.com/media/cards/uuid.jpg",
+                                    "version": 2,
+                                    "updated_at": "2024-01-20T12:00:00+00:00"
+                                }
+                            },
+                            {"seq": 43, "card_id": "uuid", "action": "delete", "card": None}
+                        ],
+                        "next_cursor": 43,
+                        "has_more": False
+                    }
+                }
+            ),
+            400: "Invalid since or limit value"
+        },
+        tags=['Cards']
+    )
+    def get(self, request):
+        try:
+            since = int(request.query_params.get('since', 0))
+            limit = int(request.query_params.get('limit', 100))
+            if since < 0 or limit <= 0:
+                raise ValueError("since and limit must be positive")
+        except ValueError:
+            raise ValidationError({'error': 'Invalid since or limit value'})
+
+        feed = CardCatalogService.changes_since(since, min(limit, self.MAX_LIMIT))
+        for change in feed['changes']:
+            if change['card']:
+                change['card']['image_url'] = request.build_absolute_uri(change['card']['image_url'])
+                change['card']['renditions'] = absolute_renditions(request, change['card']['renditions'])
+        return Response(feed)
+
+class CardArchiveAPI(APIView):
+    authentication_classes = [KioskAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    MAX_IDS = 5000
+
+    archive_parameters = [
+        openapi.Parameter(
+            'width',
+            openapi.IN_QUERY,
+            description="Pack the smallest rendition at least this wide instead of the original",
+            type=openapi.TYPE_INTEGER,
+            required=False
+        ),
+        openapi.Parameter(
+            'image_format',
+            openapi.IN_QUERY,
+            description="Rendition format to pack (webp or jpeg)",
+            type=openapi.TYPE_STRING,
+            required=False
+        )
+    ]
+
+    @swagger_auto_schema(
+        operation_description="Stream a tar archive of every card changed after a cursor (0 for a full bootstrap). The archive starts with manifest.json listing the files, removed ids and the cursor to continue from.",
+        manual_parameters=[
+            openapi.Parameter(
+                'since',
+                openapi.IN_QUERY,
+                description="Last change feed cursor the kiosk has applied (default: 0)",
+                type=openapi.TYPE_INTEGER,
+                required=False,
+                default=0
+            )
+        ] + archive_parameters,
+        responses={200: "application/x-tar stream", 400: "Invalid parameters"},
+        tags=['Cards']
+    )
+    def get(self, request):
+        try:
+            since = int(request.query_params.get('since', 0))
+            if since < 0:
+                raise ValueError("since must be positive")
+        except ValueError:
+            raise ValidationError({'error': 'Invalid since value'})
+
+        options = self.archive_options(request)
+
+        changes = CardCatalogService.changed_since(since)
+        cards = list(CardImage.objects.filter(
+            id__in=changes['upserted'], is_enabled=True,
+        ).prefetch_related('renditions'))
+        return self.archive_response(cards, changes['removed'], changes['cursor'], **options)
+
+    @swagger_auto_schema(
+        operation_description="Stream a tar archive of the requested cards. The archive starts with manifest.json; requested ids that are disabled or unknown are listed as removed.",
+        manual_parameters=archive_parameters,
+        request_body=openapi.Schema(
+            type=openapi.TYPE_OBJECT,
+            required=['ids'],
+            properties={
+                'ids': openapi.Schema(type=openapi.TYPE_ARRAY, items=openapi.Schema(type=openapi.TYPE_STRING)),
+            },
+        ),
+        responses={200: "application/x-tar stream", 400: "Invalid parameters"},
+        tags=['Cards']
+    )
+    def post(self, request):
+        ids = request.data.get('ids')
+        if not isinstance(ids, list) or len(ids) > self.MAX_IDS:
+            raise ValidationError({'error': f'ids must be a list of at most {self.MAX_IDS} card ids'})
+        options = self.archive_options(request)
+
+        valid_ids = []
+        removed = []
+        for card_id in ids:
+            try:
+                valid_ids.append(uuid.UUID(str(card_id)))
+            except ValueError:
+                removed.append(card_id)
+
+        cards = list(CardImage.objects.filter(id__in=valid_ids, is_enabled=True).prefetch_related('renditions'))
+        found = {card.id for card in cards}
+        removed += [str(card_id) for card_id in valid_ids if card_id not in found]
+        return self.archive_response(cards, removed, None, **options)
+
+    def archive_options(self, request):
+        width = request.query_params.get('width')
+        image_format = request.query_params.get('image_format')
+        try:
+            width = int(width) if width else None
+        except ValueError:
+            raise ValidationError({'error': 'Invalid width value'})
+        if image_format and image_format not in ('webp', 'jpeg'):
+            raise ValidationError({'error': 'image_format must be webp or jpeg'})
+        return {'width': width, 'image_format': image_format}
+
+    def archive_response(self, cards, removed, cursor, width=None, image_format=None):
+        response = ThreadedStreamingHttpResponse(
+            CardArchiveService.stream(cards, removed, cursor, width, image_format),
+            content_type='application/x-tar',
+        )
+        response['Content-Disposition'] = 'attachment; filename="cards.tar"'
+        if cursor is not None:
+            response['X-Card-Cursor'] = str(cursor)
+        return response
+
+class CardSpriteAPI(APIView):
+    authentication_classes = [KioskAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    @swagger_auto_schema(
+        operation_description="Get the thumbnail sprite atlas of all enabled cards. Large catalogs span several pages; each tile names its page, and image_url/width/height describe the first. Page URLs change with every catalog version and can be cached forever; send If-None-Match to get a 304 while the catalog is unchanged.",
+        responses={
+            200: openapi.Response(
+                description="Sprite atlas and coordinate map",
+                examples={
+                    "application/json": {
+                        "image_url": "https://example.com/media/cards/sprites/sha256.webp",
+                        "width": 480,
+                        "height": 480,
+                        "pages": [
+                            {"image_url": "https://example.com/media/cards/sprites/sha256.webp", "width": 480, "height": 480}
+                        ],
+                        "tile_width": 160,
+                        "tile_height": 240,
+                        "tiles": {
+                            "uuid": {"page": 0, "x": 0, "y": 0, "w": 160, "h": 240, "version": 2}
+                        }
+                    }
+                }
+            ),
+            304: "Catalog unchanged since the ETag in If-None-Match",
+            503: "Another request is building the atlas for this catalog version; retry after Retry-After seconds"
+        },
+        tags=['Cards']
+    )
+    def get(self, request):
+        catalog = CardCatalogService.get_state()
+        headers = {
+            "ETag": quote_etag(f"sprite-{catalog['etag']}"),
+            "Last-Modified": http_date(catalog["last_modified"]),
+            "Cache-Control": "no-cache",
+        }
+
+        response = get_conditional_response(
+            request._request,
+            etag=headers["ETag"],
+            last_modified=catalog["last_modified"],
+        )
+        if response is None:
+            atlas = CardSpriteService.get_atlas(catalog)
+            if atlas is None:
+                return Response(
+                    {"error": "The sprite atlas for this catalog version is being built, retry shortly"},
+                    status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    headers={"Retry-After": "2"},
+                )
+            pages = [
+                {
+                    "image_url": request.build_absolute_uri(f"{settings.MEDIA_URL}{page['path']}"),
+                    "width": page["width"],
+                    "height": page["height"],
+                }
+                for page in atlas["pages"]
+            ]
+            first_page = pages[0] if pages else {"image_url": None, "width": 0, "height": 0}
+            response = Response(dict(
+                first_page,
+                pages=pages,
+                tile_width=atlas["tile_width"],
+                tile_height=atlas["tile_height"],
+                tiles=atlas["tiles"],
+            ))
+
+        for header, value in headers.items():
+            response[header] = value
+        return response
+